@@ -1,24 +1,95 @@
+import json
+import hashlib
 import traceback
+import threading
 import numpy as np
+import shapely
 from shapely.geometry import Polygon, MultiPolygon, Point, MultiPoint, shape
 from shapely.affinity import scale
 
 import Lumos
 from Lumos import utils
+from Lumos.LRUCache import LRU_Cache
+
+
+# process-wide cache of parsed annotations, keyed by get_cache_key
+annotation_cache = LRU_Cache(max_bytes=512*1024**2, sizeof=lambda anno: anno.get_nbytes())
+
+def get_cache_key(db, task_id, sop):
+    # annotation_cache key of (task_id, sop) in a database: several databases can be open in one process (e.g. MongoDB and SQLite)
+    return (db.backend.identity(), db.db.name, task_id, sop)
+
+def set_annotation_cache_size(max_bytes):
+    """Sets the memory budget of the process-wide annotation cache (evicts least recently used annotations)"""
+    annotation_cache.resize(max_bytes)
+
+def get_annotation_cache_stats():
+    """Returns the hit, miss and eviction counters and memory usage of the process-wide annotation cache"""
+    return annotation_cache.stats()
+
+
+# top-level fields of annotation documents that are not geometries
+anno_meta_keys = ['_id', 'task_id', 'sop', 'studyuid', 'has_wkb', 'path', 'content_hash']
+
+def get_content_hash(anno_dict):
+    """Hash of an annotation's content (GeoJSON geometries and values, without ids and binary geometries)"""
+    content = {k: ({gk: gv for gk, gv in v.items() if gk!='cont_wkb'} if isinstance(v, dict) else v)
+               for k, v in anno_dict.items() if k not in anno_meta_keys}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+def add_wkb(anno_dict):
+    """Adds the binary (WKB) representation of every GeoJSON geometry as 'cont_wkb' (in place)
+    
+    Args:
+        anno_dict (dict): annotation document with GeoJSON geometries
+        
+    Returns:
+        dict: anno_dict with 'cont_wkb' fields, 'has_wkb' marker and 'content_hash'
+    """
+    anno_dict['content_hash'] = get_content_hash(anno_dict)
+    for geom_name, geom in anno_dict.items():
+        if geom_name in anno_meta_keys or not isinstance(geom, dict) or 'cont' not in geom: continue
+        try:    geom['cont_wkb'] = shapely.to_wkb(shape(geom['cont']))
+        except: print(geom_name); print(traceback.format_exc())
+    anno_dict['has_wkb'] = True
+    return anno_dict
+
+def decode_wkb(anno_dicts):
+    """Decodes the WKB geometries of many annotation documents in one vectorized shapely.from_wkb call (in place)
+    
+    Note:
+        Decoded geometries replace the GeoJSON in 'cont'. Documents without WKB keep their GeoJSON (parsed lazily).
+    
+    Args:
+        anno_dicts (iterable of dict): annotation documents
+    """
+    geoms = [g for d in anno_dicts for k, g in d.items() if k not in anno_meta_keys and isinstance(g, dict) and 'cont_wkb' in g]
+    if len(geoms)==0: return
+    decoded = shapely.from_wkb(np.array([g.pop('cont_wkb') for g in geoms], dtype=object), on_invalid='ignore')
+    for g, geo in zip(geoms, decoded):
+        if geo is not None: g['cont'] = geo
+
+def geojson_has_positions(coords):
+    """True if a (nested) GeoJSON coordinate list holds at least one position, stops at the first one found"""
+    if not isinstance(coords, (list, tuple)): return True
+    return any(geojson_has_positions(c) for c in coords)
+
+def geojson_nr_positions(coords):
+    """Number of positions in a (nested) GeoJSON coordinate list"""
+    if len(coords)==0 or not isinstance(coords[0], (list, tuple)): return 1 if len(coords)>0 else 0
+    return sum(geojson_nr_positions(c) for c in coords)
 
 
 class Annotation:
-    def __init__(self, db, task_id=None, sop=None):
+    def __init__(self, db, task_id=None, sop=None, anno_dict=None):
         assert type(db)==Lumos.Quad.QUAD_Manager, 'quad should be of type Lumos.Quad.QUAD_Manager'
-        if task_id is not None and sop is not None: anno_dict = db.anno_coll.find_one({'task_id': task_id, 'sop': sop})
-        if anno_dict is None:                       anno_dict = dict()
+        if anno_dict is None and task_id is not None and sop is not None: anno_dict = db.anno_coll.find_one({'task_id': task_id, 'sop': sop})
+        if anno_dict is None:                                             anno_dict = dict()
         if anno_dict != dict(): 
             self.task_id=anno_dict['task_id']; self.sop=anno_dict['sop']; self.studyuid=anno_dict['studyuid']
-            for k in ['_id', 'task_id', 'sop', 'studyuid']: anno_dict.pop(k)
-        for geom_name in anno_dict: 
-            try: anno_dict[geom_name]['cont'] = shape(anno_dict[geom_name]['cont'])
-            except: print(geom_name); print(anno_dict.keys()); print(traceback.format_exc())
-        self.anno = anno_dict
+            for k in anno_meta_keys: anno_dict.pop(k, None)
+        self.anno  = anno_dict # raw GeoJSON, geometries are parsed on first access
+        self.geoms = dict()    # geom_name: parsed shapely geometry
         self.ph, self.pw = self.get_pixel_size()
         self.h,  self.w  = self.get_image_size()
         
@@ -73,6 +144,43 @@ class Annotation:
         cont1, cont2 = self.get_contour(cont_name), other_anno.get_contour(cont_name)
         utils.plot_geo_face_comparison(ax, cont1, cont2, colors=colors, alpha=alpha)
 
+    def get_geometry_type(self, geom_name):
+        """Geometry type from the document metadata (no parsing)
+        
+        Args:
+            geom_name (str): contour or point name
+            
+        Returns:
+            str: GeoJSON geometry type, None if not available or empty
+        """
+        try:    cont = self.anno[geom_name]['cont']
+        except: return None
+        if geom_name in self.geoms or isinstance(cont, shapely.Geometry):
+            geo = self.get_geometry(geom_name)
+            return None if geo is None or geo.is_empty else geo.geom_type
+        try:
+            if not geojson_has_positions(cont['coordinates']): return None
+            return cont['type']
+        except: return None
+
+    def get_geometry(self, geom_name):
+        """Parses the geometry on first access
+        
+        Args:
+            geom_name (str): contour or point name
+            
+        Returns:
+            shapely.geometry: parsed geometry, None if it cannot be parsed
+        """
+        if geom_name not in self.geoms:
+            cont, wkb = self.anno[geom_name]['cont'], self.anno[geom_name].get('cont_wkb')
+            try:
+                if   isinstance(cont, shapely.Geometry): self.geoms[geom_name] = cont
+                elif wkb is not None:                    self.geoms[geom_name] = shapely.from_wkb(wkb)
+                else:                                    self.geoms[geom_name] = shape(cont)
+            except: print(geom_name); print(self.anno.keys()); print(traceback.format_exc()); self.geoms[geom_name] = None
+        return self.geoms[geom_name]
+
     def available_contour_names(self):
         """Accessible contour names
         
@@ -90,12 +198,7 @@ class Annotation:
         Returns:
             bool: True if contour available, else False
         """
-        if not cont_name in self.anno.keys():              return False
-        if not 'cont' in self.anno[cont_name]:             return False
-        a = self.anno[cont_name]['cont']
-        if a.is_empty:                                     return False
-        if a.geom_type not in ['Polygon', 'MultiPolygon']: return False
-        return True
+        return self.get_geometry_type(cont_name) in ['Polygon', 'MultiPolygon']
 
     def get_contour(self, cont_name):
         """getter function
@@ -106,8 +209,9 @@ class Annotation:
         Returns:
             shapely.geometry: contour polygon if contour available, else empty shapely.geometry.Polygon
         """
-        if self.has_contour(cont_name): return self.anno[cont_name]['cont']
-        else: return Polygon()
+        if self.has_contour(cont_name): geo = self.get_geometry(cont_name)
+        else:                           geo = None
+        return geo if geo is not None else Polygon()
 
     def available_point_names(self):
         """Accessible point names
@@ -126,12 +230,7 @@ class Annotation:
         Returns:
             bool: True if point available, else False
         """
-        if not point_name in self.anno.keys():         return False
-        if not 'cont' in self.anno[point_name]:        return False
-        a = self.anno[point_name]['cont']
-        if a.is_empty:                                 return False
-        if a.geom_type not in ['Point', 'MultiPoint']: return False
-        return True
+        return self.get_geometry_type(point_name) in ['Point', 'MultiPoint']
 
     def get_point(self, point_name):
         """getter function
@@ -142,8 +241,9 @@ class Annotation:
         Returns:
             shapely.geometry: point if available, else empty shapely.geometry.Point
         """
-        if self.has_point(point_name): return self.anno[point_name]['cont']
-        else:                          return Point()
+        if self.has_point(point_name): geo = self.get_geometry(point_name)
+        else:                          geo = None
+        return geo if geo is not None else Point()
 
 
     def has_threshold(self, thresh_name):
@@ -188,6 +288,21 @@ class Annotation:
         if not mp.geom_type=='MultiPolygon': mp = MultiPolygon([mp])
         return utils.to_mask(mp, self.h, self.w)
     
+    def get_nbytes(self):
+        """Approximate memory footprint (used for the annotation cache budget)
+        
+        Returns:
+            int: size in bytes
+        """
+        nr_coords = 0
+        for geom in self.anno.values():
+            try:
+                cont = geom['cont']
+                if isinstance(cont, shapely.Geometry): nr_coords += int(shapely.get_num_coordinates(cont))
+                else:                                  nr_coords += geojson_nr_positions(cont['coordinates'])
+            except: continue
+        return 1024 + 256*len(self.anno) + 160*nr_coords # raw GeoJSON and parsed geometry
+    
     def get_image_size(self):
         """Returns the image height and width of the referenced dicom image
         
@@ -352,3 +467,98 @@ class Annotation:
             vals = img[(low<=angle_mask) & (angle_mask<high) & (myo_mask!=0)]
             bin_dict[(low, high)] = vals
         return bin_dict
+
+
+
+class Annotation_Store:
+    """Annotation_Store serves the annotations of one evaluation from memory
+
+    Note:
+        All annotations of the task for the stack's sops are fetched in one query (served by the (task_id, studyuid) index) 
+        and indexed by (slice, phase) via depthandtime2sop. Annotations are parsed on first access and kept in the 
+        process-wide annotation_cache. Call invalidate or reload after annotations were changed in the database (e.g. GUI edits).
+
+    Args:
+        db (Lumos.Quad.QUAD_Manager): database manager
+        task_id (str): task of the annotations
+        studyuid (str): study of the annotations
+        depthandtime2sop (dict of (int, int): str): maps (slice, phase) to sop
+
+    Attributes:
+        docs (dict of str: dict): raw annotation documents by sop that have not been parsed yet (None if not loaded)
+        missing (set of str): sops without annotation
+    """
+    def __init__(self, db, task_id, studyuid, depthandtime2sop):
+        self.db               = db
+        self.task_id          = task_id
+        self.studyuid         = studyuid
+        self.depthandtime2sop = depthandtime2sop
+        self.docs, self.missing = None, set()
+        self.lock             = threading.RLock() # get_anno is also called from background prefetching
+
+    def load(self):
+        """Fetches all annotation documents of the stack in one query"""
+        sops = list(self.depthandtime2sop.values())
+        docs = self.db.anno_coll.find({'task_id': self.task_id, 'studyuid': self.studyuid, 'sop': {'$in': sops}})
+        self.docs    = {d['sop']: d for d in docs}
+        decode_wkb(self.docs.values())
+        self.missing = set(sops).difference(self.docs.keys())
+
+    def get_anno(self, slice_nr, phase_nr):
+        """getter function
+        
+        Args:
+            slice_nr (int): slice number
+            phase_nr (int): phase number
+            
+        Returns:
+            Annotation: annotation of (slice, phase), empty Annotation if none stored
+        """
+        sop  = self.depthandtime2sop[(slice_nr, phase_nr)]
+        anno = annotation_cache.get(get_cache_key(self.db, self.task_id, sop))
+        if anno is not None: return anno
+        with self.lock:
+            anno = annotation_cache.get(get_cache_key(self.db, self.task_id, sop)) # parsed by another thread meanwhile
+            if anno is not None: return anno
+            if self.docs is None or (sop not in self.docs and sop not in self.missing): self.load() # first access or evicted
+            if sop in self.missing: return Annotation(self.db, anno_dict=dict())
+            anno = Annotation(self.db, anno_dict=self.docs.pop(sop))
+            annotation_cache.put(get_cache_key(self.db, self.task_id, sop), anno)
+            return anno
+
+    def invalidate(self, slice_nr=None, phase_nr=None):
+        """Forgets annotations so that they are fetched from the database again
+        
+        Args:
+            slice_nr (int): slice to invalidate, if None all annotations are invalidated (lazy reload on next access)
+            phase_nr (int): phase to invalidate, if None all phases of slice_nr are invalidated
+        """
+        with self.lock: self._invalidate(slice_nr, phase_nr)
+
+    def _invalidate(self, slice_nr, phase_nr):
+        for (d, p), sop in self.depthandtime2sop.items():
+            if slice_nr is not None and (d!=slice_nr or (phase_nr is not None and p!=phase_nr)): continue
+            annotation_cache.pop(get_cache_key(self.db, self.task_id, sop))
+            if slice_nr is None or self.docs is None: continue
+            doc = self.db.anno_coll.find_one({'task_id': self.task_id, 'sop': sop})
+            if doc is not None: decode_wkb([doc]); self.docs[sop] = doc; self.missing.discard(sop)
+            else:               self.docs.pop(sop, None); self.missing.add(sop)
+        if slice_nr is None: self.docs, self.missing = None, set()
+
+    def refresh(self, positions):
+        """Refetches the annotations of some (slice, phase) positions from the database in one query"""
+        with self.lock:
+            sops = [self.depthandtime2sop[pos] for pos in positions if pos in self.depthandtime2sop]
+            for sop in sops: annotation_cache.pop(get_cache_key(self.db, self.task_id, sop))
+            if self.docs is None or len(sops)==0: return
+            docs = {d['sop']: d for d in self.db.anno_coll.find({'task_id': self.task_id, 'sop': {'$in': sops}})}
+            decode_wkb(docs.values())
+            for sop in sops:
+                if sop in docs: self.docs[sop] = docs[sop]; self.missing.discard(sop)
+                else:           self.docs.pop(sop, None); self.missing.add(sop)
+
+    def reload(self):
+        """Refetches all annotations of the stack from the database"""
+        with self.lock:
+            self.invalidate()
+            self.load()
@@ -6,11 +6,16 @@ import pydicom
 
 import copy
 
+import Lumos
+
 # Keep generic: 
 # - case can have a reader and a studyuid (with images and evals)
 # - case can refer to a study with images without a reader (without evals)
 # - case can refer to a study without images but with evaluations (e.g. imported cvi reports)
 
+case_imagetypes = ['SAX CINE', 'SAX CS', 'LAX CINE 2CV', 'LAX CINE 3CV', 'LAX CINE 4CV', 'SAX T1 PRE', 'SAX T1 POST', 'SAX T2', 'SAX LGE', 'SAX ECV']
+
+
 class Case:
     def __init__(self, db, studyuid=None):
         if studyuid is not None: 
@@ -18,16 +23,34 @@ class Case:
             except Exception as e: pass
         self.db = db
         self.studyuid = studyuid
-        self.name, self.age, self.gender, self.weight, self.height = self.get_patient_info()
+        if not self.has_patient_info():
+            self.name, self.age, self.gender, self.weight, self.height = self.get_patient_info()
         
+    @classmethod
+    def from_json(cls, db, case_json):
+        # case from an already fetched case_coll document (see load_cases)
+        case = cls.__new__(cls)
+        case.__dict__ = dict(case_json)
+        case.db = db
+        if not case.has_patient_info():
+            case.name, case.age, case.gender, case.weight, case.height = case.get_patient_info()
+        return case
+    
     def get_imgo(self, viewname):
         return self.imgos(viewname)
     
     def get_eval(self, viewname):
         return self.evals(viewname)
     
+    def has_patient_info(self):
+        return all(hasattr(self, k) for k in Lumos.utils.demographics_fields.values())
+    
     def get_patient_info(self):
-        dcm  = pydicom.dcmread(self.db.dcm_coll.find_one({'studyuid' : self.studyuid})['path'], stop_before_pixels=True)
+        # demographics of the case document, else of the lean header documents, only old databases fall back to a file read
+        if self.has_patient_info(): return [getattr(self, k) for k in Lumos.utils.demographics_fields.values()]
+        info = Lumos.utils.get_demographics(self.db.dcm_coll, self.studyuid)
+        if info is not None: return info
+        dcm  = pydicom.dcmread(self.db.dcm_coll.find_one({'studyuid' : self.studyuid}, {'_id': 0, 'path': 1})['path'], stop_before_pixels=True)
         info = []
         try:    info.append(str(dcm.PatientName))
         except: info.append('')
@@ -58,36 +81,64 @@ class Case:
     ###########################################
     ## make case for image types and reader  ##
     ###########################################
-    def get_imgos_evals_case(self, task_id):
-        db = self.db; self.db = None
-        case = copy.deepcopy(self) # mongodb connection not copy-able
-        self.db = db; case.db = db
-        # get imgos and evals
+    def get_imgos_evals_case(self, task_id, imgos=None):
+        # imgos: (studyuid, imagetype, stack_nr) -> ImageOrganizer, shares organizers between readers (see load_cases)
+        return load_cases(self.db, [self.studyuid], [task_id], cases=[self], imgos=imgos)[task_id][0]
+
+
+def load_cases(db, studyuids, task_ids, imagetypes=case_imagetypes, cases=None, imgos=None):
+    """Assembles the cases of many studies and readers with a few $in queries
+
+    Note:
+        Image organizers are shared between the readers' cases, evaluations are built from the fetched documents.
+
+    Args:
+        db (QUAD_Manager): database manager
+        studyuids (list of str): studies of the cases
+        task_ids (list of str): readers
+        imagetypes (list of str): image types searched for image organizers and evaluations
+        cases (list of Case): cases to copy instead of loading the studyuids' case documents
+        imgos (dict): (studyuid, imagetype, stack_nr) -> ImageOrganizer, reused and extended by the loaded organizers
+
+    Returns:
+        dict: task_id -> list of Case with imgos and evals per imagetype (as Case.get_imgos_evals_case)
+    """
+    studyuids, task_ids = list(studyuids), list(task_ids)
+    imgos = dict() if imgos is None else imgos
+    query = {'studyuid': {'$in': studyuids}, 'imagetype': {'$in': list(imagetypes)}}
+    for j in db.imgo_coll.find(query):
+        key = (j['studyuid'], j['imagetype'], j['stack_nr'])
+        if key in imgos: continue
+        try: imgos[key] = ImageOrganizer.from_json(db, j)
+        except Exception as e: print(traceback.format_exc())
+    eval_keys  = {(j['studyuid'], j['imagetype'], j['stack_nr']) for j in db.eval_coll.find(query, {'_id': 0, 'studyuid': 1, 'imagetype': 1, 'stack_nr': 1})}
+    eval_jsons = {(j['task_id'], j['studyuid'], j['imagetype'], j['stack_nr']): j for j in db.eval_coll.find(dict(query, task_id={'$in': task_ids}))}
+    tasks      = {t['_id']: t for t in db.task_coll.find({'_id': {'$in': task_ids}})}
+    if cases is None: case_jsons = list(db.case_coll.find({'studyuid': {'$in': studyuids}}))
+    imgo_stacks, eval_stacks = dict(), dict() # (studyuid, imagetype) -> stack keys
+    for k in imgos:     imgo_stacks.setdefault(k[:2], []).append(k)
+    for k in eval_keys: eval_stacks.setdefault(k[:2], []).append(k)
+    
+    def make_case(i, task_id):
+        if cases is None: case = Case.from_json(db, case_jsons[i])
+        else:
+            template = cases[i]; db_ = template.db; template.db = None
+            case = copy.deepcopy(template) # mongodb connection not copy-able
+            template.db = db_; case.db = db
         case.task_id = task_id
         case.imgos, case.evals = dict(), dict()
-        for imagetype in ['SAX CINE', 'SAX CS', 'LAX CINE 2CV', 'LAX CINE 3CV', 'LAX CINE 4CV', 'SAX T1 PRE', 'SAX T1 POST', 'SAX T2', 'SAX LGE', 'SAX ECV']:
-
-            stacknrs = list(set([d['stack_nr'] for d in self.db.imgo_coll.find({'studyuid':self.studyuid, 'imagetype':imagetype},
-                                                                               {'_id':0,'stack_nr':1})]))
-            if len(stacknrs)!=0: case.imgos[imagetype]=[]
-            for stack_i in stacknrs:
-                try: imgo = ImageOrganizer(self.db, studyuid=self.studyuid, imagetype=imagetype, stack_nr=stack_i)
-                except Exception as e: continue; print(traceback.format_exc()); continue
-                try: 
-                    if hasattr(imgo, 'depthandtime2sop'): case.imgos[imagetype].append(imgo)
-                except Exception as e: continue; print(traceback.format_exc()); continue
-            
-            stacknrs = list(set([d['stack_nr'] for d in self.db.eval_coll.find({'studyuid':self.studyuid, 'imagetype':imagetype},
-                                                                               {'_id':0,'stack_nr':1})]))
-            
-            if len(stacknrs)!=0: case.evals[imagetype]=[]
-            for stack_i in stacknrs:
-                try: eva=Evaluation(self.db,studyuid=self.studyuid,task_id=task_id,imagetype=imagetype,stack_nr=stack_i)
-                except Exception as e: continue; print(traceback.format_exc()); continue
-                try: 
+        for imagetype in imagetypes:
+            keys = imgo_stacks.get((case.studyuid, imagetype), [])
+            if len(keys)!=0: case.imgos[imagetype] = [imgos[k] for k in keys if hasattr(imgos[k], 'depthandtime2sop')]
+            keys = eval_stacks.get((case.studyuid, imagetype), [])
+            if len(keys)!=0: case.evals[imagetype] = []
+            for k in keys:
+                if (task_id,)+k not in eval_jsons or task_id not in tasks: continue
+                eva = Evaluation.from_json(db, eval_jsons[(task_id,)+k], imgos.get(k), tasks[task_id])
+                try:
                     if len(eva.available_contours)>0: case.evals[imagetype].append(eva)
-                except Exception as e: continue; print(traceback.format_exc()); continue
+                except Exception as e: continue
         return case
-                
-                
-                
\ No newline at end of file
+    
+    nr_cases = len(case_jsons) if cases is None else len(cases)
+    return {task_id: [make_case(i, task_id) for i in range(nr_cases)] for task_id in task_ids}
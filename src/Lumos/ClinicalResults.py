@@ -6,15 +6,33 @@ import traceback
 import numpy as np
 
 
-# decorator function for exception handling
+def get_memo_key(cr, args, kwargs):
+    # memo key of get_val(evaluation, ...) calls with plain arguments, None if the call is not memoizable
+    if len(args)<1 or not hasattr(args[0], 'get_cr_memo'): return None
+    extra = list(args[1:]) + [kwargs[k] for k in sorted(kwargs)]
+    if not all(isinstance(a, (str, bool, int)) and '.' not in str(a) and not str(a).startswith('$') for a in extra): return None
+    return '|'.join([type(cr).__name__] + [str(k) for k in sorted(kwargs)] + [str(a) for a in extra])
+
+# decorator function for exception handling and memoization
 def CR_exception_handler(f):
-    def inner_function(*args, **kwargs):
+    # returns np.nan if the calculation fails, results of evaluations are memoized until their annotations change
+    def inner_function(self, *args, **kwargs):
+        memo, key = None, get_memo_key(self, args, kwargs)
         try:
-            return f(*args, **kwargs)
+            if key is not None:
+                memo  = args[0].get_cr_memo()
+                value = memo.get(key)
+                if value is not None: return value
+        except Exception as e: memo = None # memo errors (e.g. read-only database, locked SQLite file) are cache misses
+        try: value = f(self, *args, **kwargs)
         except Exception as e:
             #print(f.__name__ + ' failed to calculate the clinical result. Returning np.nan. Error traceback:')
             #print(traceback.format_exc())
             return np.nan
+        try:
+            if memo is not None: memo.put(key, value)
+        except Exception as e: pass
+        return value
     return inner_function
 
 
@@ -74,8 +92,8 @@ class LVSAX_ESPHASE(Clinical_Result):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
         if 'lv_endo' not in evaluation.available_contours: raise Exception('No lv_endo contours for phase calucation.')
-        lvendo_vol_curve = [evaluation.get_volume(p, 'lv_endo') for p in range(evaluation.nr_phases)]
-        lvpamu_vol_curve = [evaluation.get_volume(p, 'lv_pamu') for p in range(evaluation.nr_phases)]
+        lvendo_vol_curve = evaluation.get_volume_curve('lv_endo')
+        lvpamu_vol_curve = evaluation.get_volume_curve('lv_pamu')
         vol_curve = np.array(lvendo_vol_curve) - np.array(lvpamu_vol_curve)
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
@@ -101,8 +119,8 @@ class LVSAX_EDPHASE(LVSAX_ESPHASE):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
         if 'lv_endo' not in evaluation.available_contours: raise Exception('No lv_endo contours for phase calucation.')
-        lvendo_vol_curve = [evaluation.get_volume(p, 'lv_endo') for p in range(evaluation.nr_phases)]
-        lvpamu_vol_curve = [evaluation.get_volume(p, 'lv_pamu') for p in range(evaluation.nr_phases)]
+        lvendo_vol_curve = evaluation.get_volume_curve('lv_endo')
+        lvpamu_vol_curve = evaluation.get_volume_curve('lv_pamu')
         vol_curve = np.array(lvendo_vol_curve) - np.array(lvpamu_vol_curve)
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
@@ -127,8 +145,8 @@ class RVSAX_ESPHASE(LVSAX_ESPHASE):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
         if 'rv_endo' not in evaluation.available_contours: raise Exception('No rv_endo contours for phase calucation.')
-        rvendo_vol_curve = [evaluation.get_volume(p, 'rv_endo') for p in range(evaluation.nr_phases)]
-        rvpamu_vol_curve = [evaluation.get_volume(p, 'rv_pamu') for p in range(evaluation.nr_phases)]
+        rvendo_vol_curve = evaluation.get_volume_curve('rv_endo')
+        rvpamu_vol_curve = evaluation.get_volume_curve('rv_pamu')
         vol_curve = np.array(rvendo_vol_curve) - np.array(rvpamu_vol_curve)
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
@@ -154,8 +172,8 @@ class RVSAX_EDPHASE(LVSAX_ESPHASE):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
         if 'rv_endo' not in evaluation.available_contours: raise Exception('No rv_endo contours for phase calucation.')
-        rvendo_vol_curve = [evaluation.get_volume(p, 'rv_endo') for p in range(evaluation.nr_phases)]
-        rvpamu_vol_curve = [evaluation.get_volume(p, 'rv_pamu') for p in range(evaluation.nr_phases)]
+        rvendo_vol_curve = evaluation.get_volume_curve('rv_endo')
+        rvpamu_vol_curve = evaluation.get_volume_curve('rv_pamu')
         vol_curve = np.array(rvendo_vol_curve) - np.array(rvpamu_vol_curve)
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
@@ -566,19 +584,13 @@ class NR_OF_SLICES_ROI(Clinical_Result):
     def get_val(self, evaluation, string = False): 
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
-        has_myo_ref = False
-        has_lge_ref = False
-        for d in range(evaluation.nr_slices):
-            anno = evaluation.get_anno(d,0)
-            if anno.has_contour('myo_ref'): has_myo_ref = True
-            elif anno.has_contour('lge_ref'): has_lge_ref = True
+        summary = evaluation.get_summary()
+        has_myo_refs = np.array([summary.has_contour('myo_ref', d, 0) for d in range(evaluation.nr_slices)], dtype=bool)
+        has_lge_refs = np.array([summary.has_contour('lge_ref', d, 0) for d in range(evaluation.nr_slices)], dtype=bool)
+        has_myo_ref, has_lge_ref = has_myo_refs.any(), (has_lge_refs & ~has_myo_refs).any()
         if has_myo_ref and has_lge_ref: return np.nan 
         if not has_myo_ref and not has_lge_ref: return np.nan #für Methoden ohne ROI
-        number_of_ROIs = 0
-        for d in range(evaluation.nr_slices):
-            anno = evaluation.get_anno(d,0)
-            number_of_ROIs += int(anno.has_contour('myo_ref') or anno.has_contour('lge_ref'))
-            int(anno.has_contour('myo_ref') or anno.has_contour('lge_ref'))
+        number_of_ROIs = int(np.sum(has_myo_refs | has_lge_refs))
         return number_of_ROIs
         
 
@@ -595,15 +607,7 @@ class SIZE_ROI(Clinical_Result):
     def get_val(self, evaluation, string = False): 
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
-        myo_ref_size = 0
-        for d in range(evaluation.nr_slices):
-            try:    anno = evaluation.get_anno(d,0)
-            except: continue
-            dcm  = evaluation.get_dcm(d,0)
-            pw, ph = evaluation.pixel_w, evaluation.pixel_h
-            if anno.has_contour('myo_ref') == True: 
-                polygon = anno.get_contour('myo_ref')
-                myo_ref_size += polygon.area * (pw * ph)
+        myo_ref_size = evaluation.get_areas('myo_ref')[:,0].sum()
         
         return myo_ref_size
 
@@ -880,7 +884,7 @@ class LAX_4CV_LAESPHASE(Clinical_Result):
     def get_val(self, evaluation, string=False):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
-        vol_curve = np.array([evaluation.get_volume(p, 'la') for p in range(evaluation.nr_phases)])
+        vol_curve = evaluation.get_volume_curve('la')
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
         valid_idx = np.where(vol_curve > 0)[0]
@@ -903,7 +907,7 @@ class LAX_4CV_LAEDPHASE(LAX_4CV_LAESPHASE):
     def get_val(self, evaluation, string=False):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
-        vol_curve = np.array([evaluation.get_volume(p, 'la') for p in range(evaluation.nr_phases)])
+        vol_curve = evaluation.get_volume_curve('la')
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
         phase = vol_curve.argmax()
@@ -919,7 +923,7 @@ class LAX_4CV_RAESPHASE(LAX_4CV_LAESPHASE):
     def get_val(self, evaluation, string=False):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
-        vol_curve = np.array([evaluation.get_volume(p, 'ra') for p in range(evaluation.nr_phases)])
+        vol_curve = evaluation.get_volume_curve('ra')
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
         valid_idx = np.where(vol_curve > 0)[0]
@@ -936,7 +940,7 @@ class LAX_4CV_RAEDPHASE(LAX_4CV_LAESPHASE):
     def get_val(self, evaluation, string=False):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
-        vol_curve = np.array([evaluation.get_volume(p, 'ra') for p in range(evaluation.nr_phases)])
+        vol_curve = evaluation.get_volume_curve('ra')
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
         phase = vol_curve.argmax()
@@ -952,7 +956,7 @@ class LAX_2CV_LAESPHASE(LAX_4CV_LAESPHASE):
     def get_val(self, evaluation, string=False):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
-        vol_curve = np.array([evaluation.get_volume(p, 'la') for p in range(evaluation.nr_phases)])
+        vol_curve = evaluation.get_volume_curve('la')
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
         valid_idx = np.where(vol_curve > 0)[0]
@@ -969,7 +973,7 @@ class LAX_2CV_LAEDPHASE(LAX_4CV_LAESPHASE):
     def get_val(self, evaluation, string=False):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
-        vol_curve = np.array([evaluation.get_volume(p, 'la') for p in range(evaluation.nr_phases)])
+        vol_curve = evaluation.get_volume_curve('la')
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
         phase = vol_curve.argmax()
@@ -985,7 +989,7 @@ class LAX_2CV_LVESPHASE(LAX_4CV_LAESPHASE):
     def get_val(self, evaluation, string=False):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
-        vol_curve = np.array([evaluation.get_volume(p, 'lv_lax_endo') for p in range(evaluation.nr_phases)])
+        vol_curve = evaluation.get_volume_curve('lv_lax_endo')
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
         valid_idx = np.where(vol_curve > 0)[0]
@@ -1002,7 +1006,7 @@ class LAX_2CV_LVEDPHASE(LAX_4CV_LAESPHASE):
     def get_val(self, evaluation, string=False):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
-        vol_curve = np.array([evaluation.get_volume(p, 'lv_lax_endo') for p in range(evaluation.nr_phases)])
+        vol_curve = evaluation.get_volume_curve('lv_lax_endo')
         has_conts = [a!=0 for a in vol_curve]
         if True not in has_conts: return np.nan
         phase = vol_curve.argmax()
@@ -1027,7 +1031,7 @@ class LAX_2CV_LVESV(Clinical_Result):
         try:    phase = evaluation.clinical_parameters[LAX_2CV_LVESPHASE.__name__]
         except: phase = LAX_2CV_LVESPHASE().get_val(evaluation)
         anno = evaluation.get_anno(0, phase)
-        area = anno.get_contour('lv_lax_endo').area * anno.ph * anno.pw
+        area = evaluation.get_areas('lv_lax_endo')[0, int(phase)]
         cr   = 8/(3*np.pi) * (area**2)/anno.length_LV() / 1000
         return "{:.2f}".format(cr) if string else cr
 
@@ -1051,7 +1055,7 @@ class LAX_2CV_LVEDV(Clinical_Result):
         try:    phase = evaluation.clinical_parameters[LAX_2CV_LVEDPHASE.name][0]
         except: phase = LAX_2CV_LVEDPHASE().get_val(evaluation)
         anno = evaluation.get_anno(0, phase)
-        area = anno.get_contour('lv_lax_endo').area * anno.ph * anno.pw
+        area = evaluation.get_areas('lv_lax_endo')[0, int(phase)]
         cr   = 8/(3*np.pi) * (area**2)/anno.length_LV() / 1000
         return "{:.2f}".format(cr) if string else cr
 
@@ -1396,8 +1400,7 @@ class LAX_4CV_RAESAREA(Clinical_Result):
     def get_val(self, evaluation, string=False):
         try:    phase = evaluation.clinical_parameters[LAX_4CV_RAESPHASE.__name__][0]
         except: phase = LAX_4CV_RAESPHASE().get_val(evaluation)
-        anno = evaluation.get_anno(0, phase)
-        cr = anno.get_contour('ra').area * anno.ph * anno.pw / 100.0
+        cr = evaluation.get_areas('ra')[0, int(phase)] / 100.0
         return "{:.2f}".format(cr) if string else cr
 
     def get_val_diff(self, eval1, eval2, string=False):
@@ -1417,8 +1420,7 @@ class LAX_4CV_RAEDAREA(Clinical_Result):
     def get_val(self, evaluation, string=False):
         try:    phase = evaluation.clinical_parameters[LAX_4CV_RAEDPHASE.__name__][0]
         except: phase = LAX_4CV_RAEDPHASE().get_val(evaluation)
-        anno = evaluation.get_anno(0, phase)
-        cr = anno.get_contour('ra').area * anno.ph * anno.pw / 100.0
+        cr = evaluation.get_areas('ra')[0, int(phase)] / 100.0
         return "{:.2f}".format(cr) if string else cr
 
     def get_val_diff(self, eval1, eval2, string=False):
@@ -1486,8 +1488,7 @@ class LAX_4CV_LAESAREA(Clinical_Result):
     def get_val(self, evaluation, string=False):
         try:    phase = evaluation.clinical_parameters[LAX_4CV_LAESPHASE.__name__][0]
         except: phase = LAX_4CV_LAESPHASE().get_val(evaluation)
-        anno = evaluation.get_anno(0, phase)
-        cr = anno.get_contour('la').area * anno.ph * anno.pw / 100.0
+        cr = evaluation.get_areas('la')[0, int(phase)] / 100.0
         return "{:.2f}".format(cr) if string else cr
 
     def get_val_diff(self, eval1, eval2, string=False):
@@ -1508,8 +1509,7 @@ class LAX_4CV_LAEDAREA(Clinical_Result):
     def get_val(self, evaluation, string=False):
         try:    phase = evaluation.clinical_parameters[LAX_4CV_LAEDPHASE.__name__][0]
         except: phase = LAX_4CV_LAEDPHASE().get_val(evaluation)
-        anno = evaluation.get_anno(0, phase)
-        cr = anno.get_contour('la').area * anno.ph * anno.pw / 100.0
+        cr = evaluation.get_areas('la')[0, int(phase)] / 100.0
         return "{:.2f}".format(cr) if string else cr
 
     def get_val_diff(self, eval1, eval2, string=False):
@@ -1577,8 +1577,7 @@ class LAX_2CV_LAESAREA(Clinical_Result):
     def get_val(self, evaluation, string=False):
         try:    phase = evaluation.clinical_parameters[LAX_2CV_LAESPHASE.__name__][0]
         except: phase = LAX_2CV_LAESPHASE().get_val(evaluation)
-        anno = evaluation.get_anno(0, phase)
-        cr = anno.get_contour('la').area * anno.ph * anno.pw / 100.0
+        cr = evaluation.get_areas('la')[0, int(phase)] / 100.0
         return "{:.2f}".format(cr) if string else cr
 
     def get_val_diff(self, eval1, eval2, string=False):
@@ -1599,8 +1598,7 @@ class LAX_2CV_LAEDAREA(Clinical_Result):
     def get_val(self, evaluation, string=False):
         try:    phase = evaluation.clinical_parameters[LAX_2CV_LAEDPHASE.__name__][0]
         except: phase = LAX_2CV_LAEDPHASE().get_val(evaluation)
-        anno = evaluation.get_anno(0, phase)
-        cr = anno.get_contour('la').area * anno.ph * anno.pw / 100.0
+        cr = evaluation.get_areas('la')[0, int(phase)] / 100.0
         return "{:.2f}".format(cr) if string else cr
 
     def get_val_diff(self, eval1, eval2, string=False):
@@ -1680,11 +1678,17 @@ class SAXMap_GLOBALT1_PRE(Clinical_Result):
     def get_val(self, evaluation, string=False):
         try:    return evaluation.clinical_parameters[self.name][0]
         except: pass
+        summary = evaluation.get_summary()
+        if summary.pixel_stats is not None: # stored by evaluate and reevaluate
+            cr = summary.get_pixel_mean('lv_myo', 0)
+            return "{:.2f}".format(cr) if string else cr
         cr = []
+        try:    imgs = evaluation.get_img_stack(0)
+        except: print(traceback.format_exc()); imgs = None # falls back to reading the images slice by slice
         for d in range(evaluation.nr_slices):
-            try: cr += evaluation.get_anno(d,0).get_pixel_values('lv_myo', evaluation.get_img(d,0)).tolist()
+            try: cr.append(evaluation.get_anno(d,0).get_pixel_values('lv_myo', imgs[d] if imgs is not None else evaluation.get_img(d,0)))
             except: print(traceback.format_exc()); continue
-        cr = np.nanmean(cr)
+        cr = np.nanmean(np.concatenate(cr)) if len(cr)>0 else np.nan
         return "{:.2f}".format(cr) if string else cr
     
     def get_val_diff(self, eval1, eval2, string=False):
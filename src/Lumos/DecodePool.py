@@ -0,0 +1,103 @@
+###############
+# Decode Pool #
+###############
+
+# Background decoding of images in threads (pydicom's pixel decoders release the GIL for most of the work).
+# Jobs are grouped (e.g. by studyuid) so that pending jobs of a case can be cancelled when the user moves on,
+# the number of pending jobs is bounded: prefetching is best-effort and jobs are dropped while the queue is full.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+
+
+def decode_dicom(path):
+    """Reads a dicom with pixel data and decodes it
+
+    Returns:
+        (pydicom.Dataset, numpy.ndarray): dicom and its pixel array
+    """
+    dcm = pydicom.dcmread(path)
+    return dcm, dcm.pixel_array
+
+
+def decode_dicoms(paths, nr_workers=8):
+    """Decodes many dicoms in parallel threads, returns [(dicom, pixel array)] in the order of paths"""
+    if nr_workers<=1 or len(paths)<2: return [decode_dicom(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=min(nr_workers, len(paths))) as executor: return list(executor.map(decode_dicom, paths))
+
+
+class Decode_Pool:
+    """Decode_Pool runs decoding jobs in background threads with a bounded queue and cancellation by group
+
+    Args:
+        nr_workers (int): number of decoding threads
+        max_pending (int): maximum number of queued and running jobs
+
+    Attributes:
+        pending (dict): group -> set of futures not finished yet
+    """
+    def __init__(self, nr_workers=4, max_pending=64):
+        self.executor = ThreadPoolExecutor(max_workers=nr_workers, thread_name_prefix='lumos_decode')
+        self.slots    = threading.BoundedSemaphore(max_pending)
+        self.pending  = dict()
+        self.lock     = threading.Lock()
+
+    def submit(self, group, func, *args, block=False):
+        """Queues func(*args)
+
+        Args:
+            group (hashable): job group used for cancellation, e.g. studyuid
+            func (callable): job
+            block (bool): wait for a free slot instead of dropping the job if the queue is full
+
+        Returns:
+            concurrent.futures.Future: the job's future, None if the job was dropped
+        """
+        if not self.slots.acquire(blocking=block): return None
+        try: future = self.executor.submit(func, *args)
+        except: self.slots.release(); raise
+        with self.lock: self.pending.setdefault(group, set()).add(future)
+        future.add_done_callback(lambda f: self.done(group, f))
+        return future
+
+    def done(self, group, future):
+        self.slots.release()
+        with self.lock:
+            futures = self.pending.get(group)
+            if futures is None: return
+            futures.discard(future)
+            if len(futures)==0: self.pending.pop(group, None)
+
+    def cancel(self, group=None, keep=None):
+        """Cancels queued jobs (running jobs finish)
+
+        Args:
+            group (hashable): cancel jobs of this group, None for all groups
+            keep (hashable): group that is not cancelled (e.g. the case the user moved to)
+
+        Returns:
+            int: number of cancelled jobs
+        """
+        with self.lock:
+            groups  = list(self.pending.keys()) if group is None else [group]
+            futures = [f for g in groups if g!=keep for f in self.pending.get(g, ())]
+        return sum(f.cancel() for f in futures)
+
+    def nr_pending(self, group=None):
+        with self.lock:
+            if group is not None: return len(self.pending.get(group, ()))
+            return sum(len(f) for f in self.pending.values())
+
+
+# process-wide decode pool
+decode_pool      = None
+decode_pool_lock = threading.Lock()
+
+def get_decode_pool():
+    """Returns the process-wide Decode_Pool (created on first use)"""
+    global decode_pool
+    with decode_pool_lock:
+        if decode_pool is None: decode_pool = Decode_Pool()
+        return decode_pool
@@ -1,9 +1,147 @@
 import Lumos
 from Lumos.Views import *
 from Lumos.ImageOrganizer import *
+from Lumos.Annotation import annotation_cache, get_cache_key, get_content_hash
 
+import os
 import math
+import json
+import hashlib
 import numpy as np
+import shapely
+
+
+# bump when clinical result calculations change, memoized results of older versions are discarded
+CR_MEMO_VERSION = 1
+
+class Clinical_Result_Memo:
+    """Clinical_Result_Memo stores clinical results of an evaluation, valid as long as its annotations are unchanged
+
+    Args:
+        coll (Collection): clinical result memo collection (QUAD_Manager.memo_coll)
+        key (dict): task_id, studyuid, imagetype and stack_nr of the evaluation
+        anno_hash (str): content hash of the evaluation's annotations (Evaluation.get_annotation_hash)
+
+    Attributes:
+        values (dict): clinical result key -> value
+    """
+    def __init__(self, coll, key, anno_hash):
+        self.coll, self.key, self.anno_hash = coll, key, anno_hash
+        doc = coll.find_one(key, {'_id': 0, 'anno_hash': 1, 'values': 1})
+        self.is_stored = doc is not None and doc.get('anno_hash')==anno_hash # False: outdated or missing, replaced on first put
+        self.values    = dict(doc.get('values', {})) if self.is_stored else dict()
+
+    def get(self, name):
+        return self.values.get(name)
+
+    def put(self, name, value):
+        # only plain numbers and strings are persisted, raises on database errors (the value stays in memory)
+        if isinstance(value, np.generic): value = value.item()
+        if not isinstance(value, (int, float, str)) or isinstance(value, bool): return
+        self.values[name] = value
+        if self.is_stored: self.coll.update_one(dict(self.key, anno_hash=self.anno_hash), {'$set': {'values.'+name: value}})
+        else:
+            self.coll.replace_one(self.key, dict(self.key, anno_hash=self.anno_hash, values=dict(self.values)), upsert=True)
+            self.is_stored = True
+
+
+# attributes of an Evaluation that are not stored in its document
+eval_runtime_keys = ['_id', 'db', 'imgo', 'depthandtime2sop', 'anno_store', 'summary', 'cr_memo']
+
+def get_view(imagetype):
+    # view with the clinical results of an imagetype, None if the imagetype is not evaluated
+    if 'SAX CINE'     in imagetype: return SAX_CINE_View()
+    if 'LAX CINE 2CV' in imagetype: return LAX_CINE_2CV_View()
+    if 'LAX CINE 4CV' in imagetype: return LAX_CINE_4CV_View()
+    if 'SAX T1 PRE'   in imagetype: return SAX_T1_PRE_View()
+    if 'SAX T2'       in imagetype: return SAX_T2_View()
+    if 'SAX T1 POST'  in imagetype: return SAX_T1_POST_View()
+    if 'SAX LGE'      in imagetype: return SAX_LGE_View()
+
+def get_slice_key(slice_nr, phase_nr):
+    # key of a (slice, phase) position in Evaluation.slice_results (stored in the evaluation document)
+    return '%d_%d' % (slice_nr, phase_nr)
+
+
+class Evaluation_Summary:
+    """Evaluation_Summary holds what clinical results and tables need to know about the annotations of an evaluation
+
+    Args:
+        nr_slices (int): number of slices of the stack
+        nr_phases (int): number of phases of the stack
+        slice_results (dict of str: dict): per (slice, phase) results (see Evaluation.get_slice_results)
+
+    Attributes:
+        contour_names (dict of str: int): contour name -> index into has_contours, areas, bounds and pixel_stats
+        point_names (dict of str: int): point name -> index into has_points
+        has_contours (ndarray): has_contours[contour, slice, phase] True if annotated
+        areas (ndarray): areas[contour, slice, phase] in mm² (0 if not annotated)
+        bounds (ndarray): bounds[contour, slice, phase] = (xmin, ymin, xmax, ymax) in pixels (nan if not annotated)
+        has_points (ndarray): has_points[point, slice, phase] True if annotated
+        pixel_stats (ndarray): pixel_stats[contour, slice, phase] = (count, sum, sum of squares) of the pixel values inside
+            the contour, None if not computed
+    """
+    def __init__(self, nr_slices, nr_phases, slice_results):
+        self.contour_names, self.point_names = dict(), dict()
+        for r in slice_results.values():
+            for name in r['areas']:  self.contour_names.setdefault(name, len(self.contour_names))
+            for name in r['points']: self.point_names.setdefault(name, len(self.point_names))
+        shape = (nr_slices, nr_phases)
+        self.has_contours = np.zeros((len(self.contour_names),)+shape, dtype=bool)
+        self.areas        = np.zeros((len(self.contour_names),)+shape)
+        self.bounds       = np.full((len(self.contour_names),)+shape+(4,), np.nan)
+        self.has_points   = np.zeros((len(self.point_names),)+shape, dtype=bool)
+        has_stats         = len(slice_results)>0 and all('pixel_stats' in r for r in slice_results.values())
+        self.pixel_stats  = np.zeros((len(self.contour_names),)+shape+(3,)) if has_stats else None
+        for key, r in slice_results.items():
+            d, p = map(int, key.split('_'))
+            for name, area in r['areas'].items():
+                c = self.contour_names[name]
+                self.has_contours[c, d, p], self.areas[c, d, p], self.bounds[c, d, p] = True, area, r['bounds'][name]
+                if has_stats and name in r['pixel_stats']: self.pixel_stats[c, d, p] = r['pixel_stats'][name]
+            for name in r['points']: self.has_points[self.point_names[name], d, p] = True
+
+    def get_available_contours(self):
+        return [name for name, i in self.contour_names.items() if self.has_contours[i].any()]
+
+    def has_contour(self, cont_name, slice_nr=None, phase_nr=None):
+        # True if the contour is annotated in (slice, phase), or anywhere in the slice / phase / stack for None
+        if cont_name not in self.contour_names: return False
+        has = self.has_contours[self.contour_names[cont_name]]
+        if slice_nr is not None: has = has[slice_nr]
+        if phase_nr is not None: has = has[..., phase_nr]
+        return bool(np.any(has))
+
+    def has_point(self, point_name, slice_nr=None, phase_nr=None):
+        if point_name not in self.point_names: return False
+        has = self.has_points[self.point_names[point_name]]
+        if slice_nr is not None: has = has[slice_nr]
+        if phase_nr is not None: has = has[..., phase_nr]
+        return bool(np.any(has))
+
+    def get_areas(self, cont_name):
+        # areas[slice, phase] in mm² of a contour
+        if cont_name not in self.contour_names: return np.zeros(self.areas.shape[1:])
+        return self.areas[self.contour_names[cont_name]]
+
+    def get_bounding_box(self, height, width):
+        """Bounding box of all contours clipped to the image
+
+        Returns:
+            (float, float, float, float): xmin, xmax, ymin, ymax
+        """
+        bounds = self.bounds[self.has_contours]
+        if len(bounds)==0: raise ValueError('No contours for bounding box.')
+        xmin, ymin, _, _ = np.nanmin(bounds, axis=0); _, _, xmax, ymax = np.nanmax(bounds, axis=0)
+        return (max(xmin,0), min(xmax,width), max(ymin,0), min(ymax,height))
+
+    def get_pixel_mean(self, cont_name, phase_nr=0):
+        # mean of the pixel values inside a contour over all slices of a phase (nan if none or not computed)
+        if self.pixel_stats is None: raise ValueError('No pixel statistics.')
+        if cont_name not in self.contour_names: return np.nan
+        n, total, _ = self.pixel_stats[self.contour_names[cont_name], :, phase_nr].sum(axis=0)
+        return total / n if n>0 else np.nan
+
 
 ## Evaluation/Report
 class Evaluation:
@@ -26,32 +164,121 @@ class Evaluation:
             try:
                 self.imgo = ImageOrganizer(db, studyuid=studyuid, imagetype=imagetype, stack_nr=stack_nr)
             except Exception as e: pass#; print(traceback.format_exc())
-            try:
-                #print('Here: ', self.imgo.__dict__.keys())
-                self.name, self.age, self.sex = self.imgo.name, self.imgo.age, self.imgo.sex
-                self.weight, self.size = self.imgo.weight, self.imgo.size
-                self.nr_slices, self.nr_phases = self.imgo.nr_slices, self.imgo.nr_phases
-                self.depthandtime2sop = self.imgo.depthandtime2sop
-                self.task_id    = task_id
-                task = db.task_coll.find_one({'_id': task_id})
-                self.taskname = task['displayname']
-                self.studyuid  = studyuid
-                self.imagetype = imagetype
-                self.stack_nr   = stack_nr
-                self.missing_slices = self.imgo.missing_slices
-                self.spacing_between_slices = self.imgo.spacing_between_slices
-                self.slice_thickness = self.imgo.slice_thickness
-                self.pixel_h, self.pixel_w = self.imgo.pixel_h, self.imgo.pixel_w
+            try: self.set_imgo_fields(self.imgo, task_id, db.task_coll.find_one({'_id': task_id}), studyuid, imagetype, stack_nr)
             except Exception as e: pass; #print(traceback.format_exc())
+    
+    @classmethod
+    def from_json(cls, db, eval_json, imgo, task):
+        # evaluation from already fetched documents and a (shared) ImageOrganizer, without querying (see Lumos.Case.load_cases)
+        eva = cls.__new__(cls)
+        if eval_json is not None: eva.__dict__ = dict(eval_json)
+        eva.db, eva.imgo = db, imgo
+        try: eva.set_imgo_fields(imgo, task['_id'], task, imgo.studyuid, imgo.imagetype, imgo.stack_nr)
+        except Exception as e: pass
+        return eva
+    
+    def set_imgo_fields(self, imgo, task_id, task, studyuid, imagetype, stack_nr):
+        self.name, self.age, self.sex = imgo.name, imgo.age, imgo.sex
+        self.weight, self.size = imgo.weight, imgo.size
+        self.nr_slices, self.nr_phases = imgo.nr_slices, imgo.nr_phases
+        self.depthandtime2sop = imgo.depthandtime2sop
+        self.task_id    = task_id
+        self.taskname = task['displayname']
+        self.studyuid  = studyuid
+        self.imagetype = imagetype
+        self.stack_nr   = stack_nr
+        self.missing_slices = imgo.missing_slices
+        self.spacing_between_slices = imgo.spacing_between_slices
+        self.slice_thickness = imgo.slice_thickness
+        self.pixel_h, self.pixel_w = imgo.pixel_h, imgo.pixel_w
         
     def get_dcm(self, slice_nr, phase_nr):
         return self.imgo.get_dcm(slice_nr, phase_nr)
         
+    def get_geometry(self, slice_nr, phase_nr=0):
+        # spacing, thickness, position, orientation and size of an image (Slice_Geometry) without reading the dicom
+        return self.imgo.get_geometry(slice_nr, phase_nr)
+        
     def get_img(self, slice_nr, phase_nr):
         return self.imgo.get_img(slice_nr, phase_nr)
     
+    def prefetch(self, positions=None):
+        # background decoding of images, positions: [(slice_nr, phase_nr)], None for the whole stack
+        return self.imgo.prefetch(positions)
+    
+    def get_img_stack(self, phase_nr=None, out=None):
+        # contiguous float32 (slices, H, W) stack of a phase, (slices, phases, H, W) for all phases
+        return self.imgo.get_img_stack(phase_nr, out=out)
+    
+    def get_anno_store(self):
+        # annotations are fetched for the whole stack at once and kept in memory
+        if getattr(self, 'anno_store', None) is None:
+            self.anno_store = Annotation_Store(self.db, self.task_id, self.studyuid, self.depthandtime2sop)
+        return self.anno_store
+    
     def get_anno(self, slice_nr, phase_nr):
-        return Annotation(db=self.db, task_id=self.task_id, sop=self.depthandtime2sop[(slice_nr, phase_nr)])
+        return self.get_anno_store().get_anno(slice_nr, phase_nr)
+    
+    def invalidate_annotations(self, slice_nr=None, phase_nr=None):
+        # call after annotations were edited in the database, refetched on next access
+        self.get_anno_store().invalidate(slice_nr, phase_nr)
+        self.summary, self.cr_memo = None, None
+    
+    def reload_annotations(self):
+        self.get_anno_store().reload()
+        self.summary, self.cr_memo = None, None
+    
+    def get_annotation_hashes(self, sops=None):
+        """Returns the content hashes of the annotations of the stack (one query)
+
+        Note:
+            Annotations stored before content hashes were introduced are fetched and hashed on the fly.
+
+        Args:
+            sops (list of str): sops of interest, None for all sops of the stack
+
+        Returns:
+            dict of str: str: sop -> content hash (sops without annotation are missing)
+        """
+        sops, hashes, unhashed = list(self.depthandtime2sop.values()) if sops is None else list(sops), dict(), []
+        for j in self.db.anno_coll.find({'task_id': self.task_id, 'sop': {'$in': sops}}, {'_id': 0, 'sop': 1, 'content_hash': 1}):
+            if 'content_hash' in j: hashes[j['sop']] = j['content_hash']
+            else:                   unhashed.append(j['sop'])
+        if len(unhashed)>0:
+            for j in self.db.anno_coll.find({'task_id': self.task_id, 'sop': {'$in': unhashed}}): hashes[j['sop']] = get_content_hash(j)
+        return hashes
+    
+    def get_stack_signature(self):
+        # (slice, phase, sop, file mtime) of the stack: clinical results also depend on pixel data and geometry
+        paths = {j['sop']: j.get('path') for j in self.db.dcm_coll.find({'sop': {'$in': list(self.depthandtime2sop.values())}}, {'_id': 0, 'sop': 1, 'path': 1})}
+        def mtime(path):
+            try:    return os.stat(path).st_mtime
+            except: return None
+        return sorted([d, p, sop, mtime(paths.get(sop))] for (d, p), sop in self.depthandtime2sop.items())
+    
+    def get_annotation_hash(self):
+        # hash over the content hashes of all annotations and the signature of the image stack
+        content = [CR_MEMO_VERSION] + sorted(self.get_annotation_hashes().items()) + self.get_stack_signature()
+        return hashlib.sha1(json.dumps(content).encode()).hexdigest()
+    
+    def get_cr_memo(self):
+        # memoized clinical results of this evaluation (see ClinicalResults.CR_exception_handler)
+        if getattr(self, 'cr_memo', None) is None:
+            key = {'task_id': self.task_id, 'studyuid': self.studyuid, 'imagetype': self.imagetype, 'stack_nr': self.stack_nr}
+            self.cr_memo = Clinical_Result_Memo(self.db.memo_coll, key, self.get_annotation_hash())
+        return self.cr_memo
+    
+    def warm(self, slice_nr, phase_nr):
+        # loads image and annotation of (slice, phase) into the shared caches (run by background prefetching)
+        if (slice_nr, phase_nr) not in self.depthandtime2sop: return
+        self.get_img(slice_nr, phase_nr)
+        self.get_anno(slice_nr, phase_nr)
+    
+    def is_cached(self, slice_nr, phase_nr):
+        # True if image and annotation of (slice, phase) are in the shared caches
+        sop = self.depthandtime2sop.get((slice_nr, phase_nr))
+        if sop is None: return True
+        return (sop,)+self.imgo.get_normalize_flags() in image_cache and get_cache_key(self.db, self.task_id, sop) in annotation_cache
     
     def get_img_anno(self, slice_nr, phase_nr):
         return self.get_img(slice_nr, phase_nr), self.get_anno(slice_nr, phase_nr)
@@ -61,72 +288,203 @@ class Evaluation:
         thresh = anno.get_threshold('thresh') 
         return "{:.2f}".format(thresh) if string else thresh
     
+    def is_mapping(self):
+        return 'T1' in self.imagetype or 'T2' in self.imagetype
+    
+    def get_view(self):
+        return get_view(self.imagetype)
+    
+    def to_json(self):
+        # evaluation document as stored in eval_coll (without database handles, image organizer and in-memory caches)
+        return {k: v for k, v in self.__dict__.items() if k not in eval_runtime_keys}
+    
     def evaluate(self):
-        self.available_contours = self.get_available_contours() # get all contour types added for this reader
-                
-        self.bounding_box = self.get_bounding_box() # get boundingbox and  areas by slice and phase
-            
-        if 'SAX CINE'     in self.imagetype: v = SAX_CINE_View()
-        if 'LAX CINE 2CV' in self.imagetype: v = LAX_CINE_2CV_View()
-        if 'LAX CINE 4CV' in self.imagetype: v = LAX_CINE_4CV_View()
-        if 'SAX T1 PRE'   in self.imagetype: v = SAX_T1_PRE_View()
-        if 'SAX T2'       in self.imagetype: v = SAX_T2_View()
-        if 'SAX T1 POST'  in self.imagetype: v = SAX_T1_POST_View()
-        if 'SAX LGE'      in self.imagetype: v = SAX_LGE_View()
-        
-        # get clinical results
+        # one scan over the annotations for per slice results (areas, bounds, points and pixel statistics if mapping)
+        self.slice_results = self.get_slice_results(pixel_stats=self.is_mapping())
+        self.summary       = Evaluation_Summary(self.nr_slices, self.nr_phases, self.slice_results)
+        self.available_contours = self.summary.get_available_contours() # get all contour types added for this reader
+        self.bounding_box = self.summary.get_bounding_box(self.imgo.height, self.imgo.width)
+        self.calculate_clinical_parameters()
+        if self.is_mapping(): self.calculate_aha_model()
+    
+    def calculate_clinical_parameters(self):
         self.clinical_parameters = dict()
-        for cr_name, cr in v.clinical_parameters.items(): 
+        for cr_name, cr in self.get_view().clinical_parameters.items(): 
             val = float(cr.get_val(self))
             if not math.isnan(val): self.clinical_parameters[cr_name] = [val, cr.unit]
+    
+    def calculate_aha_model(self):
+        try:
+            aha_names, aha_means, aha_stds = self.calculate_aha_segments()
+            self.aha_model = {aha_names[i][j]:(aha_means[i][j], aha_stds[i][j]) for i in range(3) for j in range(len(aha_names[i]))}
+        except Exception as e: print(traceback.format_exc())
+    
+    def reevaluate(self, save=True):
+        """Recomputes the results of the slices whose annotations changed since the last evaluation
         
-        # aha model if mapping
-        if 'T1' in self.imagetype or 'T2' in self.imagetype:
-            try:
-                aha_names, aha_means, aha_stds = self.calculate_aha_segments()
-                self.aha_model = {aha_names[i][j]:(aha_means[i][j], aha_stds[i][j]) for i in range(3) for j in range(len(aha_names[i]))}
-            except Exception as e: print(traceback.format_exc())
+        Note:
+            Changed slices are found by comparing the annotations' content hashes to the ones in slice_results. Only their
+            annotations are refetched and their results recomputed, the summary is assembled with the stored results of
+            the other slices. Clinical results (and the aha model) are recalculated only if a contour or point changed.
+            Evaluations without slice_results (stored before they were introduced) are evaluated completely.
+        
+        Args:
+            save (bool): if True writes the changed fields to the evaluation document
+            
+        Returns:
+            dict: 'slices' (list of (int, int)) recomputed slices and phases, 'geometries' (list of str) contours and
+                points whose results changed, 'clinical_parameters' (dict of str: (float, float)) changed clinical results
+        """
+        stored  = dict(getattr(self, 'slice_results', None) or dict())
+        touched, removed = self.get_outdated_slices(stored)
+        report  = {'slices': touched, 'geometries': [], 'clinical_parameters': dict()}
+        if len(touched)==0 and len(removed)==0: return report
+        
+        self.get_anno_store().refresh(touched)
+        new, geometries = self.get_slice_results(touched, pixel_stats=self.is_mapping()), set()
+        for key in list(new.keys()) + removed:
+            r1, r2 = stored.get(key, dict()), new.get(key, dict())
+            for field in ['areas', 'bounds', 'pixel_stats']:
+                a, b = r1.get(field, dict()), r2.get(field, dict())
+                geometries.update(n for n in set(a)|set(b) if json.dumps(a.get(n))!=json.dumps(b.get(n)))
+            geometries.update(set(r1.get('points', [])).symmetric_difference(r2.get('points', [])))
+        stored.update(new)
+        for k in removed: stored.pop(k)
+        self.slice_results = stored
+        self.summary, self.cr_memo = Evaluation_Summary(self.nr_slices, self.nr_phases, stored), None
+        report['geometries'] = sorted(geometries)
+        
+        if len(geometries)>0 or getattr(self, 'clinical_parameters', None) is None:
+            old_crs = dict(getattr(self, 'clinical_parameters', None) or dict())
+            self.available_contours = self.summary.get_available_contours()
+            try:    self.bounding_box = self.summary.get_bounding_box(self.imgo.height, self.imgo.width)
+            except: self.bounding_box = None
+            self.calculate_clinical_parameters()
+            if self.is_mapping(): self.calculate_aha_model()
+            for name in set(old_crs) | set(self.clinical_parameters):
+                v1, v2 = old_crs.get(name, [np.nan])[0], self.clinical_parameters.get(name, [np.nan])[0]
+                if v1!=v2: report['clinical_parameters'][name] = (v1, v2)
+        
+        if save:
+            fields = {'slice_results.'+k: v for k, v in new.items()}
+            fields.update({k: getattr(self, k) for k in ['available_contours', 'bounding_box', 'clinical_parameters', 'aha_model'] if hasattr(self, k)})
+            update = {'$set': fields}
+            if len(removed)>0: update['$unset'] = {'slice_results.'+k: '' for k in removed}
+            key = {'task_id': self.task_id, 'studyuid': self.studyuid, 'imagetype': self.imagetype, 'stack_nr': self.stack_nr}
+            if self.db.eval_coll.update_one(key, update).matched_count==0: raise ValueError('No evaluation document for ' + str(key))
+        return report
+    
+    def get_outdated_slices(self, slice_results):
+        """Compares stored slice results to the current annotations of the stack
+        
+        Returns:
+            (list of (int, int), list of str): (slice, phase) positions without results or whose sop or annotation content
+                hash changed, keys of results whose position is no longer part of the stack
+        """
+        hashes  = self.get_annotation_hashes()
+        keys    = {get_slice_key(d, p) for (d, p) in self.depthandtime2sop}
+        touched = [(d, p) for (d, p), sop in sorted(self.depthandtime2sop.items()) if get_slice_key(d, p) not in slice_results
+                   or slice_results[get_slice_key(d, p)]['sop']!=sop or slice_results[get_slice_key(d, p)]['content_hash']!=hashes.get(sop)]
+        removed = [k for k in slice_results if k not in keys]
+        return touched, removed
+    
+    def get_slice_results(self, positions=None, pixel_stats=False):
+        """Returns areas, bounds and points (and pixel statistics) of the annotations by slice and phase
+        
+        Args:
+            positions (list of (int, int)): (slice, phase) positions, None for all positions of the stack
+            pixel_stats (bool): if True adds (count, sum, sum of squares) of the pixel values inside each contour
+            
+        Returns:
+            dict of str: dict: get_slice_key(slice, phase) -> {'sop', 'content_hash', 'areas' (mm²), 'bounds' (pixels),
+                'points', 'pixel_stats'}, stored in the evaluation document as slice_results
+        """
+        if positions is None: positions = sorted(self.depthandtime2sop.keys())
+        hashes = self.get_annotation_hashes([self.depthandtime2sop[pos] for pos in positions])
+        imgs   = self.get_img_stack() if pixel_stats and len(positions)>0 else None
+        results, geos = dict(), []
+        for (d, p) in positions:
+            sop = self.depthandtime2sop[(d, p)]
+            r   = results[get_slice_key(d, p)] = {'sop': sop, 'content_hash': hashes.get(sop), 'areas': dict(), 'bounds': dict(), 'points': []}
+            if pixel_stats: r['pixel_stats'] = dict()
+            try:    anno = self.get_anno(d, p)
+            except: continue
+            for name in anno.anno.keys():
+                if anno.has_point(name): r['points'].append(name)
+                if not anno.has_contour(name): continue
+                geos.append((r, name, anno.get_contour(name)))
+                if not pixel_stats: continue
+                try:
+                    vals = anno.get_pixel_values(name, imgs[d, p]).astype(np.float64)
+                    vals = vals[~np.isnan(vals)]
+                    r['pixel_stats'][name] = [int(len(vals)), float(vals.sum()), float((vals**2).sum())]
+                except Exception as e: print(traceback.format_exc())
+        geo_array = np.empty(len(geos), dtype=object)
+        geo_array[:] = [geo for _, _, geo in geos]
+        areas  = np.nan_to_num(shapely.area(geo_array)) * (self.pixel_h * self.pixel_w)
+        bounds = shapely.bounds(geo_array)
+        for (r, name, _), area, b in zip(geos, areas, bounds): r['areas'][name], r['bounds'][name] = float(area), [float(x) for x in b]
+        return results
+    
+    def get_summary(self):
+        """Returns the Evaluation_Summary of the stack (contours, areas, bounds and points of all annotations)
+
+        Note:
+            Assembled from the stored slice_results if they match the annotations' content hashes, otherwise computed in
+            one scan over the annotations (fetched with one query by the Annotation_Store). Reset by invalidate_annotations
+            and reload_annotations.
+        """
+        if getattr(self, 'summary', None) is None:
+            stored = getattr(self, 'slice_results', None) or dict()
+            touched, removed = self.get_outdated_slices(stored)
+            if len(stored)>0 and len(touched)==0 and len(removed)==0: slice_results = stored
+            else:
+                self.get_anno_store().refresh(touched) # cached annotations may predate edits by other processes
+                slice_results = self.get_slice_results()
+            self.summary = Evaluation_Summary(self.nr_slices, self.nr_phases, slice_results)
+        return self.summary
+    
+    def get_area_matrix(self):
+        """Returns the areas of all contours in all slices and phases
+
+        Returns:
+            (dict of str: int, ndarray): contour name -> index, areas[contour, slice, phase] in mm² (0 if not annotated)
+        """
+        summary = self.get_summary()
+        return summary.contour_names, summary.areas
+    
+    def get_areas(self, cont_name):
+        # areas[slice, phase] in mm² of a contour
+        return self.get_summary().get_areas(cont_name)
+    
+    def get_volume_curve(self, cont_name):
+        """Returns the volume of a contour in all phases in ml
+        
+        Note:
+            Slices are weighted by the spacing between slices, base and apex (first and last slice with contour) by the
+            mean of slice thickness and spacing, missing slices are interpolated from their neighbours.
+        """
+        areas     = self.get_areas(cont_name)
+        has_conts = areas!=0
+        phases    = np.arange(self.nr_phases)
+        base_idx  = np.argmax(has_conts, axis=0)
+        apex_idx  = self.nr_slices - np.argmax(has_conts[::-1], axis=0) - 1
+        depths    = np.full(areas.shape, float(self.spacing_between_slices))
+        depths[base_idx, phases] = depths[apex_idx, phases] = (self.slice_thickness+self.spacing_between_slices)/2.0
+        vols      = np.sum(areas * depths, axis=0)
+        for d in self.missing_slices: vols += (areas[d] + areas[d+1])/2 * self.spacing_between_slices
+        vols[~has_conts.any(axis=0)] = 0
+        return vols / 1000.0
     
     def get_volume(self, phase, cont_name):
         if np.isnan(phase): raise Exception('Volume calculation not possible: phase=np.nan.') 
-        annos = [self.get_anno(d, phase) for d in range(self.nr_slices)]
-        pixel_area = self.pixel_h * self.pixel_w
-        areas = [a.get_contour(cont_name).area*pixel_area if a is not None else 0.0 for a in annos]
-        has_conts = [a!=0 for a in areas]
-        if True not in has_conts: return 0
-        base_idx = has_conts.index(True)
-        apex_idx = self.nr_slices - has_conts[::-1].index(True) - 1
-        vol = 0
-        for d in range(self.nr_slices):
-            pixel_depth = (self.slice_thickness+self.spacing_between_slices)/2.0 if d in [base_idx, apex_idx] else self.spacing_between_slices
-            vol += areas[d] * pixel_depth
-        # for missing slices
-        for d in self.missing_slices:
-            pixel_depth = self.spacing_between_slices
-            vol += (areas[d] + areas[d+1])/2 * pixel_depth
-        return vol / 1000.0
+        return self.get_volume_curve(cont_name)[int(phase)]
     
     def get_available_contours(self):
-        available_contours = set()
-        for d in range(self.nr_slices):
-            for p in range(self.nr_phases):
-                try:    anno = self.get_anno(d,p)
-                except: continue
-                for cname in anno.available_contour_names(): available_contours.add(cname)
-        return list(available_contours)
+        return self.get_summary().get_available_contours()
     
     def get_bounding_box(self):
-        bounds = []
-        for d in range(self.nr_slices):
-            for p in range(self.nr_phases):
-                anno = self.get_anno(d,p)
-                for cname in anno.available_contour_names(): 
-                    bounds.append(anno.get_contour(cname).bounds)
-        bounds = np.asarray(bounds)
-        xmin, ymin, _, _ = np.min(bounds, axis=0); _, _, xmax, ymax = np.max(bounds, axis=0)
-        h, w = self.imgo.height, self.imgo.width
-        bounding_box = (max(xmin,0), min(xmax,w), max(ymin,0), min(ymax,h))
-        return bounding_box
+        return self.get_summary().get_bounding_box(self.imgo.height, self.imgo.width)
     
     def calculate_aha_segments(self):
         # returns means and stds
@@ -142,8 +500,9 @@ class Evaluation:
                     [np.full(6,np.nan), np.roll(m_s,1), np.full(4,np.nan)])
         
         if self.nr_slices == 3: # assume 3 of 5 so: 0:base, 1:midv, 2:apex
+            imgs = self.get_img_stack(0)
             try:
-                img,  anno = self.get_img_anno(0,0)
+                img,  anno = imgs[0], self.get_anno(0,0)
                 b   = anno.get_myo_mask_by_angles(img, nr_bins=6)
                 b_m = np.asarray([np.mean(v) for v in b.values()])
                 b_s = np.asarray([np.std(v) for v in b.values()])
@@ -151,7 +510,7 @@ class Evaluation:
                 b_m = np.empty((6,)); b_m.fill(np.nan)
                 b_s = np.empty((6,)); b_s.fill(np.nan)
             try:
-                img,  anno = self.get_img_anno(1,0)
+                img,  anno = imgs[1], self.get_anno(1,0)
                 m   = anno.get_myo_mask_by_angles(img, nr_bins=6)
                 m_m = np.asarray([np.mean(v) for v in m.values()])
                 m_s = np.asarray([np.std(v) for v in m.values()])
@@ -159,7 +518,7 @@ class Evaluation:
                 m_m = np.empty((6,)); m_m.fill(np.nan)
                 m_s = np.empty((6,)); m_s.fill(np.nan)
             try:
-                img,  anno = self.get_img_anno(2,0)
+                img,  anno = imgs[2], self.get_anno(2,0)
                 a   = anno.get_myo_mask_by_angles(img, nr_bins=4)
                 a_m = np.asarray([np.mean(v) for v in a.values()])
                 a_s = np.asarray([np.std(v) for v in a.values()])
@@ -175,6 +534,30 @@ class Evaluation:
         
         
     def get_patient_info(self):
-        dcm = utils.unpack_dcm(self.db.dcm_coll.find_one({'studyuid' : self.studyuid}))
-        info = map(str, [dcm.PatientName, dcm.PatientAge, dcm.PatientSex, dcm.PatientWeight, dcm.PatientSize])
-        return info
\ No newline at end of file
+        return self.imgo.get_patient_info()
+
+
+def reevaluate_task(quad, task_id, studyuids=None, verbose=True):
+    """Incrementally re-evaluates the stored evaluations of a task after annotations were edited or re-imported
+
+    Args:
+        quad (Lumos.Quad.QUAD_Manager): database manager
+        task_id (str): task whose evaluations are updated
+        studyuids (list of str): restricts the update to these studies, None for all
+        verbose (bool): prints the changes of every evaluation
+
+    Returns:
+        dict of (str, str, int): dict: (studyuid, imagetype, stack_nr) -> report (see Evaluation.reevaluate) of every
+            evaluation with recomputed slices
+    """
+    query = {'task_id': task_id}
+    if studyuids is not None: query['studyuid'] = {'$in': list(studyuids)}
+    reports = dict()
+    for j in quad.eval_coll.find(query, {'_id': 0, 'studyuid': 1, 'imagetype': 1, 'stack_nr': 1}):
+        key = (j['studyuid'], j['imagetype'], j['stack_nr'])
+        try:    report = Evaluation(quad, task_id, *key).reevaluate()
+        except Exception as e: print(traceback.format_exc()); continue
+        if len(report['slices'])==0: continue
+        reports[key] = report
+        if verbose: print(key, len(report['slices']), 'slices recomputed, changed:', report['geometries'], report['clinical_parameters'])
+    return reports
@@ -29,6 +29,7 @@ from Lumos.utils import findMainWindow, findCCsOverviewTab, PolygonPatch
 
 class Annotation_Comparison(Visualization):
     def set_values(self, view, canvas, eval1, eval2):
+        self.cancel_prefetch()
         self.view   = view
         self.canvas = canvas
         self.add_annotation  = True
@@ -63,6 +64,7 @@ class Annotation_Comparison(Visualization):
         self.ax4  = self.add_subplot(spec[0,3], sharex=self.ax1, sharey=self.ax1)
         img1, anno1  = self.eval1.get_img_anno(slice_nr, p1)
         img2, anno2  = self.eval2.get_img_anno(slice_nr, p2)
+        self.prefetch([self.eval1, self.eval2], slice_nr, [p1, p2])
         h, w  = img1.shape
         extent=(0, w, h, 0)
         vmin, vmax = (min(np.min(img1), np.min(img2)), max(np.max(img1), np.max(img2))) if self.cmap=='gray' else self.view.cmap_vlims
@@ -25,6 +25,7 @@ from Lumos.utils import findMainWindow, findCCsOverviewTab
 
 class Basic_Presenter(Visualization):
     def set_values(self, view, canvas, eval1, eval2):
+        self.cancel_prefetch()
         self.eval1, self.eval2 = eval1, eval2
         self.view   = view
         self.canvas = canvas
@@ -56,6 +57,7 @@ class Basic_Presenter(Visualization):
         self.ax2 = self.add_subplot(spec[0,1], sharex=self.ax1, sharey=self.ax1)
         img1, anno1 = self.eval1.get_img_anno(slice_nr, p1)
         img2, anno2 = self.eval2.get_img_anno(slice_nr, p2)
+        self.prefetch([self.eval1, self.eval2], slice_nr, [p1, p2])
         h, w     = img1.shape
         extent   = (0, w, h, 0)
         vmin, vmax = (min(np.min(img1), np.min(img2)), max(np.max(img1), np.max(img2))) if self.cmap=='gray' else self.view.cmap_vlims
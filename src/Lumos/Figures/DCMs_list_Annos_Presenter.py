@@ -19,12 +19,16 @@ from Lumos.Metrics import *
 from Lumos import utils
 from Lumos.Figures.Visualization import *
 from Lumos.Annotation import *
+from Lumos.PixelCache import get_preview_or_image
 
 
 class DCMs_list_Annos_Presenter(Visualization):
-    def set_values(self, canvas, dcms, annos=None):
+    def set_values(self, canvas, dcms, annos=None, quad=None, level=2):
+        # dcms: pydicom datasets, or sops (with quad) drawn from the preview pyramid at 1/level scale
         self.canvas = canvas
         self.dcms = dcms
+        self.quad  = quad
+        self.level = level
         self.annos = annos
         self.nr = 0
         self.add_annotation = True
@@ -42,10 +46,14 @@ class DCMs_list_Annos_Presenter(Visualization):
         self.clf()
         ax  = self.add_subplot(111)
         dcm = self.dcms[nr]
-        sop = dcm.SOPInstanceUID
-        img = dcm.pixel_array
-        try:    h, w    = img.shape
-        except: h, w, _ = img.shape
+        if isinstance(dcm, str):
+            sop = dcm
+            img, (h, w) = get_preview_or_image(self.quad, sop, self.level)
+        else:
+            sop = dcm.SOPInstanceUID
+            img = dcm.pixel_array
+            try:    h, w    = img.shape
+            except: h, w, _ = img.shape
         extent = (0, w, h, 0)
         ax.imshow(img, 'gray', extent=extent)
         if self.annos is not None and sop in self.annos.keys() and self.add_annotation:
@@ -87,7 +87,7 @@ class Failed_Annotation_Comparison_Yielder(Visualization):
                         cats2 = self.view.get_categories(c2, contname)
                         for cat1, cat2 in zip(cats1, cats2):
                             p1, p2 = cat1.phase, cat2.phase
-                            dcm    = cat1.get_dcm(sl_nr, p1)
+                            dcm    = cat1.get_geometry(sl_nr, p1)
                             cont1  = cat1.get_anno(sl_nr, p1).get_contour(contname)
                             cont2  = cat2.get_anno(sl_nr, p2).get_contour(contname)
                             dice   = dsc.get_val(cont1, cont2, dcm)
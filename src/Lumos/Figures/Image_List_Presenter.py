@@ -18,12 +18,16 @@ from Lumos.Tables import *
 from Lumos.Metrics import *
 from Lumos import utils
 from Lumos.Figures.Visualization import *
+from Lumos.PixelCache import get_preview_or_image
 
 
 class Image_List_Presenter(Visualization):
-    def set_values(self, images, canvas):
+    def set_values(self, images, canvas, quad=None, level=4):
+        # images: arrays, or sops (with quad) drawn from the preview pyramid at 1/level scale
         self.imgs = images
         self.canvas = canvas
+        self.quad   = quad
+        self.level  = level
         self.add_annotation = True
         self.nr = 0
     
@@ -41,7 +45,8 @@ class Image_List_Presenter(Visualization):
         self.clf()
         ax = self.add_subplot(111)
         img = self.imgs[nr]
-        h, w   = img.shape
+        if isinstance(img, str): img, (h, w) = get_preview_or_image(self.quad, img, self.level)
+        else:                    h, w = img.shape[:2]
         extent = (0, w, h, 0)
         ax.imshow(img, 'gray', extent=extent)
         #self.suptitle('Image: ' + str(nr))
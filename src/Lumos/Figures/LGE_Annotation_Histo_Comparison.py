@@ -28,6 +28,7 @@ class LGE_Annotation_Histo_Comparison(Visualization):
     def set_gui(self, gui):       self.gui    = gui
 
     def set_values(self, view, canvas, eval1, eval2):
+        self.cancel_prefetch()
         self.view              = view
         self.canvas            = canvas
         #self.p                 = 0
@@ -61,9 +62,10 @@ class LGE_Annotation_Histo_Comparison(Visualization):
         
         colors1      = ['#785ef0', 'grey']      #red to light orange 94CBEC
         colors2      = ['#ffb000', 'grey']  #blue 000000
-        dcm          = self.eval1.get_dcm(slice_nr, 0)
+        dcm          = self.eval1.get_geometry(slice_nr, 0)
         img1, anno1  = self.eval1.get_img_anno(slice_nr, 0)
         img2, anno2  = self.eval2.get_img_anno(slice_nr, 0)
+        self.prefetch([self.eval1, self.eval2], slice_nr, [0, 0])
         geo_myo1     = anno1.get_contour(self.view.contour_names[0])
         #geo_myo1     = anno1.get_contour('lv_myo')
         mask_myo1   = utils.to_mask_pct(geo_myo1, dcm.Columns, dcm.Rows)
@@ -360,6 +362,7 @@ class LGE_Annotation_Histo_Comparison(Visualization):
 
 class Annotation_Comparison(Visualization):
     def set_values(self, view, canvas, eval1, eval2):
+        self.cancel_prefetch()
         self.view   = view
         self.canvas = canvas
         self.add_annotation  = True
@@ -394,6 +397,7 @@ class Annotation_Comparison(Visualization):
         self.ax4  = self.add_subplot(spec[0,3], sharex=self.ax1, sharey=self.ax1)
         img1, anno1  = self.eval1.get_img_anno(slice_nr, p1)
         img2, anno2  = self.eval2.get_img_anno(slice_nr, p2)
+        self.prefetch([self.eval1, self.eval2], slice_nr, [p1, p2])
         h, w  = img1.shape
         extent=(0, w, h, 0)
         vmin, vmax = (min(np.min(img1), np.min(img2)), max(np.max(img1), np.max(img2))) if self.cmap=='gray' else self.view.cmap_vlims
@@ -65,7 +65,7 @@ class LGE_Multi_Reader_Comparison(Visualization):
         
         # Histograms
         colors = ['green', 'grey']
-        dcm    = self.eval_dict[0].get_dcm(slice_nr, 0)
+        dcm    = self.eval_dict[0].get_geometry(slice_nr, 0)
         img , anno = dict(), dict()
         weights_dict, values_dict = dict(), dict()
         thresh_dict = dict()
@@ -47,7 +47,7 @@ class LGE_Overview_BySlice(Visualization):
             cat1, cat2 = cc.case1.categories[0], cc.case2.categories[0]
             for d in range(cat1.nr_slices):
                 row = [cc.case1.case_name, cc.case1.studyinstanceuid, d]
-                dcm1,  dcm2   = cat1.get_dcm(d,0),  cat2.get_dcm(d,0)
+                dcm1          = cat1.get_geometry(d,0)
                 anno1, anno2  = cat1.get_anno(d,0), cat2.get_anno(d,0)
                 scar_area     = (anno1.get_contour('scar').area     - anno2.get_contour('scar').area) / 100.0
                 noreflow_area = (anno1.get_contour('noreflow').area - anno2.get_contour('noreflow').area) / 100.0
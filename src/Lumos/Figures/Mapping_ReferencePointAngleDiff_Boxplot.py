@@ -50,7 +50,6 @@ class Mapping_ReferencePointAngleDiff_Boxplot(Visualization):
         for eva1,eva2 in zip(evals1,evals2):
             for d in range(eva1.nr_slices):
                 anno1, anno2 = eva1.get_anno(d,0), eva2.get_anno(d,0)
-                dcm = eva1.get_dcm(d,0)
                 try:
                     ad = (anno1.get_reference_angle() - anno2.get_reference_angle())
                     rows.append([eva1.name, eva1.studyuid, d, ad])
@@ -48,7 +48,7 @@ class Mapping_ReferencePointDistance_Boxplot(Visualization):
         for eva1,eva2 in zip(evals1, evals2):
             for d in range(eva1.nr_slices):
                 ref1, ref2 = eva1.get_anno(d,0).get_point('sax_ref'), eva2.get_anno(d,0).get_point('sax_ref')
-                dcm = eva1.get_dcm(d,0)
+                dcm = eva1.get_geometry(d,0)
                 try:    rows.append([eva1.name, eva1.studyuid, d, mmDist.get_val(ref1, ref2, dcm)])
                 except: print(traceback.print_exc()); pass
         df = DataFrame(rows, columns=['Casename', 'Studyuid', 'Slice', 'Value'])
@@ -31,6 +31,7 @@ class Multi_Annos_in_One(Visualization):
         """
         eval_dict : Dictionary aller evaluations eval1, eval2, ... 
         """
+        self.cancel_prefetch()
         self.view            = view
         self.canvas          = canvas
         self.p               = dict()
@@ -69,13 +70,14 @@ class Multi_Annos_in_One(Visualization):
         #for i in eval_dict.keys():
         #    dcm        = self.eval_dict[i].get_dcm(slice_nr, p[i])
         #    img        = self.eval_dict[i].get_img(slice_nr, p[i])
-        dcm        = self.eval_dict[0].get_dcm(slice_nr, p[0])
         img        = self.eval_dict[0].get_img(slice_nr, p[0])
         
         anno = dict()
 
         for i in checked_boxes_index: #i = task number
             anno[i] = self.eval_dict[i].get_anno(slice_nr, p[i])
+        readers = [0] + [i for i in checked_boxes_index if i!=0]
+        self.prefetch([self.eval_dict[i] for i in readers], slice_nr, [p[i] for i in readers])
         #print(anno)
         if debug: print('Start'); st = time()
         self.clear()
@@ -46,7 +46,7 @@ class Reference_Point_Differences(Visualization):
         for i, (eva1,eva2) in enumerate(zip(evals1,evals2)):
             for d in range(eva1.nr_slices):
                 anno1, anno2 = eva1.get_anno(d,0), eva2.get_anno(d,0)
-                dcm = eva1.get_dcm(d,0)
+                dcm = eva1.get_geometry(d,0)
                 try:
                     a1, a2 = anno1.get_reference_angle(), anno2.get_reference_angle()
                     ad = (a1 - a2)
@@ -1,6 +1,8 @@
 import os
 from matplotlib.figure import Figure
 
+from Lumos.DecodePool import get_decode_pool
+
 class Visualization(Figure):
     """Table is a class for Lumos' visualizations
 
@@ -19,6 +21,34 @@ class Visualization(Figure):
     def keyPressEvent(self, event):
         """Overwrite this method for keyPressEvents"""
         pass
+    
+    def prefetch(self, evals, slice_nr, phases, radius=1):
+        """Warms the image and annotation caches around the presented images in the background
+        
+        Note:
+            Pending prefetches of this figure are cancelled first (the user moved on). Nearest neighbours are queued first,
+            slices and phases wrap around as in keyPressEvent.
+        
+        Args:
+            evals (list of Evaluation): presented evaluations (readers)
+            slice_nr (int): presented slice
+            phases (list of int): presented phase per evaluation
+            radius (int): number of adjacent slices and phases to prefetch
+        """
+        pool = get_decode_pool()
+        pool.cancel(id(self))
+        offsets = sorted([(i, j) for i in range(-radius, radius+1) for j in range(-radius, radius+1) if (i, j)!=(0, 0)], 
+                         key=lambda o: (abs(o[0])+abs(o[1]), abs(o[0])))
+        for i, j in offsets:
+            for eva, phase in zip(evals, phases):
+                try:
+                    d, p = (slice_nr+i) % eva.nr_slices, (phase+j) % eva.nr_phases
+                    if not eva.is_cached(d, p): pool.submit(id(self), eva.warm, d, p)
+                except Exception as e: continue
+    
+    def cancel_prefetch(self):
+        """Cancels pending prefetches of this figure (e.g. when another case is presented)"""
+        get_decode_pool().cancel(id(self))
 
     # overwrite figure name
     def store(self, storepath, figurename='visualization.png'):
@@ -128,13 +128,9 @@ class Database_TabWidget(QWidget):
         
         cases = list(self.quad.case_coll.find({'$and': [{'studyuid': {'$in': cohort['studyuids']}},
                                                         {'studyuid': {'$in': task1['studyuids']}},
-                                                        {'studyuid': {'$in': task2['studyuids']}}]}))
-        cases = [Case(self.quad, studyuid=c['studyuid']) for c in cases]
-        cases1, cases2 = [], []
-        for case in cases:
-            cases1.append(case.get_imgos_evals_case(task_id=task1['_id']))
-            cases2.append(case.get_imgos_evals_case(task_id=task2['_id']))
-        cases1, cases2 = sorted(cases1, key=lambda c: c.name), sorted(cases2, key=lambda c: c.name)
+                                                        {'studyuid': {'$in': task2['studyuids']}}]}, {'_id': 0, 'studyuid': 1}))
+        cases = load_cases(self.quad, [c['studyuid'] for c in cases], [task1['_id'], task2['_id']])
+        cases1, cases2 = sorted(cases[task1['_id']], key=lambda c: c.name), sorted(cases[task2['_id']], key=lambda c: c.name)
         self.parent.add_ccs_overview_tab(self.quad, cases1, cases2)
             
     
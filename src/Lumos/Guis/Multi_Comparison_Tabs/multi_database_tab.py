@@ -121,15 +121,10 @@ class Multi_Database_TabWidget(QWidget):
             study_uids = {'studyuid': {'$in': cohort['studyuids']}}
             for task in task_list:
                 study_uids = {'$and': [study_uids, {'studyuid': {'$in': task['studyuids']}} ]}
-            cases =  list(self.quad.case_coll.find(study_uids))
-            
-            cases = [Case(self.quad, studyuid=c['studyuid']) for c in cases]
-            cases_dict = dict()
+            studyuids = [c['studyuid'] for c in self.quad.case_coll.find(study_uids, {'_id': 0, 'studyuid': 1})]
+            # all readers' cases in a few bulk queries, image organizers are shared between readers
+            cases_dict = load_cases(self.quad, studyuids, [task['_id'] for task in task_list])
             for task in task_list:
-                cases_dict[task['_id']] = list()
-                for case in cases:
-                    cases_dict[task['_id']].append((case.get_imgos_evals_case(task_id=task['_id'])))
-                #print(cases_dict)
                 cases_dict[task['_id']] = sorted(cases_dict[task['_id']], key=lambda c: c.name)
             cases_list= []
             for task in task_list:
@@ -5,10 +5,12 @@ import traceback
 
 from PyQt6.QtWidgets import QMainWindow, QWidget, QTabWidget, QVBoxLayout, QApplication, QLabel, QStatusBar, QStyle, QCheckBox, QGridLayout, QPushButton, QLineEdit, QFrame
 from PyQt6.QtGui import QIcon, QColor, QPalette, QAction
-from PyQt6.QtCore import Qt, QSize
+from PyQt6.QtCore import Qt, QSize, QTimer
 
 import qdarktheme
 
+from Lumos.ImageOrganizer import get_image_cache_stats
+
 from Lumos.Guis.Multi_Comparison_Tabs.multi_database_tab import Multi_Database_TabWidget
 from Lumos.Guis.Multi_Comparison_Tabs.CCs_Multi_Overview_Tab import CCs_Multi_Overview_Tab
 
@@ -40,6 +42,18 @@ class MainWindow(QMainWindow):
         # Set Statusbar for information display during use / mouse hovering
         self.setStatusBar(QStatusBar(self))
         
+        # Image cache counters in the statusbar, refreshed every 2 seconds
+        self.cache_label = QLabel(self)
+        self.statusBar().addPermanentWidget(self.cache_label)
+        self.cache_timer = QTimer(self)
+        self.cache_timer.timeout.connect(self.update_cache_status)
+        self.cache_timer.start(2000)
+        
+    def update_cache_status(self):
+        stats = get_image_cache_stats()
+        self.cache_label.setText('Image Cache: %d hits, %d misses (%.0f%%), %.0f / %.0f MB' % (stats['hits'], stats['misses'], 
+                                 100*stats['hit_rate'], stats['nbytes']/1024**2, stats['max_bytes']/1024**2))
+        
     def add_ccs_overview_tab(self, quad, cases_list):
         tab = CCs_Multi_Overview_Tab(self.tab, quad, cases_list)
         
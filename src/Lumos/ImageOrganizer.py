@@ -1,8 +1,79 @@
 from operator import itemgetter
 import numpy as np
 import pydicom
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import Lumos
+from Lumos.PixelCache import get_pixel_cache, get_normalize_params
+from Lumos.LRUCache import LRU_Cache
+from Lumos.DecodePool import get_decode_pool
+
+
+# process-wide cache of normalized images, keyed by (sop, value_normalize, window_normalize)
+image_cache = LRU_Cache(max_bytes=256*1024**2)
+
+def set_image_cache_size(max_bytes):
+    """Sets the memory budget of the process-wide normalized image cache (evicts least recently used images)"""
+    image_cache.resize(max_bytes)
+
+def get_image_cache_stats():
+    """Returns the hit, miss and eviction counters and memory usage of the process-wide normalized image cache"""
+    return image_cache.stats()
+
+
+def read_dicom_headers(paths, nr_workers=8):
+    # header-only reads (no pixel data) in threads, file reads are I/O bound
+    read = lambda p: pydicom.dcmread(p, stop_before_pixels=True)
+    if nr_workers<=1 or len(paths)<2: return [read(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=min(nr_workers, len(paths))) as executor: return list(executor.map(read, paths))
+
+
+class Slice_Geometry:
+    """Slice_Geometry holds the geometry fields of an image's header
+
+    Note:
+        Attribute names follow the dicom keywords, so it can replace a dicom dataset wherever only the geometry
+        is needed (e.g. the dcm argument of mlDiffMetric, AreaDiffMetric, HausdorffMetric and mmDistMetric).
+
+    Attributes:
+        PixelSpacing (list of float): row and column spacing in mm
+        SliceThickness (float): slice thickness in mm
+        SpacingBetweenSlices (float): spacing between slices in mm (None if not in the header)
+        SliceLocation (float): slice location in mm
+        ImagePositionPatient (list of float): position of the upper left pixel in patient coordinates
+        ImageOrientationPatient (list of float): row and column direction cosines
+        Rows (int): image height
+        Columns (int): image width
+    """
+    __slots__ = ('PixelSpacing', 'SliceThickness', 'SpacingBetweenSlices', 'SliceLocation',
+                 'ImagePositionPatient', 'ImageOrientationPatient', 'Rows', 'Columns')
+
+    def __init__(self, pixel_spacing, slice_thickness, spacing_between_slices=None, slice_location=None,
+                 position=None, orientation=None, rows=None, columns=None):
+        self.PixelSpacing            = [float(p) for p in pixel_spacing]
+        self.SliceThickness          = float(slice_thickness)
+        self.SpacingBetweenSlices    = None if spacing_between_slices is None else float(spacing_between_slices)
+        self.SliceLocation           = None if slice_location         is None else float(slice_location)
+        self.ImagePositionPatient    = None if position               is None else [float(x) for x in position]
+        self.ImageOrientationPatient = None if orientation            is None else [float(x) for x in orientation]
+        self.Rows                    = None if rows                   is None else int(rows)
+        self.Columns                 = None if columns                is None else int(columns)
+
+    def __repr__(self):
+        return 'Slice_Geometry(' + ', '.join(k+'='+str(getattr(self, k)) for k in self.__slots__) + ')'
+
+
+def get_dicom_geometry(dcm):
+    """Slice_Geometry of a pydicom dataset"""
+    return Slice_Geometry(dcm.PixelSpacing, dcm.SliceThickness, dcm.get('SpacingBetweenSlices'), dcm.get('SliceLocation'),
+                          dcm.get('ImagePositionPatient'), dcm.get('ImageOrientationPatient'), dcm.get('Rows'), dcm.get('Columns'))
+
+
+# header document fields of Slice_Geometry (see Lumos.utils.dcm_to_json)
+geometry_projection = {'_id': 0, 'sop': 1, 'pixelspacing': 1, 'slicethickness': 1, 'spacingbetweenslices': 1, 'slicelocation': 1,
+                       'imageposition_patient': 1, 'imageorientation_patient': 1, 'rows': 1, 'columns': 1}
+
 
 class ImageOrganizer:
     def __init__(self, db, studyuid=None, imagetype=None, stack_nr=0):
@@ -11,23 +82,33 @@ class ImageOrganizer:
         self.imagetype = imagetype
         self.stack_nr  = stack_nr
         imgo = db.imgo_coll.find_one({'studyuid': studyuid, 'imagetype': imagetype, 'stack_nr': stack_nr})
-        if imgo is not None: 
-            self.__dict__ = imgo
-            self.depthandtime2sop = {tuple(v):k for k,v in self.sop2depthandtime.items()}
-            self.__dict__.pop('_id')
+        if imgo is not None: self.set_json(imgo)
         self.db = db # DB must be passed bc it cannot be stored, must be set After the dict instantiation
     
+    @classmethod
+    def from_json(cls, db, imgo_json):
+        # organizer from an already fetched imgo_coll document, without querying (see Lumos.Case.load_cases)
+        imgo = cls.__new__(cls)
+        imgo.set_json(imgo_json)
+        imgo.db = db
+        return imgo
+    
+    def set_json(self, imgo_json):
+        self.__dict__ = dict(imgo_json)
+        self.depthandtime2sop = {tuple(v):k for k,v in self.sop2depthandtime.items()}
+        self.__dict__.pop('_id', None)
+    
     def organize(self, sops=None):
         # get the dicoms
         db = self.db
-        if sops is not None:                            img_jsons = list(db.dcm_coll.find({'sop': {'$in': sops}}))
-        if None not in [self.studyuid, self.imagetype]: img_jsons = list(db.dcm_coll.find({'studyuid': self.studyuid, 'imagetype': self.imagetype, 'stack_nr':  self.stack_nr}))
+        if sops is not None:                            img_jsons = list(db.dcm_coll.find({'sop': {'$in': sops}}, Lumos.utils.dicom_header_projection))
+        if None not in [self.studyuid, self.imagetype]: img_jsons = list(db.dcm_coll.find({'studyuid': self.studyuid, 'imagetype': self.imagetype, 'stack_nr':  self.stack_nr}, Lumos.utils.dicom_header_projection))
         try:    self.imagetype = img_jsons[0]['imagetype']
         except: self.imagetype = 'Unknown'
         try:    self.stack_nr  = img_jsons[0]['stack_nr']
         except: self.stack_nr  = 'Unknown'
         
-        dicoms = [pydicom.dcmread(j['path']) for j in img_jsons]
+        dicoms = read_dicom_headers([j['path'] for j in img_jsons])
         dcm = dicoms[0]
         self.studyuid          = dcm.StudyInstanceUID
         self.sop2depthandtime  = self.get_sop2depthandtime(dicoms)
@@ -83,7 +164,7 @@ class ImageOrganizer:
     def set_image_height_width_depth(self, dicom_dict):
         nr_slices = self.nr_slices
         dcm1 = dicom_dict[self.depthandtime2sop[(0, 0)]]
-        self.height, self.width = dcm1.pixel_array.shape
+        self.height, self.width = int(dcm1.Rows), int(dcm1.Columns)
         self.pixel_h, self.pixel_w = list(map(float, dcm1.PixelSpacing))
         try: dcm2 = dicom_dict[self.depthandtime2sop[(1, 0)]]
         except Exception as e: 
@@ -116,50 +197,172 @@ class ImageOrganizer:
         self.nr_phases = max(dat, key=itemgetter(1))[1]+1
         self.nr_slices = max(dat, key=itemgetter(0))[0]+1
         
-    def get_json(self, slice_nr, phase_nr):
+    def get_json(self, slice_nr, phase_nr, projection=None):
+        # header fields only (no bulk data), projection restricts the returned fields further
         sop  = self.depthandtime2sop[(slice_nr, phase_nr)]
-        json = self.db.dcm_coll.find_one({'sop': sop})
+        json = self.db.dcm_coll.find_one({'sop': sop}, Lumos.utils.dicom_header_projection if projection is None else projection)
         return json
         
     def get_dcm(self, slice_nr, phase_nr):
-        dcm = pydicom.dcmread(self.get_json(slice_nr, phase_nr)['path'])
+        dcm = pydicom.dcmread(self.get_json(slice_nr, phase_nr, {'_id': 0, 'path': 1})['path'])
         return dcm
 
+    def get_geometry(self, slice_nr, phase_nr=0):
+        """Returns the Slice_Geometry of an image without reading the dicom file
+
+        Note:
+            The geometry of all images of the stack is loaded from the header documents with one query on first use.
+            Fields missing in old header documents fall back to the organizer's pixel_h, pixel_w and slice_thickness.
+        """
+        if getattr(self, 'sop2geometry', None) is None:
+            sops = list(self.depthandtime2sop.values())
+            self.sop2geometry = dict()
+            for j in self.db.dcm_coll.find({'sop': {'$in': sops}}, geometry_projection):
+                try:
+                    self.sop2geometry[j['sop']] = Slice_Geometry(j.get('pixelspacing', [self.pixel_h, self.pixel_w]),
+                                                                 j.get('slicethickness', self.slice_thickness),
+                                                                 j.get('spacingbetweenslices'), j.get('slicelocation'),
+                                                                 j.get('imageposition_patient'), j.get('imageorientation_patient'),
+                                                                 j.get('rows', self.height), j.get('columns', self.width))
+                except Exception as e: print(traceback.format_exc())
+        sop = self.depthandtime2sop[(slice_nr, phase_nr)]
+        if sop not in self.sop2geometry: return get_dicom_geometry(pydicom.dcmread(self.get_json(slice_nr, phase_nr, {'_id': 0, 'path': 1})['path'], stop_before_pixels=True))
+        return self.sop2geometry[sop]
+    
     def get_img(self, slice_nr, phase_nr, normalize=True):
-        #try:
-        dcm = self.get_dcm(slice_nr, phase_nr)
-        img = self.image_normalize(dcm) if normalize else dcm.pixel_array
-        #except Exception as e:
-        #    print(e)
-        #    img = np.zeros((self.height, self.width))
+        # normalized images come from the shared image cache (read-only arrays), raw images from the on-disk pixel cache
+        # (zero-copy memmap views), both fall back to reading the dicom
+        sop = self.depthandtime2sop[(slice_nr, phase_nr)]
+        if normalize:
+            key = (sop,) + self.get_normalize_flags()
+            img = image_cache.get(key)
+            if img is not None: return img
+        img   = None
+        cache = get_pixel_cache()
+        if cache is not None:
+            try:
+                cached = cache.get_image(self, slice_nr, phase_nr) # None if the stack cannot be built (remembered by the cache)
+                if cached is not None:
+                    img, params = cached
+                    if normalize: img = self.normalize_pixels(img, params)
+            except Exception as e: print(traceback.format_exc()); img = None
+        if img is None:
+            dcm = self.get_dcm(slice_nr, phase_nr)
+            img = self.image_normalize(dcm) if normalize else dcm.pixel_array
+        if normalize:
+            img.flags.writeable = False
+            image_cache.put(key, img)
         return img
     
-    def image_normalize(self, dcm, value_normalize=None, window_normalize=None):
-        img = dcm.pixel_array
+    def prefetch(self, positions=None, normalize=True):
+        # decodes images in the background decode pool (group: studyuid), positions: [(slice_nr, phase_nr)], None for all
+        # jobs are dropped while the pool's queue is full, cancel with get_decode_pool().cancel(studyuid)
+        pool      = get_decode_pool()
+        positions = list(self.depthandtime2sop.keys()) if positions is None else positions
+        futures   = [pool.submit(self.studyuid, self.get_img, d, p, normalize) for d,p in positions if (d,p) in self.depthandtime2sop]
+        return [f for f in futures if f is not None]
+    
+    def get_normalize_flags(self, value_normalize=None, window_normalize=None):
+        # default normalization by imagetype
         if value_normalize is None or window_normalize is None:
             if 'CINE' in self.imagetype or 'CS' in self.imagetype: value_normalize, window_normalize = True, True
             if 'T1'   in self.imagetype: value_normalize, window_normalize = True, False
             if 'T2'   in self.imagetype: value_normalize, window_normalize = True, False
             if 'LGE'  in self.imagetype: value_normalize, window_normalize = True, False
+        return bool(value_normalize), bool(window_normalize)
+    
+    def image_normalize(self, dcm, value_normalize=None, window_normalize=None):
+        return self.normalize_pixels(dcm.pixel_array, get_normalize_params(dcm), value_normalize, window_normalize)
+    
+    def normalize_pixels(self, img, params, value_normalize=None, window_normalize=None):
+        # params: rescale slope / intercept and window center / width (see PixelCache.get_normalize_params)
+        value_normalize, window_normalize = self.get_normalize_flags(value_normalize, window_normalize)
         if value_normalize:
-            if [0x0028, 0x1052] in dcm and [0x0028, 0x1053] in dcm:
-                img = img * float(dcm[0x0028, 0x1053].value) + float(dcm[0x0028, 0x1052].value)
+            if params['intercept'] is not None and params['slope'] is not None:
+                img = img * params['slope'] + params['intercept']
         if window_normalize:
             minn, maxx = 0, 255
-            if [0x0028, 0x1050] in dcm and [0x0028, 0x1051] in dcm:
-                c = float(dcm[0x0028, 0x1050].value) # window center
-                w = float(dcm[0x0028, 0x1051].value) # window width
+            if params['center'] is not None and params['width'] is not None:
+                c = params['center'] # window center
+                w = params['width']  # window width
                 search_if, search_elif   = img<=(c-0.5)-((w-1)/2), img>(c-0.5)+((w-1)/2)
                 img = ((img-(c-0.5)) / (w-1)+0.5) * (maxx-minn) + minn
                 img[search_if]   = minn
                 img[search_elif] = maxx
         return img
     
+    def get_img_stack(self, phase_nr=None, value_normalize=None, window_normalize=None, out=None):
+        """Returns the normalized images of a phase (or of all phases) as one contiguous float32 array
+        
+        Note:
+            Rescale and window normalization run once, vectorized over the whole stack. Missing images are zeros.
+        
+        Args:
+            phase_nr (int): phase, None for all phases
+            value_normalize (bool): apply rescale slope / intercept, None for the default by imagetype
+            window_normalize (bool): apply window center / width (0..255), None for the default by imagetype
+            out (numpy.ndarray of float32): optional C-contiguous output buffer of the returned shape (ValueError otherwise)
+            
+        Returns:
+            numpy.ndarray of float32: (slices, H, W) for phase_nr, (slices, phases, H, W) for all phases
+        """
+        phases = list(range(self.nr_phases)) if phase_nr is None else [phase_nr]
+        value_normalize, window_normalize = self.get_normalize_flags(value_normalize, window_normalize)
+        raw, params = self.get_raw_stack(phases)
+        shape = (self.nr_slices, len(phases)) + raw.shape[2:]
+        expected = shape if phase_nr is None else shape[:1] + shape[2:]
+        if out is None: out = np.empty(expected, dtype=np.float32)
+        if out.shape!=expected or out.dtype!=np.float32 or not out.flags.c_contiguous: # reshape must return a view of out
+            raise ValueError('out must be a C-contiguous float32 array of shape %s, got %s %s' % (expected, out.dtype, out.shape))
+        out = out.reshape(shape)
+        np.copyto(out, raw, casting='unsafe')
+        def param_array(name):
+            return np.array([[np.nan if params.get(sop) is None or params[sop][name] is None else params[sop][name] for sop in sops]
+                             for sops in self.get_sop_grid(phases)], dtype=np.float32)[..., None, None]
+        if value_normalize:
+            slope, intercept = param_array('slope'), param_array('intercept')
+            valid = ~np.isnan(slope) & ~np.isnan(intercept)
+            out  *= np.where(valid, slope, 1)
+            out  += np.where(valid, intercept, 0)
+        if window_normalize:
+            minn, maxx = 0, 255
+            c, w  = param_array('center'), param_array('width')
+            valid = ~np.isnan(c) & ~np.isnan(w)
+            c, w  = np.where(valid, c, 0.5), np.where(valid, w, 2)
+            out  *= np.where(valid, (maxx-minn) / (w-1), 1)
+            out  += np.where(valid, (0.5 - (c-0.5)/(w-1)) * (maxx-minn) + minn, 0)
+            np.clip(out, np.where(valid, minn, -np.inf), np.where(valid, maxx, np.inf), out=out)
+        return out[:, 0] if phase_nr is not None else out
+    
+    def get_sop_grid(self, phases):
+        return [[self.depthandtime2sop.get((d, p)) for p in phases] for d in range(self.nr_slices)]
+    
+    def get_raw_stack(self, phases):
+        # raw pixel values (slices, len(phases), H, W) and normalization params by sop
+        cache = get_pixel_cache()
+        if cache is not None:
+            try:
+                cached = cache.get_stack(self)
+                if cached is not None: return cached[0][:, phases], cached[1]
+            except Exception as e: print(traceback.format_exc())
+        raw, params = np.zeros((self.nr_slices, len(phases), self.height, self.width)), dict()
+        for d, sops in enumerate(self.get_sop_grid(phases)):
+            for i, sop in enumerate(sops):
+                if sop is None: continue
+                dcm = self.get_dcm(d, phases[i])
+                img = dcm.pixel_array
+                raw[d, i, :img.shape[0], :img.shape[1]] = img
+                params[sop] = get_normalize_params(dcm)
+        return raw, params
+    
     def get_imgs_phase(self, phase_nr, value_normalize=True, window_normalize=True):
-        return [self.get_img(d, phase_nr, value_normalize, window_normalize) for d in range(self.nr_slices)]
+        return list(self.get_img_stack(phase_nr, value_normalize, window_normalize))
     
     def get_patient_info(self):
-        dcm  = pydicom.dcmread(self.db.dcm_coll.find_one({'studyuid' : self.studyuid})['path'])
+        # from the lean header documents, only old databases fall back to a file read
+        info = Lumos.utils.get_demographics(self.db.dcm_coll, self.studyuid)
+        if info is not None: return info
+        dcm  = pydicom.dcmread(self.db.dcm_coll.find_one({'studyuid' : self.studyuid}, {'_id': 0, 'path': 1})['path'], stop_before_pixels=True)
         info = []
         try:    info.append(str(dcm.PatientName))
         except: info.append('')
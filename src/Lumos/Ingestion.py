@@ -0,0 +1,390 @@
+#############
+# Ingestion #
+#############
+
+# Bulk import of DICOM and annotation folders into the database:
+#   - header-only reads (no pixel data) fanned out over a process pool
+#   - insert_many(ordered=False) in batches, duplicates (unique sop index) are counted instead of printed
+#   - all studies in the folder tree are imported (optionally restricted to studyuids)
+#   - Ingestion_Report with progress and throughput (files/s, MB/s)
+#   - annotation files are parsed (optionally validated) and converted to WKB in worker processes
+#   - Import_Manifest persists (path, size, mtime[, hash]) of imported files: re-imports only process new or changed files
+#   - patient demographics are stored in the header documents and copied to existing case documents
+#   - optionally the preview pyramids of imported images are built in the worker processes (stored in the pixel cache folder)
+
+import os
+import json
+import time
+import hashlib
+import traceback
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom
+import shapely
+from shapely.geometry import shape
+from shapely.validation import explain_validity
+from pymongo import UpdateOne, UpdateMany, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from Lumos.utils import dcm_to_json, demographics_fields, get_demographics
+from Lumos.Annotation import anno_meta_keys, annotation_cache, get_cache_key, get_content_hash
+from Lumos.PixelCache import build_preview_file, get_pixel_cache
+
+
+class Ingestion_Report:
+    """Ingestion_Report counts files and bytes of an import and reports the throughput
+
+    Attributes:
+        nr_files (int): number of files read
+        nr_bytes (int): size of all files read in bytes
+        nr_inserted (int): number of documents inserted
+        nr_duplicates (int): number of documents already in the database
+        nr_failed (int): number of unreadable files or failed inserts
+        nr_rejected (int): number of documents rejected by validation
+        nr_skipped (int): number of unchanged files (according to the manifest)
+        nr_updated (int): number of documents replaced because their file changed
+        failed (list of (str, str)): (path, error) of failed files
+        studyuids (set of str): studies found
+    """
+    def __init__(self):
+        self.start_time    = time.time()
+        self.nr_files      = 0
+        self.nr_bytes      = 0
+        self.nr_inserted   = 0
+        self.nr_duplicates = 0
+        self.nr_failed     = 0
+        self.nr_rejected   = 0
+        self.nr_skipped    = 0
+        self.nr_updated    = 0
+        self.failed        = []
+        self.studyuids     = set()
+
+    def add_failure(self, path, error):
+        self.nr_failed += 1
+        self.failed.append((path, error))
+
+    def seconds(self):
+        return max(time.time() - self.start_time, 1e-9)
+
+    def files_per_second(self):
+        return self.nr_files / self.seconds()
+
+    def mb_per_second(self):
+        return self.nr_bytes / 1024**2 / self.seconds()
+
+    def __str__(self):
+        return ('Files: %d (%.1f MB), Studies: %d, Inserted: %d, Updated: %d, Duplicates: %d, Skipped: %d, Rejected: %d, Failed: %d, '
+                '%.1fs: %.1f files/s, %.1f MB/s' %
+                (self.nr_files, self.nr_bytes/1024**2, len(self.studyuids), self.nr_inserted, self.nr_updated, self.nr_duplicates,
+                 self.nr_skipped, self.nr_rejected, self.nr_failed, self.seconds(), self.files_per_second(), self.mb_per_second()))
+
+
+class Import_Manifest:
+    """Import_Manifest remembers imported files by (path, size, mtime) and optionally their content hash
+
+    Note:
+        Manifest documents are stored in quad.mani_coll: {'kind', 'path', 'size', 'mtime', 'hash'}.
+        With use_hash, files whose size or mtime changed but whose content did not (e.g. copied or touched) are skipped too.
+        Only successfully imported files are recorded, failed files are retried on the next import.
+
+    Args:
+        coll (Collection): manifest collection
+        kind (str): file kind, e.g. 'dicom' or 'annotation:<task_id>'
+        use_hash (bool): compare content hashes of files with changed size or mtime
+    """
+    def __init__(self, coll, kind, use_hash=False):
+        self.coll     = coll
+        self.kind     = kind
+        self.use_hash = use_hash
+        self.entries  = {d['path']: d for d in coll.find({'kind': kind}, {'_id': 0, 'path': 1, 'size': 1, 'mtime': 1, 'hash': 1})}
+        self.updates  = []
+
+    def file_hash(self, path):
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024**2), b''): h.update(chunk)
+        return h.hexdigest()
+
+    def file_state(self, path):
+        st = os.stat(path)
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+
+    def classify(self, paths):
+        """Splits paths into new, changed and unchanged files
+
+        Returns:
+            (list of str, list of str, list of str): new paths, changed paths, unchanged paths
+        """
+        new, changed, unchanged = [], [], []
+        for p in paths:
+            entry = self.entries.get(p)
+            if entry is None: new.append(p); continue
+            state = self.file_state(p)
+            if entry['size']==state['size'] and entry['mtime']==state['mtime']: unchanged.append(p); continue
+            if self.use_hash and entry.get('hash') is not None and entry['hash']==self.file_hash(p):
+                self.record(p); unchanged.append(p); continue
+            changed.append(p)
+        return new, changed, unchanged
+
+    def record(self, path):
+        """Marks path as imported in its current state (written on flush)"""
+        try:    state = self.file_state(path)
+        except: return
+        if self.use_hash: state['hash'] = self.file_hash(path)
+        self.entries[path] = state
+        self.updates.append(UpdateOne({'kind': self.kind, 'path': path}, {'$set': state}, upsert=True))
+        if len(self.updates)>=1000: self.flush()
+
+    def flush(self):
+        if len(self.updates)==0: return
+        self.coll.bulk_write(self.updates, ordered=False)
+        self.updates = []
+
+
+def read_dicom_header(path):
+    """Reads a DICOM file without pixel data (runs in worker processes)
+
+    Returns:
+        (str, dict, str, int): path, header document (None on failure), error message (None on success), file size in bytes
+    """
+    try:
+        nbytes = os.path.getsize(path)
+        dcm    = pydicom.dcmread(path, stop_before_pixels=True)
+        return path, dcm_to_json(dcm, path), None, nbytes
+    except Exception as e: return path, None, traceback.format_exc(limit=1), 0
+
+
+def read_annotation_file(path, validate=False):
+    """Reads an annotation file (<sop>.json) and adds binary (WKB) geometries (runs in worker processes)
+
+    Args:
+        path (str): path of the annotation file
+        validate (bool): reject annotations with unparsable or invalid geometries (unreadable JSON is always rejected)
+
+    Returns:
+        (str, dict, str, int): path, annotation document (None on failure), error message (None on success), file size in bytes
+    """
+    try:
+        nbytes = os.path.getsize(path)
+        with open(path) as f: anno = json.load(f)
+        if not isinstance(anno, dict): return path, None, 'rejected: not a JSON object', nbytes
+        anno['content_hash'] = get_content_hash(anno)
+        for geom_name, geom in anno.items():
+            if geom_name in anno_meta_keys or not isinstance(geom, dict) or 'cont' not in geom: continue
+            try:    geo = shape(geom['cont'])
+            except Exception as e:
+                if validate: return path, None, 'rejected: '+geom_name+': '+str(e), nbytes
+                continue
+            if validate and not geo.is_valid: return path, None, 'rejected: '+geom_name+': '+explain_validity(geo), nbytes
+            geom['cont_wkb'] = shapely.to_wkb(geo)
+        anno['has_wkb'] = True
+        return path, anno, None, nbytes
+    except Exception as e: return path, None, 'rejected: '+traceback.format_exc(limit=1), 0
+
+
+def parallel_map(func, items, nr_workers=None, chunksize=32):
+    """Yields func(item) in order, in worker processes if nr_workers is None (all cpus) or >1"""
+    nr_workers = os.cpu_count() if nr_workers is None else nr_workers
+    if nr_workers<=1 or len(items)<2*chunksize:
+        for item in items: yield func(item)
+        return
+    with ProcessPoolExecutor(max_workers=nr_workers) as executor:
+        for result in executor.map(func, items, chunksize=chunksize): yield result
+
+
+def insert_batch(coll, docs, report, manifest=None):
+    """Inserts documents unordered, duplicate keys are counted, other write errors reported as failed"""
+    if len(docs)==0: return
+    failed = set()
+    try: report.nr_inserted += len(coll.insert_many(docs, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        details = e.details
+        report.nr_inserted += details.get('nInserted', 0)
+        for error in details.get('writeErrors', []):
+            if error.get('code')==11000: report.nr_duplicates += 1; continue
+            failed.add(error['index'])
+            report.add_failure(docs[error['index']].get('path'), error.get('errmsg'))
+    if manifest is not None:
+        for i, doc in enumerate(docs):
+            if i not in failed: manifest.record(doc['path'])
+
+
+def replace_batch(coll, docs, keys, report, manifest=None):
+    """Replaces (upserts) documents of changed files, matched on the fields in keys"""
+    if len(docs)==0: return
+    requests = [ReplaceOne({k: doc[k] for k in keys}, doc, upsert=True) for doc in docs]
+    failed   = set()
+    try: result = coll.bulk_write(requests, ordered=False).bulk_api_result
+    except BulkWriteError as e:
+        result = e.details
+        for error in result.get('writeErrors', []):
+            failed.add(error['index'])
+            report.add_failure(docs[error['index']].get('path'), error.get('errmsg'))
+    report.nr_updated  += result.get('nMatched', 0)
+    report.nr_inserted += result.get('nUpserted', 0)
+    if manifest is not None:
+        for i, doc in enumerate(docs):
+            if i not in failed: manifest.record(doc['path'])
+
+
+def ingest_dicom_folder(quad, folder_path, batch_size=500, nr_workers=None, studyuids=None, pattern='**/*.dcm',
+                        use_manifest=True, use_hash=False, build_previews=False, verbose=True):
+    """Imports the DICOM headers of all files in folder_path
+
+    Args:
+        quad (QUAD_Manager): database manager
+        folder_path (str): root folder, searched recursively
+        batch_size (int): number of documents per insert_many
+        nr_workers (int): number of reading processes, None for all cpus, 1 for serial reading
+        studyuids (collection of str): only import these studies, None for all
+        pattern (str): glob pattern for DICOM files
+        use_manifest (bool): skip files imported before, replace documents of changed files
+        use_hash (bool): additionally compare content hashes of files with changed size or mtime
+        build_previews (bool): decode the new and changed images and store their preview pyramids (requires the pixel cache)
+        verbose (bool): print progress after each batch
+
+    Returns:
+        Ingestion_Report: counts and throughput
+    """
+    report   = Ingestion_Report()
+    paths    = [str(p) for p in Path(folder_path).glob(pattern)]
+    imported = []
+    manifest = Import_Manifest(quad.mani_coll, 'dicom', use_hash) if use_manifest else None
+    changed  = set()
+    if manifest is not None:
+        paths, changed, unchanged = manifest.classify(paths)
+        report.nr_skipped = len(unchanged)
+        paths, changed = paths + changed, set(changed)
+    new_batch, changed_batch = [], []
+    for path, dcm_json, error, nbytes in parallel_map(read_dicom_header, paths, nr_workers):
+        report.nr_files += 1
+        report.nr_bytes += nbytes
+        if dcm_json is None:                    report.add_failure(path, error); continue
+        if 'sop' not in dcm_json:               report.add_failure(path, 'No SOPInstanceUID'); continue
+        if studyuids is not None and dcm_json.get('studyuid') not in studyuids: continue
+        report.studyuids.add(dcm_json.get('studyuid'))
+        imported.append(path)
+        if path in changed: changed_batch.append(dcm_json)
+        else:               new_batch.append(dcm_json)
+        if len(new_batch)>=batch_size:
+            insert_batch(quad.dcm_coll, new_batch, report, manifest); new_batch = []
+            if verbose: print(report)
+        if len(changed_batch)>=batch_size:
+            replace_batch(quad.dcm_coll, changed_batch, ['sop'], report, manifest); changed_batch = []
+            if verbose: print(report)
+    insert_batch(quad.dcm_coll, new_batch, report, manifest)
+    replace_batch(quad.dcm_coll, changed_batch, ['sop'], report, manifest)
+    if manifest is not None: manifest.flush()
+    update_case_demographics(quad, report.studyuids - {None})
+    cache = get_pixel_cache() if build_previews else None
+    if cache is not None:
+        for path, sop, error in parallel_map(partial(build_preview_file, folder_path=cache.folder_path), imported, nr_workers):
+            if error is not None: report.add_failure(path, error)
+    if verbose: print(report)
+    return report
+
+
+def update_case_demographics(quad, studyuids=None, batch_size=500):
+    """Copies the patient demographics of the header documents into case documents that miss them
+
+    Args:
+        quad (QUAD_Manager): database manager
+        studyuids (collection of str): cases to update, None for all cases
+
+    Returns:
+        int: number of updated case documents
+    """
+    query = {'$or': [{k: {'$exists': False}} for k in demographics_fields.values()]}
+    if studyuids is not None: query = {'$and': [{'studyuid': {'$in': list(studyuids)}}, query]}
+    nr_updated, updates = 0, []
+    for case in quad.case_coll.find(query, {'_id': 1, 'studyuid': 1}):
+        info = get_demographics(quad.dcm_coll, case['studyuid'])
+        if info is None: continue
+        updates.append(UpdateOne({'_id': case['_id']}, {'$set': dict(zip(demographics_fields.values(), info))}))
+        if len(updates)>=batch_size: nr_updated += quad.case_coll.bulk_write(updates, ordered=False).modified_count; updates = []
+    if len(updates)>0: nr_updated += quad.case_coll.bulk_write(updates, ordered=False).modified_count
+    return nr_updated
+
+
+def backfill_demographics(quad, batch_size=500, nr_workers=None, verbose=True):
+    """Backfills patient demographics of existing databases
+
+    Note:
+        Header documents without any demographics field (e.g. imported before they were stored) are re-read
+        (header only, one file per study), then the demographics are copied into the case documents.
+
+    Returns:
+        (int, int): number of updated header documents, number of updated case documents
+    """
+    query = {'$and': [{f: {'$exists': False}} for f in demographics_fields]}
+    paths = dict()
+    for doc in quad.dcm_coll.find(query, {'_id': 0, 'studyuid': 1, 'path': 1}):
+        if doc.get('path') is not None: paths.setdefault(doc.get('studyuid'), doc['path'])
+    nr_headers, updates = 0, []
+    for path, dcm_json, error, nbytes in parallel_map(read_dicom_header, list(paths.values()), nr_workers):
+        if dcm_json is None: print(path, error); continue
+        fields = {f: dcm_json[f] for f in demographics_fields if f in dcm_json}
+        if len(fields)==0: continue
+        updates.append(UpdateMany({'studyuid': dcm_json.get('studyuid'), '$and': query['$and']}, {'$set': fields}))
+        if len(updates)>=batch_size: nr_headers += quad.dcm_coll.bulk_write(updates, ordered=False).modified_count; updates = []
+    if len(updates)>0: nr_headers += quad.dcm_coll.bulk_write(updates, ordered=False).modified_count
+    nr_cases = update_case_demographics(quad, batch_size=batch_size)
+    if verbose: print('Demographics backfilled: %d header documents, %d cases' % (nr_headers, nr_cases))
+    return nr_headers, nr_cases
+
+
+def ingest_anno_folder(quad, folder_path, task_id, studyuid, batch_size=500, nr_workers=None, validate=False, upsert=False,
+                       use_manifest=True, use_hash=False, verbose=True):
+    """Imports the annotation files (<sop>.json) in folder_path for the reader task task_id
+
+    Args:
+        quad (QUAD_Manager): database manager
+        folder_path (str): folder with annotation files, searched recursively
+        task_id (str): reader task of the annotations
+        studyuid (str): study of the annotations
+        batch_size (int): number of documents per database write
+        nr_workers (int): number of parsing processes, None for all cpus, 1 for serial parsing
+        validate (bool): reject annotations with unparsable or invalid geometries
+        upsert (bool): replace existing annotations of (task_id, sop), e.g. for re-imported reader tasks
+        use_manifest (bool): skip files imported before, replace annotations of changed files
+        use_hash (bool): additionally compare content hashes of files with changed size or mtime
+        verbose (bool): print progress after each batch
+
+    Returns:
+        Ingestion_Report: counts and throughput
+    """
+    report   = Ingestion_Report()
+    paths    = [str(p) for p in Path(folder_path).glob('**/*.json')]
+    manifest = Import_Manifest(quad.mani_coll, 'annotation:'+str(task_id), use_hash) if use_manifest else None
+    changed  = set()
+    if manifest is not None:
+        paths, changed, unchanged = manifest.classify(paths)
+        report.nr_skipped = len(unchanged)
+        paths, changed = paths + changed, set(changed)
+    report.studyuids.add(studyuid)
+    read = partial(read_annotation_file, validate=validate)
+    new_batch, changed_batch = [], []
+    def write(batch, replace):
+        if len(batch)==0: return
+        if replace: replace_batch(quad.anno_coll, batch, ['task_id', 'sop'], report, manifest)
+        else:       insert_batch(quad.anno_coll, batch, report, manifest)
+        for doc in batch: annotation_cache.pop(get_cache_key(quad, task_id, doc['sop']))
+        if verbose: print(report)
+    for path, anno, error, nbytes in parallel_map(read, paths, nr_workers):
+        report.nr_files += 1
+        report.nr_bytes += nbytes
+        if anno is None:
+            if error.startswith('rejected'): report.nr_rejected += 1; report.failed.append((path, error))
+            else:                            report.add_failure(path, error)
+            continue
+        anno.update({'task_id': task_id, 'studyuid': studyuid, 'sop': os.path.basename(path).replace('.json',''), 'path': path})
+        if upsert or path in changed: changed_batch.append(anno)
+        else:                         new_batch.append(anno)
+        if len(new_batch)>=batch_size:     write(new_batch, False);    new_batch = []
+        if len(changed_batch)>=batch_size: write(changed_batch, True); changed_batch = []
+    write(new_batch, False)
+    write(changed_batch, True)
+    if manifest is not None: manifest.flush()
+    return report
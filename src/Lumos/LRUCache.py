@@ -0,0 +1,113 @@
+#############
+# LRU Cache #
+#############
+
+# Memory-bounded least-recently-used cache shared by the annotation, image and preview caches.
+# Kept outside the Lumos.utils package: importing it must not import the image modules (Lumos.utils imports them).
+
+import sys
+import threading
+from collections import OrderedDict
+
+
+def default_sizeof(value):
+    """Approximate size in bytes (numpy arrays report nbytes)"""
+    try:    return int(value.nbytes)
+    except: return sys.getsizeof(value)
+
+
+class LRU_Cache:
+    """LRU_Cache is a thread-safe least-recently-used cache bounded by a memory budget
+
+    Note:
+        Values are sized once on insertion with sizeof. When the budget is exceeded the least recently used
+        entries are evicted. Values larger than the whole budget are not cached.
+
+    Args:
+        max_bytes (int): memory budget in bytes
+        sizeof (callable): returns the (approximate) size of a value in bytes
+
+    Attributes:
+        hits (int): number of successful lookups
+        misses (int): number of failed lookups
+        evictions (int): number of entries evicted to stay within budget
+        nbytes (int): current size of all cached values in bytes
+    """
+    def __init__(self, max_bytes, sizeof=default_sizeof):
+        self.max_bytes = int(max_bytes)
+        self.sizeof    = sizeof
+        self.entries   = OrderedDict() # key: (value, nbytes)
+        self.lock      = threading.RLock()
+        self.nbytes    = 0
+        self.reset_stats()
+
+    def get(self, key, default=None):
+        """Returns cached value and marks it as recently used, default if not cached"""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    def put(self, key, value):
+        """Caches value under key
+
+        Returns:
+            bool: True if the value was cached, False if it exceeds the budget
+        """
+        nbytes = self.sizeof(value)
+        with self.lock:
+            self.pop(key)
+            if nbytes > self.max_bytes: return False
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+            return True
+
+    def pop(self, key, default=None):
+        """Removes key from cache (no eviction count), returns its value or default"""
+        with self.lock:
+            if key not in self.entries: return default
+            value, nbytes = self.entries.pop(key)
+            self.nbytes  -= nbytes
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def resize(self, max_bytes):
+        """Sets a new memory budget, evicting entries if necessary"""
+        with self.lock:
+            self.max_bytes = int(max_bytes)
+            self._evict()
+
+    def reset_stats(self):
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def stats(self):
+        """Cache counters
+
+        Returns:
+            dict: hits, misses, evictions, hit rate, number of entries, bytes used and byte budget
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self.entries), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def __contains__(self, key):
+        with self.lock: return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self.entries) > 0:
+            _, (_, nbytes) = self.entries.popitem(last=False)
+            self.nbytes    -= nbytes
+            self.evictions += 1
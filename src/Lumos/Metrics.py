@@ -72,7 +72,7 @@ class DiceMetric(Metric):
         Args:
             geo1 (shapely.geometry): first object for comparison
             geo2 (shapely.geometry): second object for comparison
-            dcm (dicom dataset):     dicom dataset with pixel spacing
+            dcm (Slice_Geometry):    geometry (or dicom dataset) with pixel spacing
             string (bool):           return string of float with 2 decimal places
             
         Returns:
@@ -103,6 +103,7 @@ class mmDistMetric(Metric):
         Args:
             p1 (Annotation): first point
             p2 (Annotation): second point
+            dcm (Slice_Geometry): geometry (or dicom dataset) with pixel spacing
             string (bool):   return string of float with 2 decimal places
             
         Returns:
@@ -135,7 +136,7 @@ class AreaDiffMetric(Metric):
         Args:
             geo1 (shapely.geometry): first object for comparison
             geo2 (shapely.geometry): second object for comparison
-            dcm (dicom dataset):     dicom dataset with pixel spacing and slice thickness
+            dcm (Slice_Geometry):    geometry (or dicom dataset) with pixel spacing and slice thickness
             string (bool):           return string of float with 2 decimal places
             
         Returns:
@@ -167,7 +168,7 @@ class HausdorffMetric(Metric):
         Args:
             geo1 (shapely.geometry): first object for comparison
             geo2 (shapely.geometry): second object for comparison
-            dcm (dicom dataset):     dicom dataset with pixel spacing
+            dcm (Slice_Geometry):    geometry (or dicom dataset) with pixel spacing
             string (bool):           return string of float with 2 decimal places
             
         Returns:
@@ -199,7 +200,7 @@ class mlDiffMetric(Metric):
         Args:
             geo1 (shapely.geometry): first object for comparison
             geo2 (shapely.geometry): second object for comparison
-            dcm (dicom dataset):     dicom dataset with pixel spacing and slice thickness
+            dcm (Slice_Geometry):    geometry (or dicom dataset) with pixel spacing and slice thickness
             string (bool):           return string of float with 2 decimal places
             
         Returns:
@@ -231,7 +232,7 @@ class absMlDiffMetric(Metric):
         Args:
             geo1 (shapely.geometry): first object for comparison
             geo2 (shapely.geometry): second object for comparison
-            dcm (dicom dataset):     dicom dataset with pixel spacing and slice thickness
+            dcm (Slice_Geometry):    geometry (or dicom dataset) with pixel spacing and slice thickness
             string (bool):           return string of float with 2 decimal places
             
         Returns:
@@ -308,7 +309,7 @@ class AvgAreaPerThreshMetric(Metric):
             slice_nr (int):        slice number (same for both comparison objects)
             phase_nr1 (int):       phase of first comparison object 
             phase_nr2 (int):       phase of second comparison object 
-            dcm (dicom.pydicom):   Dicom object
+            dcm (Slice_Geometry):  geometry (or dicom dataset) with pixel spacing
             string (bool):         return string of float with 2 decimal places if True
             
         Returns:
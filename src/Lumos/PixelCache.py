@@ -0,0 +1,354 @@
+###############
+# Pixel Cache #
+###############
+
+# On-disk cache of decoded image stacks: every ImageOrganizer stack is decoded once into a (slices, phases, H, W) .npy file
+# (opened as memmap) with a JSON sidecar holding the sop grid, the source file mtimes and the normalization tags per sop.
+# Stacks are decoded in parallel threads and rebuilt automatically when the sop grid or the mtime of a source file changes.
+# The stored stacks are kept within a size budget (LUMOS_PIXEL_CACHE_GB, default 8), least recently used stacks are deleted.
+# Next to the stacks, a preview pyramid (1/2, 1/4, 1/8 scale uint8 images) is stored per sop for thumbnails and list views.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pydicom
+
+from Lumos.DecodePool import decode_dicom, decode_dicoms
+from Lumos.LRUCache import LRU_Cache
+
+
+preview_levels = (2, 4, 8)
+
+# process-wide cache of loaded previews, keyed by (sop, level)
+preview_cache = LRU_Cache(max_bytes=64*1024**2, sizeof=lambda v: v[0].nbytes)
+
+
+def get_normalize_params(dcm):
+    """Rescale and window tags of a dicom needed for image normalization
+
+    Returns:
+        dict: slope, intercept, window center and window width (None if not available)
+    """
+    params = dict()
+    for name, tag in [('slope', (0x0028, 0x1053)), ('intercept', (0x0028, 0x1052)), ('center', (0x0028, 0x1050)), ('width', (0x0028, 0x1051))]:
+        try:
+            value = dcm[tag].value
+            params[name] = float(value[0] if isinstance(value, pydicom.multival.MultiValue) else value)
+        except: params[name] = None
+    return params
+
+
+def to_uint8(img, params):
+    """Windowed (or min-max scaled if the dicom has no window) grayscale uint8 image"""
+    img = np.asarray(img, dtype=np.float32)
+    if img.ndim==3: img = img.mean(axis=-1) if img.shape[-1] in (3, 4) else img[0]
+    if params.get('slope')     is not None: img = img * params['slope']
+    if params.get('intercept') is not None: img = img + params['intercept']
+    if params.get('center') is not None and params.get('width'):
+        lo, hi = params['center'] - params['width']/2, params['center'] + params['width']/2
+    else: lo, hi = float(img.min()), float(img.max())
+    img = (img - lo) * (255 / max(hi - lo, 1e-6))
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def downsample(img, factor):
+    """Block mean downsampling, edges are padded to a multiple of factor"""
+    h, w = img.shape
+    img  = np.pad(img, ((0, -h % factor), (0, -w % factor)), mode='edge')
+    return img.reshape(img.shape[0]//factor, factor, img.shape[1]//factor, factor).mean(axis=(1, 3)).round().astype(np.uint8)
+
+
+def make_previews(img, params, levels=preview_levels):
+    """Preview pyramid of an image
+
+    Returns:
+        dict: level -> uint8 image downsampled by level (each level is computed from the previous one)
+    """
+    previews, prev, prev_level = dict(), to_uint8(img, params), 1
+    for level in sorted(levels):
+        prev = downsample(prev, level//prev_level) if level%prev_level==0 else downsample(to_uint8(img, params), level)
+        previews[level], prev_level = prev, level
+    return previews
+
+
+def build_preview_file(path, folder_path, levels=preview_levels):
+    """Decodes a dicom and stores its preview pyramid in folder_path (picklable, used by ingestion worker processes)
+
+    Returns:
+        (str, str, str): path, sop (None on failure), error (None on success)
+    """
+    try:
+        mtime    = os.stat(path).st_mtime
+        dcm, img = decode_dicom(path)
+        sop      = dcm.SOPInstanceUID
+        write_previews(get_preview_path(folder_path, sop), make_previews(img, get_normalize_params(dcm), levels), img.shape[:2], mtime)
+        return path, sop, None
+    except Exception as e: return path, None, traceback.format_exc(limit=1)
+
+
+def get_preview_path(folder_path, sop):
+    return os.path.join(folder_path, 'previews', hashlib.sha1(sop.encode()).hexdigest()+'.npz')
+
+
+def write_previews(preview_path, previews, shape, mtime):
+    os.makedirs(os.path.dirname(preview_path), exist_ok=True)
+    tmp_path = preview_path + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, shape=np.array(shape), mtime=np.array(mtime), **{'l%d'%l: p for l, p in previews.items()})
+    os.replace(tmp_path, preview_path)
+
+
+class Pixel_Cache:
+    """Pixel_Cache materializes image stacks as memory mapped .npy files
+
+    Note:
+        Stacks are identified by their sop grid (organizers built from sops share imagetype 'Unknown'). When the stacks
+        exceed max_bytes, the least recently opened ones are deleted (the sidecar's mtime marks the last use).
+
+    Args:
+        folder_path (str): cache folder
+        check_interval (float): seconds after which opened stacks are checked against the source files' mtimes again
+        max_bytes (int): size budget of the stored stacks (previews are not counted), None for no limit
+
+    Attributes:
+        stacks (dict): stack key -> (memmap, sidecar dict, time of last check)
+        stack_locks (dict): stack key -> lock held while a stack is opened or built
+        failed (dict): stack key -> error of stacks that could not be built (not retried until invalidate)
+    """
+    def __init__(self, folder_path, check_interval=5.0, max_bytes=8*1024**3):
+        self.folder_path    = folder_path
+        self.check_interval = check_interval
+        self.max_bytes      = max_bytes
+        self.stacks         = dict()
+        self.lock           = threading.RLock()
+        self.stack_locks    = dict()
+        self.failed         = dict()
+        os.makedirs(folder_path, exist_ok=True)
+
+    def get_key(self, imgo):
+        return hashlib.sha1(json.dumps(self.get_sop_grid(imgo)).encode()).hexdigest()
+
+    def get_paths(self, key):
+        return os.path.join(self.folder_path, key+'.npy'), os.path.join(self.folder_path, key+'.json')
+
+    def get_sop_grid(self, imgo):
+        return [[imgo.depthandtime2sop.get((d, p)) for p in range(imgo.nr_phases)] for d in range(imgo.nr_slices)]
+
+    def get_source_paths(self, imgo):
+        sops = list(imgo.depthandtime2sop.values())
+        return {j['sop']: j['path'] for j in imgo.db.dcm_coll.find({'sop': {'$in': sops}}, {'_id': 0, 'sop': 1, 'path': 1})}
+
+    def is_valid(self, imgo, sidecar):
+        if sidecar is None or sidecar['sops']!=self.get_sop_grid(imgo) or 'shapes' not in sidecar: return False
+        try:    return all(os.stat(p).st_mtime==mtime for p, mtime in sidecar['mtimes'].items())
+        except: return False
+
+    def get_stack(self, imgo):
+        """Returns the stack of raw pixel values of an image organizer, decodes and stores it if necessary
+
+        Note:
+            Images smaller than the largest image of the stack are zero-padded (see get_image for cropped images).
+
+        Returns:
+            (np.memmap, dict): (slices, phases, H, W) copy-on-write memmap, normalization params per sop,
+                None if the stack cannot be built (e.g. a missing or unreadable dicom)
+        """
+        opened = self.open(imgo)
+        return None if opened is None else (opened[0], opened[1]['params'])
+
+    def get_image(self, imgo, slice_nr, phase_nr):
+        """Returns the raw pixel values of one image (cropped to its size) and its normalization params, None if not available"""
+        opened = self.open(imgo)
+        if opened is None: return None
+        stack, sidecar = opened
+        sop = imgo.depthandtime2sop[(slice_nr, phase_nr)]
+        h, w = sidecar['shapes'][sop]
+        return stack[slice_nr, phase_nr, :h, :w], sidecar['params'][sop]
+
+    def open(self, imgo):
+        key = self.get_key(imgo)
+        with self.lock: stack_lock = self.stack_locks.setdefault(key, threading.Lock())
+        with stack_lock: # one build per stack, other stacks stay accessible (e.g. while prefetching in the background)
+            if key in self.failed: return None
+            if key in self.stacks:
+                stack, sidecar, checked = self.stacks[key]
+                if time.time()-checked < self.check_interval: return stack, sidecar
+                if self.is_valid(imgo, sidecar): self.stacks[key] = (stack, sidecar, time.time()); return stack, sidecar
+            npy_path, json_path = self.get_paths(key)
+            sidecar = None
+            try:
+                with open(json_path) as f: sidecar = json.load(f)
+                os.utime(json_path) # last use for the size budget
+            except: pass
+            try:
+                if not self.is_valid(imgo, sidecar) or not os.path.exists(npy_path):
+                    sidecar = self.build(imgo, npy_path, json_path)
+                    self.cleanup(keep=key)
+                stack = np.load(npy_path, mmap_mode='c')
+            except Exception as e:
+                self.failed[key] = traceback.format_exc()
+                print(self.failed[key])
+                return None
+            self.stacks[key] = (stack, sidecar, time.time())
+            return stack, sidecar
+
+    def build(self, imgo, npy_path, json_path):
+        sop_paths = self.get_source_paths(imgo)
+        sop_grid  = self.get_sop_grid(imgo)
+        missing   = [sop for sops in sop_grid for sop in sops if sop is not None and sop not in sop_paths]
+        if len(missing)>0: raise KeyError('No dicom documents for %d sops, e.g. %s' % (len(missing), missing[0]))
+        mtimes    = {p: os.stat(p).st_mtime for p in sop_paths.values()}
+        imgs, params = dict(), dict()
+        sops = list(sop_paths.keys())
+        for sop, (dcm, img) in zip(sops, decode_dicoms([sop_paths[sop] for sop in sops])):
+            imgs[sop], params[sop] = img, get_normalize_params(dcm)
+        h = max(img.shape[0] for img in imgs.values())
+        w = max(img.shape[1] for img in imgs.values())
+        tmp_suffix = '.%d.%d.tmp' % (os.getpid(), threading.get_ident()) # stacks may be built by several processes at once
+        tmp_path = npy_path + tmp_suffix + '.npy'
+        stack = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.result_type(*imgs.values()), shape=(imgo.nr_slices, imgo.nr_phases, h, w))
+        for d, sops in enumerate(sop_grid):
+            for p, sop in enumerate(sops):
+                if sop is None: continue
+                img = imgs[sop]
+                stack[d, p, :img.shape[0], :img.shape[1]] = img
+        stack.flush(); del stack
+        os.replace(tmp_path, npy_path)
+        sidecar = {'studyuid': imgo.studyuid, 'imagetype': imgo.imagetype, 'stack_nr': imgo.stack_nr, 'sops': sop_grid, 'mtimes': mtimes,
+                   'params': params, 'shapes': {sop: list(img.shape[:2]) for sop, img in imgs.items()}}
+        with open(json_path+tmp_suffix, 'w') as f: json.dump(sidecar, f)
+        os.replace(json_path+tmp_suffix, json_path)
+        return sidecar
+
+    def cleanup(self, keep=None):
+        """Deletes the least recently used stacks until the stored stacks fit into max_bytes
+
+        Returns:
+            int: number of deleted stacks
+        """
+        if self.max_bytes is None: return 0
+        entries = []
+        for name in os.listdir(self.folder_path):
+            if not name.endswith('.npy') or '.tmp' in name: continue
+            key = name[:-4]
+            npy_path, json_path = self.get_paths(key)
+            try:    entries.append((os.stat(json_path).st_mtime if os.path.exists(json_path) else 0, os.stat(npy_path).st_size, key))
+            except: continue
+        total, nr_deleted = sum(e[1] for e in entries), 0
+        for _, size, key in sorted(entries):
+            if total<=self.max_bytes: break
+            if key==keep: continue
+            if self.remove(key): total -= size; nr_deleted += 1
+        return nr_deleted
+
+    def remove(self, key):
+        with self.lock: self.stacks.pop(key, None)
+        try:
+            for path in self.get_paths(key):
+                if os.path.exists(path): os.remove(path)
+            return True
+        except: return False # e.g. still mapped on Windows
+
+    def clear(self):
+        """Deletes all stored stacks and previews"""
+        with self.lock:
+            self.stacks.clear(); self.failed.clear()
+            for name in os.listdir(self.folder_path):
+                if name.endswith('.npy') or name.endswith('.json'): self.remove(name.rsplit('.', 1)[0])
+        shutil.rmtree(os.path.join(self.folder_path, 'previews'), ignore_errors=True)
+        preview_cache.clear()
+
+    def get_preview(self, sop, path, level=4):
+        """Returns the preview of a sop at 1/level scale, builds and stores the sop's pyramid if missing or outdated
+
+        Args:
+            sop (str): SOPInstanceUID
+            path (str): path of the dicom file
+            level (int): one of preview_levels
+
+        Returns:
+            (np.ndarray, (int, int)): uint8 preview, (height, width) of the full resolution image
+        """
+        cached = preview_cache.get((sop, level))
+        if cached is not None: return cached
+        preview_path = get_preview_path(self.folder_path, sop)
+        try:
+            with np.load(preview_path) as f:
+                if float(f['mtime'])!=os.stat(path).st_mtime: raise ValueError('outdated')
+                preview = (f['l%d'%level], tuple(int(x) for x in f['shape']))
+        except:
+            _, _, error = build_preview_file(path, self.folder_path)
+            if error is not None: raise RuntimeError(error)
+            with np.load(preview_path) as f: preview = (f['l%d'%level], tuple(int(x) for x in f['shape']))
+        preview[0].flags.writeable = False
+        preview_cache.put((sop, level), preview)
+        return preview
+
+    def invalidate(self, imgo=None):
+        """Forgets opened and failed stacks (of imgo, or all) so they are checked against their source files on the next access"""
+        with self.lock:
+            if imgo is None: self.stacks.clear(); self.failed.clear()
+            else:            self.stacks.pop(self.get_key(imgo), None); self.failed.pop(self.get_key(imgo), None)
+
+
+# process-wide pixel cache, disabled with set_pixel_cache_folder(None)
+pixel_cache_folder = os.environ.get('LUMOS_PIXEL_CACHE', os.path.join(os.path.expanduser('~'), '.lumos', 'pixel_cache'))
+pixel_cache_max_bytes = int(float(os.environ.get('LUMOS_PIXEL_CACHE_GB', 8)) * 1024**3)
+pixel_cache        = None
+
+def set_pixel_cache_folder(folder_path, max_bytes=None):
+    """Sets the folder (and optionally the size budget in bytes) of the process-wide pixel cache, None disables the cache"""
+    global pixel_cache_folder, pixel_cache_max_bytes, pixel_cache
+    pixel_cache_folder, pixel_cache = folder_path, None
+    if max_bytes is not None: pixel_cache_max_bytes = max_bytes
+
+def clear_pixel_cache():
+    """Deletes all stacks and previews of the process-wide pixel cache"""
+    cache = get_pixel_cache()
+    if cache is not None: cache.clear()
+
+def get_pixel_cache():
+    """Returns the process-wide Pixel_Cache, None if disabled or the cache folder cannot be created"""
+    global pixel_cache_folder, pixel_cache
+    if pixel_cache is None and pixel_cache_folder is not None:
+        try:    pixel_cache = Pixel_Cache(pixel_cache_folder, max_bytes=pixel_cache_max_bytes)
+        except: print(traceback.format_exc()); pixel_cache_folder = None
+    return pixel_cache
+
+def get_previews(quad, sops, level=4, nr_workers=8):
+    """Previews of sops at 1/level scale, missing pyramids are built in parallel threads
+
+    Note:
+        Without pixel cache the previews are computed from the dicoms and not stored.
+
+    Returns:
+        list of (np.ndarray, (int, int)): uint8 preview and full resolution (height, width) per sop, None if unreadable
+    """
+    paths = {j['sop']: j['path'] for j in quad.dcm_coll.find({'sop': {'$in': list(sops)}}, {'_id': 0, 'sop': 1, 'path': 1})}
+    cache = get_pixel_cache()
+    def get(sop):
+        try:
+            if cache is not None: return cache.get_preview(sop, paths[sop], level)
+            dcm, img = decode_dicom(paths[sop])
+            return make_previews(img, get_normalize_params(dcm), [level])[level], img.shape[:2]
+        except: print(traceback.format_exc()); return None
+    if nr_workers<=1 or len(sops)<2: return [get(sop) for sop in sops]
+    with ThreadPoolExecutor(max_workers=min(nr_workers, len(sops))) as executor: return list(executor.map(get, sops))
+
+def get_preview_or_image(quad, sop, level=4):
+    """Preview of a sop at 1/level scale, the full resolution pixel values if no preview can be built
+
+    Returns:
+        (np.ndarray, (int, int)): preview (or image) and full resolution (height, width)
+    """
+    preview = get_previews(quad, [sop], level)[0]
+    if preview is not None: return preview
+    img = pydicom.dcmread(quad.dcm_coll.find_one({'sop': sop}, {'_id': 0, 'path': 1})['path']).pixel_array
+    return img, img.shape[:2]
@@ -1,6 +1,7 @@
 import pymongo
 from   pymongo import MongoClient
 from   pymongo import IndexModel
+from   pymongo import UpdateOne, ReplaceOne
 
 import os
 import json
@@ -9,12 +10,22 @@ from pathlib import Path
 import traceback
 
 from Lumos.utils import *
+from Lumos.Annotation import annotation_cache, get_cache_key, add_wkb, get_content_hash
+from Lumos.Storage import *
+from Lumos.Ingestion import ingest_dicom_folder, ingest_anno_folder, backfill_demographics
+
+
+# bump when indexes (or other schema changes) are added, ensure_schema then migrates each database once
+SCHEMA_VERSION  = 3
+ensured_schemas = set()
 
 
 class QUAD_Manager:
-    def __init__(self):
-        self.client    = MongoClient()
-        self.db        = self.client['Lumos_CMR_QualityAssuranceDatabase'] 
+    def __init__(self, uri=None, dbname='Lumos_CMR_QualityAssuranceDatabase', migrate=True, backend=None):
+        # backend: Storage_Backend (e.g. SQLite_Backend(folder_path)), default: Mongo_Backend(uri) or set_default_backend
+        if backend is None: backend = Mongo_Backend(uri) if uri is not None else get_default_backend()
+        self.backend   = backend
+        self.db        = self.backend.get_database(dbname)
         self.dcm_coll  = self.db['dicoms']
         self.anno_coll = self.db['annotations']
         self.imgo_coll = self.db['image_organizers']
@@ -23,7 +34,23 @@ class QUAD_Manager:
         self.coho_coll = self.db['cohorts']
         self.pers_coll = self.db['persons'] # rename to actors = NI or AI
         self.task_coll = self.db['task_environments'] # links to readers and 
+        self.meta_coll = self.db['metadata'] # schema version
+        self.mani_coll = self.db['import_manifest'] # imported files (path, size, mtime, hash)
+        self.memo_coll = self.db['clinical_result_memo'] # clinical results by evaluation and annotation content hash
+        if migrate: self.ensure_schema()
         
+    def ensure_schema(self):
+        # creates the indexes once per database version, afterwards only checked once per process
+        key = (os.getpid(), self.backend.identity(), self.db.name)
+        if key in ensured_schemas: return
+        schema = self.meta_coll.find_one({'_id': 'schema'})
+        if schema is None or schema['version'] < SCHEMA_VERSION:
+            self.create_indexes()
+            if schema is None or schema['version'] < 3: self.backfill_content_hash() # content hashes of the clinical result memo
+            self.meta_coll.update_one({'_id': 'schema'}, {'$set': {'version': SCHEMA_VERSION}}, upsert=True)
+        ensured_schemas.add(key)
+        
+    def create_indexes(self):
         # DICOMS
         index_dicom_sop = IndexModel([('sop', 1)], unique=True)
         index_study = IndexModel([('studyuid', 1)])
@@ -61,40 +88,94 @@ class QUAD_Manager:
         # TASK ENVIRONMENTS
         # require no unique ids
         
+        # IMPORT MANIFEST
+        self.db['import_manifest'].create_index([('kind', 1), ('path', 1)], unique=True)
+        
+        # CLINICAL RESULT MEMO
+        self.db['clinical_result_memo'].create_index([('task_id', 1), ('studyuid', 1), ('imagetype', 1), ('stack_nr', 1)], unique=True)
         
         
     def _drop_collections(self):
         for coll_name in self.db.list_collection_names():
             self.db[coll_name].drop_indexes()
             self.db[coll_name].drop()
+        ensured_schemas.clear()
     
     
-    def insert_dicom(self, dcm):
+    def insert_dicom(self, dcm, path=None):
+        # lean header document (dcm_to_json), pixel data and other bulk elements are not stored
         try: 
-            dcm_json  = json.loads(dcm.to_json())
-            fmeta = json.loads(dcm.file_meta.to_json())
-            dcm_json['file_meta']  = fmeta
-            dcm_json['sop']        = dcm.SOPInstanceUID
-            dcm_json['seriesuid']  = dcm.SeriesInstanceUID
-            dcm_json['seriesdescription'] = dcm.SeriesDescription
-            dcm_json['studyuid']   = dcm.StudyInstanceUID
-            try:    dcm_json['imagetype'] = dcm[0x0b, 0x10].value.replace('Lazy Luna: ', '') # try ll tag import =)
-            except: dcm_json['imagetype'] = 'Unknown'
+            dcm_json = dcm_to_json(dcm, path if path is not None else str(dcm.filename))
             self.dcm_coll.insert_one(dcm_json)
         except Exception as e: print(traceback.format_exc())
         
+    def migrate_dicom_headers(self, batch_size=500):
+        # one-off migration: replaces full DICOM JSON documents (with file_meta and bulk data) by lean header documents
+        is_tag = lambda k: len(k)==8 and all(c in '0123456789ABCDEFabcdef' for c in k)
+        nr_migrated, requests = 0, []
+        for doc in self.dcm_coll.find({'file_meta': {'$exists': True}}, {'7FE00010': 0, '7fe00010': 0}):
+            try:
+                tags = {k: v for k,v in doc.items() if is_tag(k) and isinstance(v, dict) and 'InlineBinary' not in v and 'BulkDataURI' not in v}
+                lean = dcm_to_json(pydicom.Dataset.from_json(tags), doc.get('path'))
+                lean.update({k: v for k,v in doc.items() if not is_tag(k) and k!='file_meta'})
+                requests.append(ReplaceOne({'_id': doc['_id']}, lean))
+            except Exception as e: print(traceback.format_exc()); continue
+            if len(requests)>=batch_size: nr_migrated += self.dcm_coll.bulk_write(requests, ordered=False).modified_count; requests = []
+        if len(requests)>0: nr_migrated += self.dcm_coll.bulk_write(requests, ordered=False).modified_count
+        return nr_migrated
+        
+    def backfill_demographics(self, batch_size=500, nr_workers=None, verbose=True):
+        # one-off backfill: patient demographics into header documents without them and into the case documents (see Lumos.Ingestion)
+        return backfill_demographics(self, batch_size=batch_size, nr_workers=nr_workers, verbose=verbose)
+        
+    def prepare_anno(self, json_anno, task_id, studyuid, sop):
+        # annotation document as stored: ids and binary (WKB) geometries
+        json_anno['task_id']   = task_id
+        json_anno['studyuid']  = studyuid
+        json_anno['sop']       = sop
+        return add_wkb(json_anno)
+        
     def insert_anno(self, json_anno, task_id, studyuid, sop):
         try:
-            json_anno['task_id']   = task_id
-            json_anno['studyuid']  = studyuid
-            json_anno['sop']       = sop
-            self.anno_coll.insert_one(json_anno)
+            self.anno_coll.insert_one(self.prepare_anno(json_anno, task_id, studyuid, sop))
+            annotation_cache.pop(get_cache_key(self, task_id, sop))
         except Exception as e: return; print(traceback.format_exc())
+        
+    def replace_anno(self, json_anno, task_id, studyuid, sop):
+        # inserts or overwrites the annotation of (task_id, sop)
+        self.anno_coll.replace_one({'task_id': task_id, 'sop': sop}, self.prepare_anno(json_anno, task_id, studyuid, sop), upsert=True)
+        annotation_cache.pop(get_cache_key(self, task_id, sop))
+            
+    def migrate_anno_wkb(self, batch_size=500):
+        # one-off backfill: adds binary (WKB) geometries to annotations that only have GeoJSON
+        nr_updated, updates = 0, []
+        for anno in self.anno_coll.find({'has_wkb': {'$exists': False}}):
+            try:
+                add_wkb(anno)
+                fields = {k+'.cont_wkb': v['cont_wkb'] for k,v in anno.items() if isinstance(v, dict) and 'cont_wkb' in v}
+                fields['has_wkb'], fields['content_hash'] = True, anno['content_hash']
+                updates.append(UpdateOne({'_id': anno['_id']}, {'$set': fields}))
+            except Exception as e: print(traceback.format_exc()); continue
+            if len(updates)>=batch_size: nr_updated += self.anno_coll.bulk_write(updates, ordered=False).modified_count; updates = []
+        if len(updates)>0: nr_updated += self.anno_coll.bulk_write(updates, ordered=False).modified_count
+        annotation_cache.clear()
+        return nr_updated
+            
+    def backfill_content_hash(self, batch_size=500):
+        # one-off backfill: content hashes of annotations stored before they were introduced (also those migrated to WKB earlier)
+        nr_updated, updates = 0, []
+        for anno in self.anno_coll.find({'content_hash': {'$exists': False}}):
+            try:    updates.append(UpdateOne({'_id': anno['_id']}, {'$set': {'content_hash': get_content_hash(anno)}}))
+            except Exception as e: print(traceback.format_exc()); continue
+            if len(updates)>=batch_size: nr_updated += self.anno_coll.bulk_write(updates, ordered=False).modified_count; updates = []
+        if len(updates)>0: nr_updated += self.anno_coll.bulk_write(updates, ordered=False).modified_count
+        annotation_cache.clear()
+        return nr_updated
             
     def insert_img_o(self, img_o):
         try:
             imgo_dict = img_o.__dict__
-            imgo_dict.pop('db'); imgo_dict.pop('depthandtime2sop')
+            imgo_dict.pop('db'); imgo_dict.pop('depthandtime2sop'); imgo_dict.pop('sop2geometry', None)
             self.imgo_coll.insert_one(imgo_dict)
         except Exception as e: return; print(traceback.format_exc())
         
@@ -104,6 +185,9 @@ class QUAD_Manager:
             eva_dict.pop('db')
             eva_dict.pop('imgo')
             eva_dict.pop('depthandtime2sop')
+            eva_dict.pop('anno_store', None)
+            eva_dict.pop('summary', None)
+            eva_dict.pop('cr_memo', None)
             self.eval_coll.insert_one(eva_dict)
             print('EVA DICT: ', eva_dict)
         except Exception as e: print(traceback.format_exc()); return; 
@@ -119,23 +203,17 @@ class QUAD_Manager:
     def insert_cohort(self, cohort): # currently just a dictionary
         self.coho_coll.insert_one(cohort)
 
-    def insert_dicom_folder(quad, folder_path):
-        studyuids = set()
-        for i_p, p in enumerate(Path(folder_path).glob('**/*.dcm')):
-            try:
-                dcm = pydicom.dcmread(str(p), stop_before_pixels=False)
-                dcmjson = dcm_to_json(dcm, str(p))
-                studyuids.add(dcmjson['studyuid'])
-                if len(studyuids)>1: break
-                quad.dcm_coll.insert_one(dcmjson)
-            except: print(traceback.format_exc()); continue
+    def insert_dicom_folder(self, folder_path, batch_size=500, nr_workers=None, studyuids=None, use_manifest=True, use_hash=False,
+                            build_previews=False, verbose=True):
+        # header-only parallel reads and batched inserts of new and changed files in folder_path (see Lumos.Ingestion)
+        return ingest_dicom_folder(self, folder_path, batch_size=batch_size, nr_workers=nr_workers, studyuids=studyuids,
+                                   use_manifest=use_manifest, use_hash=use_hash, build_previews=build_previews, verbose=verbose)
     
-    def insert_anno_folder(self, folder_path, task_id, studyuid):
-        for i_p, p in enumerate(Path(folder_path).glob('**/*.json')):
-            try:
-                sop = os.path.basename(p).replace('.json','')
-                self.insert_anno(json.load(open(p)), task_id, studyuid, sop)
-            except: print(traceback.format_exc()); continue
+    def insert_anno_folder(self, folder_path, task_id, studyuid, batch_size=500, nr_workers=None, validate=False, upsert=False,
+                           use_manifest=True, use_hash=False, verbose=True):
+        # parallel parsing and batched writes of new and changed annotation files (see Lumos.Ingestion)
+        return ingest_anno_folder(self, folder_path, task_id, studyuid, batch_size=batch_size, nr_workers=nr_workers, validate=validate,
+                                  upsert=upsert, use_manifest=use_manifest, use_hash=use_hash, verbose=verbose)
                 
     def insert_person(self, person_dict):
         try: self.pers_coll.insert_one(person_dict)
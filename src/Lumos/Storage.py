@@ -0,0 +1,533 @@
+####################
+# Storage Backends #
+####################
+
+# QUAD_Manager works on database objects that behave like pymongo databases (db[collection_name]).
+# Two backends are available:
+#   - Mongo_Backend:  pymongo databases on a (shared) MongoClient
+#   - SQLite_Backend: embedded, file-based databases without server (single workstation analyses, CI, benchmarks)
+# The SQLite collections cover the operations Lumos uses: find/find_one (equality, $in, $nin, $ne, $exists,
+# $and, $or, projections), insert_one/insert_many, update_one/update_many ($set, $unset), replace_one,
+# delete_one/delete_many, bulk_write, count_documents, distinct and indexes (unique constraints are enforced).
+
+import os
+import re
+import copy
+import sqlite3
+import threading
+
+import bson
+from bson import ObjectId
+from pymongo import MongoClient, InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from pymongo.results import InsertOneResult, InsertManyResult, UpdateResult, DeleteResult, BulkWriteResult
+
+
+##########################
+# Shared Mongo Clients   #
+##########################
+
+# Shared connection pools: one MongoClient per process and connection settings
+client_settings = {'host': None, 'maxPoolSize': 100, 'serverSelectionTimeoutMS': 5000, 'connectTimeoutMS': 5000}
+clients         = dict()
+clients_lock    = threading.Lock()
+
+
+def configure_client(uri=None, max_pool_size=100, server_selection_timeout_ms=5000, connect_timeout_ms=5000):
+    """Sets the default connection settings for QUAD_Manager
+
+    Args:
+        uri (str): MongoDB connection string, None for localhost:27017
+        max_pool_size (int): maximum number of pooled connections
+        server_selection_timeout_ms (int): timeout for finding a server in milliseconds
+        connect_timeout_ms (int): timeout for opening a connection in milliseconds
+    """
+    client_settings.update({'host': uri, 'maxPoolSize': max_pool_size,
+                            'serverSelectionTimeoutMS': server_selection_timeout_ms, 'connectTimeoutMS': connect_timeout_ms})
+
+def get_client(**settings):
+    """Returns the shared MongoClient for the default settings (updated by settings)
+
+    Note:
+        Clients are created once per process (MongoClient is not fork-safe) and reused by all QUAD_Managers.
+
+    Returns:
+        pymongo.MongoClient: client with connection pool
+    """
+    settings = dict(client_settings, **settings)
+    key = (os.getpid(),) + tuple(sorted(settings.items(), key=lambda kv: kv[0]))
+    with clients_lock:
+        if key not in clients: clients[key] = MongoClient(**settings)
+        return clients[key]
+
+
+####################
+# Backend classes  #
+####################
+
+class Storage_Backend:
+    """Storage_Backend is the interface QUAD_Manager uses to access databases
+
+    Note:
+        get_database returns an object that provides db[collection_name], db.name and db.list_collection_names().
+        Collections provide the pymongo collection methods listed at the top of this module.
+    """
+    def get_database(self, dbname):
+        """Returns the database called dbname (created on first use)"""
+        raise NotImplementedError
+
+    def identity(self):
+        """Hashable identity of the storage location (equal for backends that share their databases)"""
+        return id(self)
+
+
+class Mongo_Backend(Storage_Backend):
+    """Mongo_Backend provides pymongo databases on the shared MongoClient
+
+    Args:
+        uri (str): MongoDB connection string, None for the configured default (see configure_client)
+        settings (kwargs): further MongoClient settings
+    """
+    def __init__(self, uri=None, **settings):
+        if uri is not None: settings['host'] = uri
+        self.client = get_client(**settings)
+
+    def get_database(self, dbname):
+        return self.client[dbname]
+
+    def identity(self):
+        return ('mongo', id(self.client))
+
+
+class SQLite_Backend(Storage_Backend):
+    """SQLite_Backend provides embedded databases stored as one SQLite file per database
+
+    Args:
+        folder_path (str): folder containing the database files (<dbname>.sqlite), ':memory:' for in-memory databases
+    """
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.databases   = dict()
+        self.lock        = threading.Lock()
+        if folder_path != ':memory:': os.makedirs(folder_path, exist_ok=True)
+
+    def get_database(self, dbname):
+        with self.lock:
+            if dbname not in self.databases:
+                path = ':memory:' if self.folder_path==':memory:' else os.path.join(self.folder_path, dbname+'.sqlite')
+                self.databases[dbname] = SQLite_Database(dbname, path)
+            return self.databases[dbname]
+
+    def identity(self):
+        return ('sqlite', id(self)) if self.folder_path==':memory:' else ('sqlite', os.path.abspath(self.folder_path))
+
+
+# process-wide default used by QUAD_Manager() when no backend is passed
+default_backend = None
+
+def set_default_backend(backend):
+    """Sets the backend used by QUAD_Manager() if none is passed (None restores the default Mongo_Backend)"""
+    global default_backend
+    default_backend = backend
+
+def get_default_backend():
+    return default_backend if default_backend is not None else Mongo_Backend()
+
+
+###########################
+# SQLite implementation   #
+###########################
+
+MISSING = object()
+ARRAY   = b'\x00array' # index column value for lists and dicts, such documents are always matched in python
+
+def encode_key(value):
+    """Encodes a value for an index column: equal values (also int / float) have equal keys, None if not indexable"""
+    if value is MISSING or value is None:  return None
+    if isinstance(value, (list, dict)):    return ARRAY
+    if isinstance(value, (int, float)) and not isinstance(value, bool): value = float(value)
+    return bson.encode({'v': value})
+
+def get_field(doc, path):
+    """Returns value at dotted path, MISSING if not available"""
+    for k in path.split('.'):
+        if isinstance(doc, dict) and k in doc: doc = doc[k]
+        else: return MISSING
+    return doc
+
+def set_field(doc, path, value):
+    keys = path.split('.')
+    for k in keys[:-1]: doc = doc.setdefault(k, dict())
+    doc[keys[-1]] = value
+
+def unset_field(doc, path):
+    keys = path.split('.')
+    for k in keys[:-1]:
+        if not isinstance(doc, dict) or k not in doc: return
+        doc = doc[k]
+    if isinstance(doc, dict): doc.pop(keys[-1], None)
+
+def values_equal(value, cond):
+    if value is MISSING: return cond is None
+    if value == cond:    return True
+    return isinstance(value, list) and not isinstance(cond, list) and cond in value
+
+def match_condition(value, cond):
+    if not (isinstance(cond, dict) and len(cond)>0 and all(k.startswith('$') for k in cond)): return values_equal(value, cond)
+    for op, arg in cond.items():
+        if   op=='$eq':     ok = values_equal(value, arg)
+        elif op=='$ne':     ok = not values_equal(value, arg)
+        elif op=='$in':     ok = any(values_equal(value, a) for a in arg)
+        elif op=='$nin':    ok = not any(values_equal(value, a) for a in arg)
+        elif op=='$exists': ok = (value is not MISSING) == bool(arg)
+        elif op in ['$gt', '$gte', '$lt', '$lte']:
+            if value is MISSING or value is None: return False
+            try:    ok = {'$gt': value>arg, '$gte': value>=arg, '$lt': value<arg, '$lte': value<=arg}[op]
+            except: return False
+        else: raise NotImplementedError('SQLite backend does not support query operator: ' + op)
+        if not ok: return False
+    return True
+
+def match(doc, query):
+    """True if doc matches the (pymongo style) query"""
+    for k, cond in (query or dict()).items():
+        if   k=='$and':
+            if not all(match(doc, q) for q in cond): return False
+        elif k=='$or':
+            if not any(match(doc, q) for q in cond): return False
+        elif not match_condition(get_field(doc, k), cond): return False
+    return True
+
+def project(doc, projection):
+    """Applies pymongo style inclusion or exclusion projection"""
+    if projection is None: return doc
+    if isinstance(projection, (list, tuple)): projection = {k: 1 for k in projection}
+    fields = {k: v for k, v in projection.items() if k!='_id'}
+    if all(not v for v in fields.values()): # exclusion (also {'_id': 0} alone)
+        doc = copy.deepcopy(doc)
+        for k in projection: unset_field(doc, k)
+        return doc
+    ret = dict()
+    if projection.get('_id', 1) and '_id' in doc: ret['_id'] = doc['_id']
+    for k in fields:
+        v = get_field(doc, k)
+        if v is not MISSING: set_field(ret, k, copy.deepcopy(v))
+    return ret
+
+def apply_update(doc, update):
+    """Applies $set / $unset update or replaces the document (keeps _id)"""
+    if not any(k.startswith('$') for k in update):
+        return dict({'_id': doc['_id']}, **{k: v for k, v in update.items() if k!='_id'})
+    for op, fields in update.items():
+        for k, v in fields.items():
+            if   op in ['$set', '$setOnInsert']: set_field(doc, k, copy.deepcopy(v))
+            elif op=='$unset':                   unset_field(doc, k)
+            else: raise NotImplementedError('SQLite backend does not support update operator: ' + op)
+    return doc
+
+def equality_fields(query):
+    """Fields fixed by a query (used to build upserted documents)"""
+    ret = dict()
+    for k, cond in (query or dict()).items():
+        if k=='$and':
+            for q in cond: ret.update(equality_fields(q))
+        elif not k.startswith('$') and not (isinstance(cond, dict) and any(c.startswith('$') for c in cond)):
+            ret[k] = cond
+    return ret
+
+
+class SQLite_Database:
+    """SQLite_Database holds the collections of one database file
+
+    Args:
+        name (str): database name
+        path (str): path of the SQLite file
+    """
+    def __init__(self, name, path):
+        self.name        = name
+        self.path        = path
+        self.lock        = threading.RLock()
+        self.connection  = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS "lumos_collections" (name TEXT PRIMARY KEY)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS "lumos_indexes" (collection TEXT, name TEXT, fields TEXT, '
+                                'is_unique INTEGER, PRIMARY KEY (collection, name))')
+        self.collections = dict()
+
+    def __getitem__(self, coll_name):
+        with self.lock:
+            if coll_name not in self.collections: self.collections[coll_name] = SQLite_Collection(self, coll_name)
+            return self.collections[coll_name]
+
+    def get_collection(self, coll_name):
+        return self[coll_name]
+
+    def list_collection_names(self):
+        with self.lock:
+            return [r[0] for r in self.connection.execute('SELECT name FROM "lumos_collections"')]
+
+    def drop_collection(self, coll_name):
+        self[coll_name].drop()
+
+
+class SQLite_Collection:
+    """SQLite_Collection stores documents as BSON, indexed fields get their own (indexed) columns
+
+    Args:
+        database (SQLite_Database): database of the collection
+        name (str): collection name
+    """
+    def __init__(self, database, name):
+        self.database = database
+        self.name     = name
+        self.table    = 'c_' + name
+        self.create_table()
+
+    @property
+    def connection(self):
+        return self.database.connection
+
+    @property
+    def lock(self):
+        return self.database.lock
+
+    def create_table(self):
+        with self.lock:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS "%s" (id BLOB PRIMARY KEY, doc BLOB)' % self.table)
+            self.columns    = {r[1] for r in self.connection.execute('PRAGMA table_info("%s")' % self.table)}
+            self.registered = False
+
+    def register(self):
+        # collections are listed once they hold documents or indexes (as in MongoDB)
+        if self.registered: return
+        self.connection.execute('INSERT OR IGNORE INTO "lumos_collections" VALUES (?)', (self.name,))
+        self.registered = True
+
+    def column(self, field):
+        return 'k_' + re.sub(r'\W', '_', field)
+
+    def field_columns(self):
+        fields = set()
+        for (fields_str,) in self.connection.execute('SELECT fields FROM "lumos_indexes" WHERE collection=?', (self.name,)):
+            fields.update(fields_str.split(','))
+        return {f: self.column(f) for f in fields}
+
+    ###########
+    # Indexes #
+    ###########
+    def create_index(self, keys, unique=False, name=None, **kwargs):
+        if isinstance(keys, str): keys = [(keys, 1)]
+        fields = [k for k, _ in keys]
+        name   = name if name is not None else '_'.join(f+'_1' for f in fields)
+        with self.lock:
+            self.register()
+            indexed = self.field_columns()
+            for f in fields:
+                c = self.column(f)
+                if f in indexed: continue
+                if c not in self.columns:
+                    self.connection.execute('ALTER TABLE "%s" ADD COLUMN "%s" BLOB' % (self.table, c))
+                    self.columns.add(c)
+                rows = self.connection.execute('SELECT id, doc FROM "%s"' % self.table).fetchall()
+                self.connection.executemany('UPDATE "%s" SET "%s"=? WHERE id=?' % (self.table, c),
+                                            [(encode_key(get_field(bson.decode(d), f)), i) for i, d in rows])
+            columns = ', '.join('"%s"' % self.column(f) for f in fields)
+            try:
+                self.connection.execute('CREATE %s INDEX IF NOT EXISTS "%s" ON "%s" (%s)' % ('UNIQUE' if unique else '',
+                                        self.table+'__'+name, self.table, columns))
+            except sqlite3.IntegrityError as e: raise DuplicateKeyError('E11000 duplicate key error building index '+name+': '+str(e), 11000)
+            self.connection.execute('INSERT OR REPLACE INTO "lumos_indexes" VALUES (?, ?, ?, ?)', (self.name, name, ','.join(fields), int(unique)))
+        return name
+
+    def create_indexes(self, indexes):
+        names = []
+        for index in indexes:
+            document = index.document
+            names.append(self.create_index(list(document['key'].items()), unique=document.get('unique', False), name=document['name']))
+        return names
+
+    def index_information(self):
+        info = {'_id_': {'key': [('_id', 1)]}}
+        for name, fields, is_unique in self.connection.execute('SELECT name, fields, is_unique FROM "lumos_indexes" WHERE collection=?', (self.name,)):
+            info[name] = {'key': [(f, 1) for f in fields.split(',')]}
+            if is_unique: info[name]['unique'] = True
+        return info
+
+    def drop_indexes(self):
+        with self.lock:
+            for (name,) in self.connection.execute('SELECT name FROM "lumos_indexes" WHERE collection=?', (self.name,)).fetchall():
+                self.connection.execute('DROP INDEX IF EXISTS "%s"' % (self.table+'__'+name))
+            self.connection.execute('DELETE FROM "lumos_indexes" WHERE collection=?', (self.name,))
+
+    def drop(self):
+        with self.lock:
+            self.drop_indexes()
+            self.connection.execute('DROP TABLE IF EXISTS "%s"' % self.table)
+            self.connection.execute('DELETE FROM "lumos_collections" WHERE name=?', (self.name,))
+            self.create_table()
+
+    ###########
+    # Reading #
+    ###########
+    def prefilter(self, query):
+        # SQL conditions on index columns for equality and $in conditions, the full query is matched in python
+        conditions, params, columns = [], [], self.field_columns()
+        columns['_id'] = 'id'
+        queries = [query or dict()]
+        while len(queries)>0:
+            q = queries.pop()
+            for k, cond in q.items():
+                if k=='$and': queries.extend(cond); continue
+                if k not in columns: continue
+                if isinstance(cond, dict) and set(cond.keys())=={'$in'}: values = list(cond['$in'])
+                elif isinstance(cond, dict) and set(cond.keys())=={'$eq'}: values = [cond['$eq']]
+                elif isinstance(cond, (dict, list)) or cond is None: continue
+                else: values = [cond]
+                keys = [encode_key(v) for v in values]
+                if None in keys or ARRAY in keys or len(keys)>5000: continue
+                c = columns[k]
+                if c=='id': conditions.append('id IN (%s)' % ','.join('?'*len(keys))); params.extend(keys)
+                else: conditions.append('("%s" IN (%s) OR "%s"=?)' % (c, ','.join('?'*len(keys)), c)); params.extend(keys+[ARRAY])
+        return conditions, params
+
+    def find_rows(self, query):
+        conditions, params = self.prefilter(query)
+        sql = 'SELECT doc FROM "%s"' % self.table
+        if len(conditions)>0: sql += ' WHERE ' + ' AND '.join(conditions)
+        with self.lock: rows = self.connection.execute(sql, params).fetchall()
+        for (d,) in rows:
+            doc = bson.decode(d)
+            if match(doc, query): yield doc
+
+    def check_find_options(self, kwargs):
+        # options that change the result are not supported, others (e.g. batch_size, session) have no effect
+        for k in ['sort', 'skip', 'limit', 'hint', 'min', 'max', 'collation', 'cursor_type']:
+            if kwargs.get(k) not in (None, 0): raise NotImplementedError('SQLite backend does not support find option: ' + k)
+
+    def find(self, filter=None, projection=None, **kwargs):
+        self.check_find_options(kwargs)
+        return iter([project(doc, projection) for doc in self.find_rows(filter)])
+
+    def find_one(self, filter=None, projection=None, **kwargs):
+        self.check_find_options(kwargs)
+        if filter is not None and not isinstance(filter, dict): filter = {'_id': filter}
+        for doc in self.find_rows(filter): return project(doc, projection)
+        return None
+
+    def count_documents(self, filter, **kwargs):
+        return sum(1 for _ in self.find_rows(filter))
+
+    def distinct(self, key, filter=None):
+        values = []
+        for doc in self.find_rows(filter):
+            v = get_field(doc, key)
+            if v is MISSING: continue
+            for x in (v if isinstance(v, list) else [v]):
+                if x not in values: values.append(x)
+        return values
+
+    ###########
+    # Writing #
+    ###########
+    def write_row(self, doc, old_id=None):
+        # inserts doc, or overwrites the row of old_id (no INSERT OR REPLACE: it would delete rows conflicting on a unique index)
+        columns = self.field_columns()
+        names   = ['id', 'doc'] + list(columns.values())
+        values  = [encode_key(doc['_id']), bson.encode(doc)] + [encode_key(get_field(doc, f)) for f in columns]
+        if old_id is None: sql = 'INSERT INTO "%s" (%s) VALUES (%s)' % (self.table, ','.join('"%s"' % n for n in names), ','.join('?'*len(names)))
+        else:
+            sql = 'UPDATE "%s" SET %s WHERE id=?' % (self.table, ','.join('"%s"=?' % n for n in names))
+            values.append(encode_key(old_id))
+        self.register()
+        try: self.connection.execute(sql, values)
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError('E11000 duplicate key error collection: '+self.name+' '+str(e), 11000)
+
+    def insert_one(self, document, **kwargs):
+        if '_id' not in document: document['_id'] = ObjectId()
+        with self.lock: self.write_row(document)
+        return InsertOneResult(document['_id'], True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        inserted_ids, errors = [], []
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                for i, document in enumerate(documents):
+                    if '_id' not in document: document['_id'] = ObjectId()
+                    try: self.write_row(document); inserted_ids.append(document['_id'])
+                    except DuplicateKeyError as e:
+                        errors.append({'index': i, 'code': 11000, 'errmsg': str(e), 'op': document})
+                        if ordered: break
+            finally: self.connection.execute('COMMIT')
+        if len(errors)>0:
+            raise BulkWriteError({'writeErrors': errors, 'writeConcernErrors': [], 'nInserted': len(inserted_ids),
+                                  'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []})
+        return InsertManyResult(inserted_ids, True)
+
+    def update(self, filter, update, upsert=False, multi=False, replace=False):
+        with self.lock:
+            docs = list(self.find_rows(filter))
+            if not multi: docs = docs[:1]
+            nr_modified = 0
+            for doc in docs:
+                new_doc = apply_update(copy.deepcopy(doc), update)
+                if new_doc!=doc: self.write_row(new_doc, old_id=doc['_id']); nr_modified += 1
+            raw = {'n': len(docs), 'nModified': nr_modified}
+            if len(docs)==0 and upsert:
+                doc = equality_fields(filter) if not replace else dict()
+                if '_id' in filter and '_id' not in doc: doc['_id'] = filter['_id']
+                if '_id' not in doc: doc['_id'] = update.get('_id', ObjectId()) if replace else ObjectId()
+                doc = apply_update(doc, update)
+                self.write_row(doc)
+                raw = {'n': 1, 'nModified': 0, 'upserted': doc['_id']}
+        return UpdateResult(raw, True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        return self.update(filter, update, upsert=upsert)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        return self.update(filter, update, upsert=upsert, multi=True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        return self.update(filter, replacement, upsert=upsert, replace=True)
+
+    def delete(self, filter, multi=False):
+        with self.lock:
+            docs = list(self.find_rows(filter))
+            if not multi: docs = docs[:1]
+            self.connection.executemany('DELETE FROM "%s" WHERE id=?' % self.table, [(encode_key(d['_id']),) for d in docs])
+        return DeleteResult({'n': len(docs)}, True)
+
+    def delete_one(self, filter, **kwargs):
+        return self.delete(filter)
+
+    def delete_many(self, filter, **kwargs):
+        return self.delete(filter, multi=True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        # supports pymongo's InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne and DeleteMany requests
+        result = {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0,
+                  'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                for i, r in enumerate(requests):
+                    try:
+                        if isinstance(r, InsertOne): self.insert_one(r._doc); result['nInserted'] += 1; continue
+                        if isinstance(r, (DeleteOne, DeleteMany)):
+                            result['nRemoved'] += self.delete(r._filter, multi=isinstance(r, DeleteMany)).deleted_count; continue
+                        if   isinstance(r, ReplaceOne): res = self.update(r._filter, r._doc, upsert=r._upsert, replace=True)
+                        elif isinstance(r, UpdateOne):  res = self.update(r._filter, r._doc, upsert=r._upsert)
+                        elif isinstance(r, UpdateMany): res = self.update(r._filter, r._doc, upsert=r._upsert, multi=True)
+                        else: raise NotImplementedError('SQLite backend does not support request: ' + str(r))
+                        if res.upserted_id is not None:
+                            result['nUpserted'] += 1; result['upserted'].append({'index': i, '_id': res.upserted_id})
+                        else: result['nMatched'] += res.matched_count; result['nModified'] += res.modified_count
+                    except DuplicateKeyError as e:
+                        result['writeErrors'].append({'index': i, 'code': 11000, 'errmsg': str(e)})
+                        if ordered: break
+            finally: self.connection.execute('COMMIT')
+        if len(result['writeErrors'])>0: raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
@@ -8,33 +8,30 @@ from Lumos.Metrics import *
 
 
 class CC_StatsOverviewTable(Table):
-    def get_dcm(self, cc):
-        case = cc.case1
-        for k in case.all_imgs_sop2filepath.keys():
-            try: sop = next(iter(case.all_imgs_sop2filepath[k]))
-            except: continue
-            return pydicom.dcmread(case.all_imgs_sop2filepath[k][sop])
+    def get_info(self, cc):
+        # [name, age, sex, weight, size] stored with the case (no file reads)
+        return cc.case1.get_patient_info()
     def get_age(self, cc):
         try:
-            age = self.get_dcm(cc).data_element('PatientAge').value
+            age = self.get_info(cc)[1]
             age = float(age[:-1]) if age!='' else np.nan
         except: age=np.nan
         return age
     def get_gender(self, cc):
         try:
-            gender = self.get_dcm(cc).data_element('PatientSex').value
+            gender = self.get_info(cc)[2]
             gender = gender if gender in ['M','F'] else np.nan
         except: gender=np.nan
         return gender
     def get_weight(self, cc):
         try:
-            weight = self.get_dcm(cc).data_element('PatientWeight').value
+            weight = self.get_info(cc)[3]
             weight = float(weight) if weight is not None else np.nan
         except: weight=np.nan
         return weight
     def get_height(self, cc):
         try:
-            h = self.get_dcm(cc).data_element('PatientSize').value
+            h = self.get_info(cc)[4]
             h = np.nan if h is None else float(h)/100 if float(h)>3 else float(h)
         except: h=np.nan
         return h
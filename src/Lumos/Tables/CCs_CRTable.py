@@ -73,7 +73,7 @@ class CC_ClinicalResultsTable(Table):
                 for cat1, cat2 in zip(cats1, cats2):
                     try:
                         p1, p2 = cat1.phase, cat2.phase
-                        dcm = cat1.get_dcm(d, p1)
+                        dcm = cat1.get_geometry(d, p1)
                         anno1, anno2 = cat1.get_anno(d, p1), cat2.get_anno(d, p2)
                         cont1, cont2 = anno1.get_contour(cn), anno2.get_contour(cn)
                         dsc       = dsc_m.get_val(cont1, cont2, dcm, string=False)
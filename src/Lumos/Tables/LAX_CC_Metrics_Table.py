@@ -25,7 +25,7 @@ class LAX_CC_Metrics_Table(Table):
         for cat1, cat2 in zip(cats1, cats2):
             try:
                 p1, p2 = (cat1.phase, cat2.phase) if not fixed_phase_first_reader else (cat1.phase, cat1.phase)
-                dcm = cat1.get_dcm(0, p1)
+                dcm = cat1.get_geometry(0, p1)
                 anno1, anno2 = cat1.get_anno(0, p1), cat2.get_anno(0, p2)
                 cont1, cont2 = anno1.get_contour(contname), anno2.get_contour(contname)
                 area_diff = areadiff_m.get_val(cont1, cont2, dcm, string=pretty)
@@ -36,7 +36,7 @@ class Metrics_Overview_Table(Table):
                     if eval1.name==eval2.name:
                         for d in range(eval1.nr_slices):
                             try:
-                                dcm          = eval1.get_dcm(d, p1)
+                                dcm          = eval1.get_geometry(d, p1)
                                 anno1, anno2 = eval1.get_anno(d, p1), eval2.get_anno(d, p2)
                                 cont1, cont2 = anno1.get_contour(contname), anno2.get_contour(contname)
             
@@ -63,7 +63,7 @@ class Metrics_Overview_Table(Table):
                     if eval1.name==eval2.name:
                         for d in range(eval1.nr_slices):
                             try:
-                                dcm          = eval1.get_dcm(d, p1)
+                                dcm          = eval1.get_geometry(d, p1)
                                 anno1, anno2 = eval1.get_anno(d, p1), eval2.get_anno(d, p2)
                                 cont1, cont2 = anno1.get_contour(contname), anno2.get_contour(contname)
             
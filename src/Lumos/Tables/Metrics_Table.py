@@ -10,13 +10,13 @@ from Lumos.Metrics import *
 
 class Metrics_Table(Table):
     def _is_apic_midv_basal_outside(self, eva, d, p, cont_name):
-        anno = eva.get_anno(d, p)
-        has_cont = anno.has_contour(cont_name)
+        summary  = eva.get_summary()
+        has_cont = summary.has_contour(cont_name, d, p)
         if not has_cont:                    return 'outside'
         if has_cont and d==0:               return 'basal'
         if has_cont and d==eva.nr_slices-1: return 'apical'
-        prev_has_cont = eva.get_anno(d-1, p).has_contour(cont_name)
-        next_has_cont = eva.get_anno(d+1, p).has_contour(cont_name)
+        prev_has_cont = summary.has_contour(cont_name, d-1, p)
+        next_has_cont = summary.has_contour(cont_name, d+1, p)
         if prev_has_cont and next_has_cont: return 'midv'
         if prev_has_cont and not next_has_cont: return 'apical'
         if not prev_has_cont and next_has_cont: return 'basal'
@@ -36,7 +36,7 @@ class Metrics_Table(Table):
         rows, cols = [], []
         for d in range(eval1.nr_slices):
             try:
-                dcm          = eval1.get_dcm(d, p1)
+                dcm          = eval1.get_geometry(d, p1)
                 anno1, anno2 = eval1.get_anno(d, p1), eval2.get_anno(d, p2)
                 cont1, cont2 = anno1.get_contour(contname), anno2.get_contour(contname)
                 ml_diff      = mlDiff_m.get_val(cont1, cont2, dcm, string=pretty)
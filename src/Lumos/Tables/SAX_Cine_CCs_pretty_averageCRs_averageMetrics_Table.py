@@ -26,7 +26,7 @@ class SAX_Cine_CCs_pretty_averageCRs_averageMetrics_Table(Table):
         for cname in ['lv_endo', 'lv_myo', 'rv_endo']: 
             dices[cname]=[]; dices_both[cname]=[]; hds[cname]=[]; absmldiffs[cname]=[]
         for eva1,eva2 in zip(evals1, evals2):
-            dcm = eva1.get_dcm(0,0)
+            dcm = eva1.get_geometry(0,0)
             for d in range(eva1.nr_slices):
                 # get the phases
                 esp, edp = view.clinical_phases['lv_endo']
@@ -14,8 +14,8 @@ from Lumos.Tables.SAX_CINE_CCs_Metrics_Table import *
 
 class SAX_Cine_Metrics_By_CardiacLocation_Table(Table):
     def get_cardiac_location(self, eva, contname, phase):
-        annos     = [eva.get_anno(d, phase) for d in range(eva.nr_slices)]
-        has_conts = [a.has_contour(contname) if a is not None else 0.0 for a in annos]
+        summary   = eva.get_summary()
+        has_conts = [summary.has_contour(contname, d, phase) for d in range(eva.nr_slices)]
         if True not in has_conts: return None
         base_idx = has_conts.index(True)
         apex_idx = eva.nr_slices - has_conts[::-1].index(True) - 1
@@ -42,7 +42,7 @@ class SAX_Cine_Metrics_By_CardiacLocation_Table(Table):
                 absmldiffs[cname + ' ' + cardiac_structure] = []
         # calculate metric values
         for eva1,eva2 in zip(evals1, evals2):
-            dcm = eva1.get_dcm(0,0)
+            dcm = eva1.get_geometry(0,0)
             for cname in ['lv_endo', 'lv_myo', 'rv_endo']: 
                 phases = view.clinical_phases[cname]
                 phases = [view.clinical_parameters[p] for p in phases]
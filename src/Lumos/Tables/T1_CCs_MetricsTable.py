@@ -31,7 +31,7 @@ class T1_CCs_MetricsTable(Table):
             for cat1, cat2 in zip(cats1, cats2):
                 for d in range(cat1.nr_slices):
                     try:
-                        dcm = cat1.get_dcm(d, 0)
+                        dcm = cat1.get_geometry(d, 0)
                         img1 = cat1.get_img(d,0, True, False)
                         img2 = cat2.get_img(d,0, True, False)
                         anno1, anno2 = cat1.get_anno(d, 0), cat2.get_anno(d, 0)
@@ -0,0 +1,232 @@
+####################
+# Batch Evaluation #
+####################
+
+# Headless evaluation of a cohort for a set of tasks:
+#   - one item per (task_id, studyuid, imagetype, stack_nr) of the cohort's studies that the task covers
+#   - items are evaluated in a process pool, every worker process opens its own database connection
+#   - evaluation documents are written by the main process with unordered bulk upserts
+#   - resumable: items that already have an evaluation document are skipped (unless overwrite)
+#   - errors and printed output are captured per item instead of printed, failed items are retried on the next run
+#   - Batch_Report with progress and throughput (items/s)
+#
+# Usage:
+#   python -m Lumos.batch_evaluation --cohort <name> --tasks <task_id> [<task_id> ...] [--uri <uri> | --sqlite <folder>]
+
+import io
+import os
+import sys
+import time
+import argparse
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from bson import ObjectId
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from Lumos.Quad import QUAD_Manager
+from Lumos.Storage import Mongo_Backend, SQLite_Backend
+from Lumos.Case import case_imagetypes
+from Lumos.Evaluation import Evaluation, get_view
+
+
+eval_key_fields = ['task_id', 'studyuid', 'imagetype', 'stack_nr']
+
+
+class Batch_Report:
+    """Batch_Report counts the items of a batch evaluation and reports the throughput
+
+    Attributes:
+        nr_items (int): number of items of the cohort and tasks
+        nr_skipped (int): number of items with an evaluation document (not evaluated again)
+        nr_evaluated (int): number of evaluated items
+        nr_written (int): number of evaluation documents written
+        nr_failed (int): number of items whose evaluation or write failed
+        failed (list of (tuple, str)): (item, error) of failed items
+        messages (list of (tuple, str)): (item, printed output) of items that printed while evaluating (e.g. warnings)
+    """
+    def __init__(self):
+        self.start_time   = time.time()
+        self.nr_items     = 0
+        self.nr_skipped   = 0
+        self.nr_evaluated = 0
+        self.nr_written   = 0
+        self.nr_failed    = 0
+        self.failed       = []
+        self.messages     = []
+
+    def add_failure(self, item, error):
+        self.nr_failed += 1
+        self.failed.append((item, error))
+
+    def seconds(self):
+        return max(time.time() - self.start_time, 1e-9)
+
+    def items_per_second(self):
+        return self.nr_evaluated / self.seconds()
+
+    def __str__(self):
+        return ('Items: %d, Skipped: %d, Evaluated: %d, Written: %d, Failed: %d, With output: %d, %.1fs: %.2f items/s' %
+                (self.nr_items, self.nr_skipped, self.nr_evaluated, self.nr_written, self.nr_failed, len(self.messages),
+                 self.seconds(), self.items_per_second()))
+
+
+def connect(uri=None, dbname='Lumos_CMR_QualityAssuranceDatabase', sqlite_folder=None):
+    """Opens a QUAD_Manager on a MongoDB (uri) or on SQLite databases in sqlite_folder (picklable, used by worker processes)"""
+    backend = SQLite_Backend(sqlite_folder) if sqlite_folder is not None else Mongo_Backend(uri)
+    return QUAD_Manager(dbname=dbname, backend=backend)
+
+
+def resolve_task_ids(quad, task_ids):
+    """Task environment ids as stored (ObjectIds given as strings are converted)"""
+    resolved = []
+    for task_id in task_ids:
+        if quad.task_coll.find_one({'_id': task_id}, {'_id': 1}) is None and ObjectId.is_valid(task_id): task_id = ObjectId(task_id)
+        if quad.task_coll.find_one({'_id': task_id}, {'_id': 1}) is None: raise ValueError('Unknown task: ' + str(task_id))
+        resolved.append(task_id)
+    return resolved
+
+
+def get_items(quad, cohort_name, task_ids, imagetypes=case_imagetypes):
+    """Returns the (task_id, studyuid, imagetype, stack_nr) items of a cohort for the tasks (with a view for their imagetype)"""
+    cohort = quad.coho_coll.find_one({'name': cohort_name})
+    if cohort is None: raise ValueError('Unknown cohort: ' + cohort_name)
+    imagetypes = [it for it in imagetypes if get_view(it) is not None]
+    stacks = sorted((j['studyuid'], j['imagetype'], j['stack_nr']) for j in quad.imgo_coll.find(
+                    {'studyuid': {'$in': cohort['studyuids']}, 'imagetype': {'$in': imagetypes}},
+                    {'_id': 0, 'studyuid': 1, 'imagetype': 1, 'stack_nr': 1}))
+    items = []
+    for task in quad.task_coll.find({'_id': {'$in': list(task_ids)}}, {'_id': 1, 'studyuids': 1}):
+        studyuids = set(task.get('studyuids', cohort['studyuids']))
+        items += [(task['_id'],) + stack for stack in stacks if stack[0] in studyuids]
+    return items
+
+
+def get_evaluated(quad, items):
+    """Items that already have an evaluation document"""
+    task_ids, studyuids = list({i[0] for i in items}), list({i[1] for i in items})
+    projection = dict({k: 1 for k in eval_key_fields}, _id=0)
+    docs = quad.eval_coll.find({'task_id': {'$in': task_ids}, 'studyuid': {'$in': studyuids}}, projection)
+    return {tuple(j.get(k) for k in eval_key_fields) for j in docs}
+
+
+# database connection of a worker process (opened by init_worker)
+worker_quad = None
+
+def init_worker(connect_kwargs):
+    global worker_quad
+    worker_quad = connect(**connect_kwargs)
+
+
+def evaluate_item(item, quad=None):
+    """Evaluates one (task_id, studyuid, imagetype, stack_nr) item
+
+    Returns:
+        (tuple, dict, str, str): item, evaluation document (None on failure), error (None on success), printed output
+    """
+    quad, output = worker_quad if quad is None else quad, io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            eva = Evaluation(quad, *item)
+            eva.evaluate()
+            doc = eva.to_json()
+        return item, doc, None, output.getvalue()
+    except Exception as e: return item, None, traceback.format_exc(), output.getvalue()
+
+
+def write_batch(quad, docs, report):
+    """Upserts evaluation documents unordered, write errors are reported per item"""
+    if len(docs)==0: return
+    requests = [ReplaceOne({k: doc[k] for k in eval_key_fields}, doc, upsert=True) for doc in docs]
+    try:
+        result = quad.eval_coll.bulk_write(requests, ordered=False)
+        report.nr_written += result.upserted_count + result.matched_count
+    except BulkWriteError as e:
+        details = e.details
+        report.nr_written += details.get('nUpserted', 0) + details.get('nMatched', 0)
+        for error in details.get('writeErrors', []):
+            report.add_failure(tuple(docs[error['index']][k] for k in eval_key_fields), error.get('errmsg'))
+    except Exception as e: # e.g. a document that cannot be encoded, written one by one to find it
+        for doc, request in zip(docs, requests):
+            try:    quad.eval_coll.bulk_write([request]); report.nr_written += 1
+            except: report.add_failure(tuple(doc[k] for k in eval_key_fields), traceback.format_exc())
+
+
+def evaluate_cohort(quad, cohort_name, task_ids, imagetypes=case_imagetypes, nr_workers=None, batch_size=50, overwrite=False,
+                    connect_kwargs=None, verbose=True):
+    """Evaluates all stacks of a cohort for the tasks and stores the evaluation documents
+
+    Note:
+        Without connect_kwargs (arguments of connect) or with nr_workers<=1 the items are evaluated in this process on quad.
+
+    Args:
+        quad (Lumos.Quad.QUAD_Manager): database manager, evaluation documents are written with it
+        cohort_name (str): name of the cohort
+        task_ids (list): task environment ids
+        imagetypes (list of str): imagetypes to evaluate
+        nr_workers (int): number of worker processes, None for all cpus
+        batch_size (int): number of evaluation documents per bulk write
+        overwrite (bool): evaluate items with an evaluation document again
+        connect_kwargs (dict): connection of the worker processes, e.g. {'uri': ..., 'dbname': ...}
+        verbose (bool): prints progress
+
+    Returns:
+        Batch_Report: counts, failed items with their errors and throughput
+    """
+    report = Batch_Report()
+    items  = get_items(quad, cohort_name, task_ids, imagetypes)
+    report.nr_items = len(items)
+    if not overwrite:
+        evaluated = get_evaluated(quad, items)
+        todo      = [i for i in items if i not in evaluated]
+        report.nr_skipped = len(items) - len(todo)
+        items     = todo
+
+    docs = []
+    def handle(result):
+        item, doc, error, output = result
+        report.nr_evaluated += 1
+        if output.strip(): report.messages.append((item, output))
+        if error is not None: report.add_failure(item, error)
+        else:                 docs.append(doc)
+        if len(docs)>=batch_size: write_batch(quad, docs, report); docs.clear()
+        if verbose and report.nr_evaluated%batch_size==0: print(report)
+
+    nr_workers = os.cpu_count() if nr_workers is None else nr_workers
+    in_memory  = connect_kwargs is not None and connect_kwargs.get('sqlite_folder')==':memory:' # not shared with other processes
+    if connect_kwargs is None or in_memory or nr_workers<=1 or len(items)<2:
+        for item in items: handle(evaluate_item(item, quad))
+    else:
+        with ProcessPoolExecutor(max_workers=min(nr_workers, len(items)), initializer=init_worker, initargs=(connect_kwargs,)) as executor:
+            for future in as_completed([executor.submit(evaluate_item, item) for item in items]): handle(future.result())
+    write_batch(quad, docs, report)
+    if verbose: print(report)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluates all stacks of a cohort for a set of tasks.')
+    parser.add_argument('--cohort',     required=True, help='cohort name')
+    parser.add_argument('--tasks',      required=True, nargs='+', help='task environment ids')
+    parser.add_argument('--uri',        default=None, help='MongoDB connection string (default: localhost)')
+    parser.add_argument('--sqlite',     default=None, help='folder of SQLite databases instead of MongoDB')
+    parser.add_argument('--dbname',     default='Lumos_CMR_QualityAssuranceDatabase')
+    parser.add_argument('--imagetypes', nargs='+', default=case_imagetypes)
+    parser.add_argument('--workers',    type=int, default=None, help='number of worker processes (default: all cpus)')
+    parser.add_argument('--batch-size', type=int, default=50, help='evaluation documents per bulk write')
+    parser.add_argument('--overwrite',  action='store_true', help='evaluate items with an evaluation document again')
+    parser.add_argument('--quiet',      action='store_true')
+    args = parser.parse_args(argv)
+
+    connect_kwargs = {'uri': args.uri, 'dbname': args.dbname, 'sqlite_folder': args.sqlite}
+    quad   = connect(**connect_kwargs)
+    report = evaluate_cohort(quad, args.cohort, resolve_task_ids(quad, args.tasks), imagetypes=args.imagetypes, nr_workers=args.workers,
+                             batch_size=args.batch_size, overwrite=args.overwrite, connect_kwargs=connect_kwargs, verbose=not args.quiet)
+    for item, error in report.failed: print('FAILED', item, error.strip().splitlines()[-1] if error else error)
+    return 1 if report.nr_failed>0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,12 @@
+import io
+import os
 import unittest
+from unittest import mock
+import contextlib
 import numpy as np
 
 from Lumos.utils import *
+from Lumos.LRUCache import LRU_Cache
 
 class TestRasterizing(unittest.TestCase):
     def test_Polygon(self):
@@ -76,7 +81,316 @@ class TestRasterizing(unittest.TestCase):
         geo5 = MultiPoint(((1,1),(2,2)))
         with self.assertRaises(Exception):
             to_mask_pct(geo5, 12, 10)
-     
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRU_Cache(max_bytes=3, sizeof=lambda v: 1)
+        for k in 'abc': cache.put(k, k)
+        cache.get('a')
+        cache.put('d', 'd')
+        self.assertFalse('b' in cache)
+        self.assertTrue('a' in cache)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_counters(self):
+        cache = LRU_Cache(max_bytes=10, sizeof=lambda v: 4)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['nbytes']), (1, 1, 4))
+
+    def test_too_large(self):
+        cache = LRU_Cache(max_bytes=10, sizeof=lambda v: 11)
+        self.assertFalse(cache.put('a', 1))
+        self.assertEqual(len(cache), 0)
+
+    def test_resize(self):
+        cache = LRU_Cache(max_bytes=10, sizeof=lambda v: 4)
+        for k in 'ab': cache.put(k, k)
+        cache.resize(4)
+        self.assertEqual(list(cache.entries.keys()), ['b'])
+
+
+class TestSQLiteBackend(unittest.TestCase):
+    def setUp(self):
+        from Lumos.Storage import SQLite_Backend
+        self.coll = SQLite_Backend(':memory:').get_database('test')['annotations']
+        self.coll.create_index([('task_id', 1), ('sop', 1)], unique=True)
+        self.coll.insert_many([{'task_id': 't1', 'sop': 'a', 'geom': {'n': 1}}, {'task_id': 't1', 'sop': 'b', 'tags': ['x', 'y']},
+                               {'task_id': 't2', 'sop': 'a'}])
+
+    def test_find(self):
+        self.assertEqual(len(list(self.coll.find({'task_id': 't1', 'sop': {'$in': ['a', 'b']}}))), 2)
+        self.assertEqual(self.coll.find_one({'tags': 'x'}, {'sop': 1, '_id': 0}), {'sop': 'b'})
+        self.assertEqual(self.coll.find_one({'tags': 'x'}, {'_id': 0}), {'task_id': 't1', 'sop': 'b', 'tags': ['x', 'y']})
+        self.assertEqual(self.coll.count_documents({'$or': [{'task_id': 't2'}, {'geom.n': {'$gte': 1}}]}), 2)
+
+    def test_unsupported_find_options(self):
+        with self.assertRaises(NotImplementedError): self.coll.find({}, sort=[('sop', 1)])
+        with self.assertRaises(NotImplementedError): self.coll.find_one({}, skip=1)
+        self.assertEqual(len(list(self.coll.find({}, limit=0, batch_size=10))), 3)
+
+    def test_unique(self):
+        from pymongo.errors import DuplicateKeyError
+        with self.assertRaises(DuplicateKeyError): self.coll.insert_one({'task_id': 't1', 'sop': 'a'})
+
+    def test_conflicting_update(self):
+        from pymongo.errors import DuplicateKeyError
+        with self.assertRaises(DuplicateKeyError): self.coll.update_one({'task_id': 't1', 'sop': 'b'}, {'$set': {'sop': 'a'}})
+        with self.assertRaises(DuplicateKeyError): self.coll.replace_one({'task_id': 't1', 'sop': 'b'}, {'task_id': 't1', 'sop': 'a'})
+        self.assertEqual(sorted(j['sop'] for j in self.coll.find({'task_id': 't1'})), ['a', 'b'])
+        self.assertEqual(self.coll.find_one({'task_id': 't1', 'sop': 'a'})['geom'], {'n': 1})
+
+    def test_update(self):
+        self.coll.update_one({'task_id': 't3', 'sop': 'c'}, {'$set': {'geom.n': 2}}, upsert=True)
+        self.assertEqual(self.coll.find_one({'task_id': 't3'})['geom'], {'n': 2})
+        self.coll.update_many({'task_id': 't1'}, {'$unset': {'geom': ''}})
+        self.assertEqual(self.coll.count_documents({'geom': {'$exists': True}}), 1)
+
+
+class TestImports(unittest.TestCase):
+    def test_fresh_imports(self):
+        # every module and subpackage of Lumos imports on its own (catches import cycles hidden by the import order of a test run)
+        import sys, pkgutil, subprocess, Lumos
+        env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+        for module in pkgutil.iter_modules(Lumos.__path__, 'Lumos.'):
+            if module.name=='Lumos.unittests': continue
+            with self.subTest(module=module.name):
+                result = subprocess.run([sys.executable, '-c', 'import '+module.name], capture_output=True, text=True, env=env)
+                self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+
+
+class TestContentHash(unittest.TestCase):
+    def test_hash(self):
+        from Lumos.Annotation import add_wkb, get_content_hash
+        cont = {'type': 'Polygon', 'coordinates': [[[0, 0], [0, 4], [4, 4], [0, 0]]]}
+        anno = add_wkb({'lv_endo': {'cont': cont}, 'task_id': 't1', 'sop': 'a'})
+        self.assertEqual(anno['content_hash'], get_content_hash({'lv_endo': {'cont': cont}, 'sop': 'b'}))
+        self.assertEqual(anno['content_hash'], get_content_hash(anno))
+        self.assertNotEqual(anno['content_hash'], get_content_hash({'rv_endo': {'cont': cont}}))
+
+
+class TestAnnotationCache(unittest.TestCase):
+    def test_databases_do_not_share_entries(self):
+        from Lumos.Quad import QUAD_Manager
+        from Lumos.Storage import SQLite_Backend
+        from Lumos.Annotation import Annotation_Store
+        quads = [QUAD_Manager(backend=SQLite_Backend(':memory:'), dbname='test') for size in [2, 3]]
+        for quad, size in zip(quads, [2, 3]): quad.insert_anno({'lv_endo': square(0, size)}, 't', '1.2.3', 's1') # same task and sop
+        areas = [Annotation_Store(quad, 't', '1.2.3', {(0, 0): 's1'}).get_anno(0, 0).get_contour('lv_endo').area for quad in quads]
+        self.assertEqual(areas, [4, 9])
+
+
+class TestClinicalResultMemo(unittest.TestCase):
+    def test_memo_errors_are_misses(self):
+        from Lumos.ClinicalResults import LVSAX_ESV
+        class Stub_Evaluation:
+            clinical_parameters = {'LVESV': [42.0, '[ml]']}
+            def get_cr_memo(self): raise RuntimeError('read-only database')
+        self.assertEqual(LVSAX_ESV().get_val(Stub_Evaluation()), 42.0)
+
+    def test_memo_written_on_first_put(self):
+        from Lumos.Storage import SQLite_Backend
+        from Lumos.Evaluation import Clinical_Result_Memo
+        coll, key = SQLite_Backend(':memory:').get_database('test')['clinical_result_memo'], {'task_id': 't', 'stack_nr': 0}
+        memo = Clinical_Result_Memo(coll, key, 'h1')
+        self.assertEqual(coll.count_documents({}), 0)
+        memo.put('LVSAX_ESV', np.float64(2.5)); memo.put('NR_SLICES', 6)
+        self.assertEqual(Clinical_Result_Memo(coll, key, 'h1').values, {'LVSAX_ESV': 2.5, 'NR_SLICES': 6})
+        self.assertEqual(Clinical_Result_Memo(coll, key, 'h2').values, {})
+
+
+def make_sax_database(folder, nr_slices, nr_phases):
+    # SQLite database with a 'SAX CINE' stack of small dicoms in folder (study '1.2.3') and a task 't'
+    import pydicom
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+    from Lumos.Quad import QUAD_Manager
+    from Lumos.Storage import SQLite_Backend
+    from Lumos.ImageOrganizer import ImageOrganizer
+    quad = QUAD_Manager(backend=SQLite_Backend(folder), dbname='test')
+    for d in range(nr_slices):
+        for p in range(nr_phases):
+            path, meta = os.path.join(folder, '%d_%d.dcm' % (d, p)), FileMetaDataset()
+            meta.MediaStorageSOPClassUID, meta.MediaStorageSOPInstanceUID, meta.TransferSyntaxUID = '1.2.840.10008.5.1.4.1.1.4', generate_uid(), ExplicitVRLittleEndian
+            dcm = FileDataset(path, {}, file_meta=meta, preamble=b'\0'*128)
+            dcm.SOPInstanceUID, dcm.StudyInstanceUID, dcm.SeriesInstanceUID, dcm.SeriesDescription = meta.MediaStorageSOPInstanceUID, '1.2.3', '1.2.3.1', 'sax'
+            dcm.Rows, dcm.Columns, dcm.PixelSpacing, dcm.SliceThickness, dcm.SliceLocation = 16, 16, [1.5, 1.5], 8, float(d*8)
+            dcm.InstanceNumber, dcm.ImagePositionPatient = p+1, [0, 0, d*8]
+            dcm.BitsAllocated, dcm.BitsStored, dcm.HighBit, dcm.SamplesPerPixel, dcm.PixelRepresentation = 16, 16, 15, 1, 0
+            dcm.RescaleSlope, dcm.RescaleIntercept, dcm.WindowCenter, dcm.WindowWidth = 2, -10, 500, 800
+            dcm.PhotometricInterpretation, dcm.PixelData = 'MONOCHROME2', (np.arange(256, dtype=np.uint16).reshape(16, 16)*3 + d*10+p).tobytes()
+            dcm.save_as(path, write_like_original=False)
+            quad.insert_dicom(pydicom.dcmread(path, stop_before_pixels=True), path)
+    quad.dcm_coll.update_many({}, {'$set': {'imagetype': 'SAX CINE', 'stack_nr': 0}})
+    imgo = ImageOrganizer(quad, '1.2.3', 'SAX CINE', 0); imgo.organize(); quad.insert_img_o(imgo)
+    quad.insert_task_environment({'_id': 't', 'displayname': 't', 'studyuids': ['1.2.3']})
+    return quad
+
+def square(offset, size):
+    return {'cont': {'type': 'Polygon', 'coordinates': [[[offset, offset], [offset, offset+size], [offset+size, offset+size], [offset+size, offset], [offset, offset]]]}}
+
+
+class Sax_Database_Test(unittest.TestCase):
+    # 4 slices, 3 phases: lv_endo on slices 0-2 in phase 0, only on slice 2 in phase 1 (base==apex), none in phase 2
+    def setUp(self):
+        import tempfile
+        from Lumos import PixelCache
+        from Lumos.ImageOrganizer import ImageOrganizer
+        self.folder = tempfile.mkdtemp()
+        self.pixel_cache_folder = PixelCache.pixel_cache_folder
+        PixelCache.set_pixel_cache_folder(os.path.join(self.folder, 'pixel_cache'))
+        with contextlib.redirect_stdout(io.StringIO()): self.quad = make_sax_database(self.folder, 4, 3)
+        self.sops = ImageOrganizer(self.quad, '1.2.3', 'SAX CINE', 0).depthandtime2sop
+        for (d, p), sop in self.sops.items():
+            anno = {}
+            if (p==0 and d<3) or (p==1 and d==2): anno['lv_endo'] = square(1+d, 3+p)
+            if p==0 and d==1: anno['rv_endo'] = square(6, 4)
+            if len(anno)>0: self.quad.insert_anno(anno, 't', '1.2.3', sop)
+
+    def tearDown(self):
+        import shutil
+        from Lumos import PixelCache
+        PixelCache.set_pixel_cache_folder(self.pixel_cache_folder)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def get_evaluation(self):
+        from Lumos.Evaluation import Evaluation
+        with contextlib.redirect_stdout(io.StringIO()): return Evaluation(self.quad, 't', '1.2.3', 'SAX CINE', 0)
+
+
+class TestVolumeCurve(Sax_Database_Test):
+    def get_volume_per_slice(self, eva, phase, cont_name):
+        # volume computation before get_volume_curve (one loop over the slices per phase)
+        annos = [eva.get_anno(d, phase) for d in range(eva.nr_slices)]
+        areas = [a.get_contour(cont_name).area*eva.pixel_h*eva.pixel_w if a is not None else 0.0 for a in annos]
+        has_conts = [a!=0 for a in areas]
+        if True not in has_conts: return 0
+        base_idx, apex_idx = has_conts.index(True), eva.nr_slices - has_conts[::-1].index(True) - 1
+        vol = 0
+        for d in range(eva.nr_slices):
+            vol += areas[d] * ((eva.slice_thickness+eva.spacing_between_slices)/2.0 if d in [base_idx, apex_idx] else eva.spacing_between_slices)
+        for d in eva.missing_slices: vol += (areas[d] + areas[d+1])/2 * eva.spacing_between_slices
+        return vol / 1000.0
+
+    def test_volume_curve(self):
+        for missing_slices in [[], [1]]:
+            eva = self.get_evaluation()
+            eva.missing_slices = missing_slices
+            curve = eva.get_volume_curve('lv_endo')
+            self.assertEqual(curve[2], 0)
+            self.assertGreater(curve[1], 0)
+            for p in range(eva.nr_phases): self.assertAlmostEqual(curve[p], self.get_volume_per_slice(eva, p, 'lv_endo'))
+            self.assertTrue(np.all(eva.get_volume_curve('lv_pamu')==0))
+
+
+class TestEvaluationSummary(Sax_Database_Test):
+    def test_summary(self):
+        eva     = self.get_evaluation()
+        summary = eva.get_summary()
+        self.assertEqual(sorted(summary.get_available_contours()), ['lv_endo', 'rv_endo'])
+        for (d, p) in self.sops:
+            anno = eva.get_anno(d, p)
+            for name in ['lv_endo', 'rv_endo']:
+                self.assertEqual(summary.has_contour(name, d, p), anno.has_contour(name))
+                self.assertAlmostEqual(eva.get_areas(name)[d, p], anno.get_contour(name).area*eva.pixel_h*eva.pixel_w)
+        self.assertTrue(summary.has_contour('lv_endo', phase_nr=1) and not summary.has_contour('lv_endo', phase_nr=2))
+        self.assertEqual(tuple(summary.get_bounding_box(eva.imgo.height, eva.imgo.width)), tuple(eva.get_bounding_box()))
+
+    def test_summary_after_external_edit(self):
+        eva = self.get_evaluation(); eva.evaluate(); self.quad.insert_eval(eva)
+        area = self.get_evaluation().get_areas('lv_endo')[1, 0] # annotation of (1, 0) in the annotation cache
+        sop  = self.sops[(1, 0)]
+        self.quad.anno_coll.replace_one({'task_id': 't', 'sop': sop}, self.quad.prepare_anno({'lv_endo': square(0, 8)}, 't', '1.2.3', sop))
+        self.assertNotEqual(area, 64*eva.pixel_h*eva.pixel_w) # edited by another process: annotation cache not invalidated
+        self.assertAlmostEqual(self.get_evaluation().get_areas('lv_endo')[1, 0], 64*eva.pixel_h*eva.pixel_w)
+
+
+class TestImgStack(Sax_Database_Test):
+    def test_stack_matches_images(self):
+        from Lumos import PixelCache
+        from Lumos.ImageOrganizer import ImageOrganizer, image_cache
+        for imagetype in ['SAX CINE', 'SAX T1 PRE']: # window normalized, rescaled only
+            for cache_folder in [os.path.join(self.folder, 'pixel_cache'), None]:
+                PixelCache.set_pixel_cache_folder(cache_folder); image_cache.clear()
+                imgo = ImageOrganizer(self.quad, '1.2.3', 'SAX CINE', 0)
+                imgo.imagetype = imagetype
+                for p in range(imgo.nr_phases):
+                    imgs = np.stack([imgo.get_img(d, p) for d in range(imgo.nr_slices)])
+                    self.assertTrue(np.allclose(imgo.get_img_stack(p), imgs, atol=1e-3), (imagetype, cache_folder, p))
+
+    def test_out(self):
+        from Lumos.ImageOrganizer import ImageOrganizer
+        imgo = ImageOrganizer(self.quad, '1.2.3', 'SAX CINE', 0)
+        out  = np.zeros((imgo.nr_slices, 16, 16), dtype=np.float32)
+        self.assertTrue(np.shares_memory(imgo.get_img_stack(1, out=out), out))
+        self.assertTrue(np.array_equal(out, imgo.get_img_stack(1)))
+        for wrong in [np.zeros((imgo.nr_slices, 16, 32), dtype=np.float32)[:, :, ::2], out.astype(np.float64), out[:-1]]:
+            with self.assertRaises(ValueError): imgo.get_img_stack(1, out=wrong)
+
+
+class TestReevaluate(Sax_Database_Test):
+    def test_reevaluate(self):
+        from unittest import mock
+        from Lumos.Evaluation import Evaluation
+        eva = self.get_evaluation(); eva.evaluate(); self.quad.insert_eval(eva)
+        self.assertEqual(self.get_evaluation().reevaluate()['slices'], [])
+        self.quad.replace_anno({'lv_endo': square(0, 8)}, 't', '1.2.3', self.sops[(0, 1)])
+        report = self.get_evaluation().reevaluate()
+        self.assertEqual(report['slices'], [(0, 1)])
+        self.assertIn('lv_endo', report['geometries'])
+        stored, full = self.get_evaluation(), self.get_evaluation()
+        full.evaluate()
+        self.assertEqual(stored.slice_results, full.slice_results)
+        self.assertEqual(stored.clinical_parameters, full.clinical_parameters)
+        with mock.patch.object(Evaluation, 'get_slice_results') as get_slice_results: # summary from the stored slice results
+            self.assertTrue(np.array_equal(stored.get_areas('lv_endo'), full.get_areas('lv_endo')))
+            get_slice_results.assert_not_called()
+        self.quad.eval_coll.delete_many({})
+        self.quad.replace_anno({'lv_endo': square(0, 9)}, 't', '1.2.3', self.sops[(0, 1)])
+        with self.assertRaises(ValueError): stored.reevaluate()
+
+
+class TestBatchEvaluation(Sax_Database_Test):
+    def test_batch(self):
+        from Lumos import batch_evaluation as be
+        self.quad.insert_cohort({'name': 'c', 'owner': 'o', 'studyuids': ['1.2.3']})
+        items = be.get_items(self.quad, 'c', ['t'])
+        self.assertEqual(items, [('t', '1.2.3', 'SAX CINE', 0)])
+        report = be.evaluate_cohort(self.quad, 'c', ['t'], nr_workers=1, verbose=False)
+        self.assertEqual((report.nr_evaluated, report.nr_written, report.nr_failed), (1, 1, 0))
+        self.assertEqual(be.get_evaluated(self.quad, items), set(items))
+        report = be.evaluate_cohort(self.quad, 'c', ['t'], nr_workers=1, verbose=False)
+        self.assertEqual((report.nr_skipped, report.nr_evaluated), (1, 0))
+        doc = self.quad.eval_coll.find_one({'task_id': 't'}, {'_id': 0})
+        bad = dict(doc, studyuid='1.2.4', slice_results={1: 'int keys cannot be encoded'})
+        report = be.Batch_Report()
+        be.write_batch(self.quad, [doc, bad], report) # encoding error: falls back to writing one by one
+        self.assertEqual((report.nr_written, report.nr_failed), (1, 1))
+        self.assertEqual(report.failed[0][0], ('t', '1.2.4', 'SAX CINE', 0))
+
+    def test_worker_processes(self):
+        from concurrent.futures import ProcessPoolExecutor
+        from Lumos import batch_evaluation as be
+        self.quad.insert_task_environment({'_id': 't2', 'displayname': 't2', 'studyuids': ['1.2.3']})
+        self.quad.anno_coll.insert_many([dict(j, task_id='t2') for j in self.quad.anno_coll.find({'task_id': 't'}, {'_id': 0})])
+        self.quad.insert_cohort({'name': 'c', 'owner': 'o', 'studyuids': ['1.2.3']})
+        pools = []
+        class Recorded_Pool(ProcessPoolExecutor):
+            def __init__(self, *args, **kwargs): pools.append(kwargs); super().__init__(*args, **kwargs)
+        with mock.patch.object(be, 'ProcessPoolExecutor', Recorded_Pool):
+            report = be.evaluate_cohort(self.quad, 'c', ['t', 't2'], nr_workers=2, verbose=False,
+                                        connect_kwargs={'sqlite_folder': self.folder, 'dbname': 'test'})
+        self.assertEqual([p['max_workers'] for p in pools], [2]) # evaluated in worker processes with their own connections
+        self.assertEqual((report.nr_evaluated, report.nr_written, report.nr_failed), (2, 2, 0), report.failed)
+        expected = self.get_evaluation(); expected.evaluate()
+        stored = self.quad.eval_coll.find_one({'task_id': 't', 'studyuid': '1.2.3'})
+        self.assertEqual(stored['clinical_parameters'], expected.clinical_parameters)
+        self.assertEqual(self.quad.eval_coll.count_documents({'task_id': 't2'}), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -110,6 +110,15 @@ class Dicom_Organizer:
         keys = self.get_section_keys()
         return [self.get_first_path_from_section(k) for k in keys]
     
+    def get_section_previews(self, key, level=8):
+        # uint8 previews of all images of a section from the preview pyramid (no full resolution decoding)
+        from Lumos.PixelCache import get_previews # not at module level: Lumos.utils is imported by the image modules
+        return get_previews(self.quad, self.get_paths_from_section(key), level)
+    
+    def get_first_preview_all_sections(self, level=8):
+        from Lumos.PixelCache import get_previews
+        return get_previews(self.quad, self.get_first_path_all_sections(), level)
+    
     def get_firstpath_hasanno_nr(self, key):
         firstpath = self.get_first_path_from_section(key)
         has_anno  = self.section_has_annotations(key)
@@ -1,4 +1,5 @@
 from time import time
+from datetime import date
 
 import numpy as np
 from scipy.ndimage import morphology
@@ -55,11 +56,29 @@ def dcmvalue2pythontype(key, val):
         if val=='None': val='Unknown'
     return val
 
+# lean header documents: only the dcmtag2name fields and the path, no bulk data (pixel data etc.)
+dicom_header_projection = dict({'_id': 0, 'path': 1, 'stack_nr': 1, 'seriesdescription': 1}, **{name: 1 for name in dcmtag2name.values()})
+
+# patient demographics: header document field -> case document / Case attribute
+demographics_fields = {'name': 'name', 'age': 'age', 'sex': 'gender', 'weight': 'weight', 'size': 'height'}
+
+def get_demographics(dcm_coll, studyuid):
+    """Patient name, age, sex, weight and size of a study from its lean header documents (no file reads)
+
+    Returns:
+        list of str: [name, age, sex, weight, size] ('' if not in the headers), None if no header document has demographics
+    """
+    query = {'studyuid': studyuid, '$or': [{f: {'$exists': True}} for f in demographics_fields]}
+    doc   = dcm_coll.find_one(query, dict({'_id': 0}, **{f: 1 for f in demographics_fields}))
+    if doc is None: return None
+    return [str(doc[f]) if doc.get(f) is not None else '' for f in demographics_fields]
+
 def dcm_to_json(dcm, path):
     json_dict = {'path': path}
     for tag,name in dcmtag2name.items():
         try: json_dict[name] = dcmvalue2pythontype(name, dcm[tag].value)
         except Exception as e: continue
+    json_dict.setdefault('imagetype', 'Unknown')
     return json_dict
 
 